@@ -0,0 +1,149 @@
+import argparse
+from copy import deepcopy
+from time import time
+
+import numpy as np
+import torch
+from batchgenerators.dataloading.data_loader import SlimDataLoaderBase
+from d_lka_former.training.data_augmentation.data_augmentation_moreDA import (
+    get_moreDA_augmentation,
+)
+from d_lka_former.training.data_augmentation.default_data_augmentation import (
+    default_3D_augmentation_params,
+    get_patch_size,
+)
+from d_lka_former.training.data_augmentation.torch_augmentation import (
+    get_torch_augmentation,
+)
+
+
+class RandomPatchLoader(SlimDataLoaderBase):
+    def __init__(self, shape, batch_size, num_classes):
+        """
+        Stands in for DataLoader3D: random patches of the given shape with a few blocks of foreground (and -1 at the
+        border, like padded cases) so that the segmentation transforms have something to do
+        """
+        super(RandomPatchLoader, self).__init__(None, batch_size, None)
+        self.shape = shape
+        self.num_classes = num_classes
+
+    def generate_train_batch(self):
+        data = np.random.normal(size=[self.batch_size, 1] + list(self.shape)).astype(
+            np.float32
+        )
+        seg = np.zeros([self.batch_size, 1] + list(self.shape), dtype=np.float32)
+        for b in range(self.batch_size):
+            for label in range(1, self.num_classes):
+                slicer = tuple(
+                    slice(lb, lb + s // 4)
+                    for lb, s in zip(
+                        [np.random.randint(0, s // 2) for s in self.shape], self.shape
+                    )
+                )
+                seg[(b, 0) + slicer] = label
+        seg[:, :, :4] = -1
+        return {"data": data, "seg": seg, "keys": ["random"] * self.batch_size}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares the throughput of the batchgenerators data augmentation (MultiThreadedAugmenter "
+        "workers) with the torch backend (workers only load, augmentation runs batched on one device). Uses random "
+        "patches, so no dataset is needed"
+    )
+    parser.add_argument("--patch_size", nargs=3, type=int, default=[64, 128, 128])
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--num_classes", type=int, default=14)
+    parser.add_argument("--num_threads", type=int, default=8)
+    parser.add_argument("--num_batches", type=int, default=50)
+    parser.add_argument(
+        "--elastic",
+        action="store_true",
+        help="enable elastic deformation (d_lka_former_trainer_synapse turns it off)",
+    )
+    parser.add_argument(
+        "--cpu", action="store_true", help="augment on CPU even if a GPU is available"
+    )
+    args = parser.parse_args()
+
+    # the parameters of d_lka_former_trainer_synapse.setup_DA_params
+    params = deepcopy(default_3D_augmentation_params)
+    for axis in ("rotation_x", "rotation_y", "rotation_z"):
+        params[axis] = (-30.0 / 360 * 2.0 * np.pi, 30.0 / 360 * 2.0 * np.pi)
+    basic_generator_patch_size = get_patch_size(
+        args.patch_size,
+        params["rotation_x"],
+        params["rotation_y"],
+        params["rotation_z"],
+        params["scale_range"],
+    )
+    params["scale_range"] = (0.7, 1.4)
+    params["do_elastic"] = args.elastic
+    params["selected_seg_channels"] = [0]
+    params["num_threads"] = args.num_threads
+    params["num_cached_per_thread"] = 2
+    deep_supervision_scales = [[1, 1, 1], [0.5, 0.5, 0.5], [0.25, 0.25, 0.25]]
+    device = "cuda" if torch.cuda.is_available() and not args.cpu else "cpu"
+
+    print(
+        "patches of %s, cropped to %s, batch size %d"
+        % (str(list(basic_generator_patch_size)), str(args.patch_size), args.batch_size)
+    )
+    results = {}
+    for backend in ("batchgenerators", "torch"):
+        dl_tr = RandomPatchLoader(
+            basic_generator_patch_size, args.batch_size, args.num_classes
+        )
+        dl_val = RandomPatchLoader(args.patch_size, args.batch_size, args.num_classes)
+        kwargs = {
+            "deep_supervision_scales": deep_supervision_scales,
+            "pin_memory": device != "cpu",
+            "seeds_train": list(range(args.num_threads)),
+            "seeds_val": list(range(max(args.num_threads // 2, 1))),
+        }
+        if backend == "torch":
+            tr_gen, _ = get_torch_augmentation(
+                dl_tr, dl_val, args.patch_size, params, device=device, **kwargs
+            )
+        else:
+            tr_gen, _ = get_moreDA_augmentation(
+                dl_tr, dl_val, args.patch_size, params, **kwargs
+            )
+
+        # the workers need a moment to start
+        for _ in range(args.num_threads):
+            batch = next(tr_gen)
+        start = time()
+        foreground = []
+        for _ in range(args.num_batches):
+            batch = next(tr_gen)
+            target = batch["target"][0].to(device)
+            foreground.append((target > 0).float().mean().item())
+        elapsed = time() - start
+        results[backend] = args.num_batches / elapsed
+        print(
+            "%s: %.2f batches/s, data mean %.3f std %.3f, foreground fraction %.3f, target shapes %s"
+            % (
+                backend,
+                results[backend],
+                batch["data"].mean().item(),
+                batch["data"].std().item(),
+                np.mean(foreground),
+                str([tuple(t.shape) for t in batch["target"]]),
+            )
+        )
+        if backend == "torch":
+            print(
+                "time spent waiting for patches: %.2f s, augmenting: %.2f s"
+                % (tr_gen.timings["load"], tr_gen.timings["augment"])
+            )
+        if hasattr(tr_gen, "_finish"):
+            tr_gen._finish()
+    print(
+        "\nspeedup of the torch backend: %.2fx"
+        % (results["torch"] / results["batchgenerators"])
+    )
+
+
+if __name__ == "__main__":
+    main()
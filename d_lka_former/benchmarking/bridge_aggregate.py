@@ -0,0 +1,175 @@
+import argparse
+from functools import partial
+from time import time
+
+import numpy as np
+import torch
+from d_lka_former.benchmarking.checkpointing import kept_bytes
+from d_lka_former.benchmarking.fuse_for_inference import lhunet_synapse
+from d_lka_former.network_architecture.synapse.lhunet.bridge import BridgeModule
+from d_lka_former.network_architecture.synapse.main_model.models.main import (
+    GateChannelAttentionModule,
+    MultiScaleLKA3DModule,
+    SKAttentionModule,
+)
+from torch.nn import functional as F
+
+
+class ReferenceBridge(BridgeModule):
+    """
+    BridgeModule with the forward from before the shared pyramid: every level projects and resizes every skip at full
+    resolution into a zero initialized tensor
+    """
+
+    def forward(self, *skips):
+        def aggregate(out_shape):
+            agg = torch.zeros(out_shape).to(skips[0].device)
+            for skip in skips:
+                ps = self.projs[f"{skip.shape[1]}->{out_shape[1]}"](skip)
+                agg = agg + F.interpolate(ps, size=out_shape[2:])
+            return agg
+
+        last_x = None
+        outs = []
+        for i, x in enumerate(skips[::-1][: self.num_stages]):
+            _x = x.clone()
+            if i > 0:
+                x = x + self.ups[i - 1](last_x)
+            c_att = self.c_atts[i](_x) if self.use_c else 0
+            s_att = self.s_atts[i](x) if self.use_c else 0
+            m_att = self.m_atts[i](_x + aggregate(x.shape)) if self.use_m else 0
+            if self.use_weigths:
+                att = self.c_w[i] * c_att + self.s_w[i] * s_att + self.m_w[i] * m_att
+            else:
+                att = c_att + s_att + m_att
+            x = self.norms[i](att + x)
+            outs.append(x)
+            last_x = x.clone()
+        return outs[::-1]
+
+
+def bridge_synapse(reference=False):
+    """
+    the bridge of main_model.models.main.Model_Bridge for the skips of the Synapse LHUNet (with 4 instead of 8 groups
+    in the SKAttentionModules, 12 channels are not divisible by 8)
+    """
+    return (ReferenceBridge if reference else BridgeModule)(
+        feats=[12, 16, 32, 64],
+        c_attn_block=GateChannelAttentionModule,
+        s_attn_block=partial(SKAttentionModule, groups=4),
+        m_attn_block=MultiScaleLKA3DModule,
+        use_weigths=True,
+    )
+
+
+def synapse_skips(patch_size, batch_size, device):
+    """
+    cnn_skips + hyb_skips[:-1] of the Synapse LHUNet for a random batch
+    """
+    network = lhunet_synapse(patch_size).to(device).eval()
+    with torch.no_grad():
+        x = network.init(torch.randn(batch_size, 1, *patch_size, device=device))
+        x, cnn_skips = network.cnn_encoder(x)
+        _, hyb_skips = network.hyb_encoder(x)
+    return cnn_skips + hyb_skips[:-1]
+
+
+def timed(function, skips, repeats, train):
+    times, peaks = [], []
+    for _ in range(repeats + 1):
+        if skips[0].is_cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start = time()
+        if train:
+            sum(o.float().mean() for o in function(*skips)).backward()
+        else:
+            with torch.no_grad():
+                function(*skips)
+        if skips[0].is_cuda:
+            torch.cuda.synchronize()
+            peaks.append(torch.cuda.max_memory_allocated())
+        times.append(time() - start)
+    return np.median(times[1:]), max(peaks) if len(peaks) > 0 else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="lhunet BridgeModule with the shared multi-scale pyramid in _aggregate against the former "
+        "per-level aggregation: checks that outputs and gradients are the same and compares time and memory of "
+        "training steps and inference forward passes for the skips of the Synapse LHUNet"
+    )
+    parser.add_argument(
+        "--patch_size",
+        nargs=3,
+        type=int,
+        default=[32, 64, 64],
+        help="the trainer uses 64 128 128, must be divisible by 16 32 32",
+    )
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--no_gpu", action="store_true")
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() and not args.no_gpu else "cpu"
+    torch.manual_seed(0)
+    skips = synapse_skips(args.patch_size, args.batch_size, device)
+    print("skips: %s" % ", ".join(str(tuple(s.shape[1:])) for s in skips))
+
+    bridge = bridge_synapse().to(device).train()
+    # the attention weights start at 0, which would hide the attentions from the comparison
+    with torch.no_grad():
+        for w in (bridge.c_w, bridge.s_w, bridge.m_w):
+            w.uniform_(0.5, 1.5)
+    reference = bridge_synapse(reference=True).to(device).train()
+    reference.load_state_dict(bridge.state_dict())
+
+    skips = [s.requires_grad_() for s in skips]
+    results = {}
+    for name, module in (("reference", reference), ("pyramid", bridge)):
+        outputs = module(*skips)
+        sum(
+            (
+                o.float() * torch.linspace(-1, 1, o.numel(), device=device).view_as(o)
+            ).sum()
+            for o in outputs
+        ).backward()
+        results[name] = (
+            [o.detach() for o in outputs],
+            [p.grad.clone() for p in module.parameters() if p.grad is not None]
+            + [s.grad.clone() for s in skips],
+        )
+        for s in skips:
+            s.grad = None
+    for kind, i in (("outputs", 0), ("gradients", 1)):
+        error = max(
+            ((a - b).abs().max() / b.abs().max().clamp_min(1e-12)).item()
+            for a, b in zip(results["pyramid"][i], results["reference"][i])
+        )
+        print("largest relative difference of the %s: %.3g" % (kind, error))
+
+    print("\n%-10s %-10s %12s %12s %12s" % ("", "", "ms", "peak GB", "kept GB"))
+    for train in (True, False):
+        for name, module in (("reference", reference), ("pyramid", bridge)):
+            module.train(train)
+            seconds, peak = timed(
+                module,
+                skips if train else [s.detach() for s in skips],
+                args.repeats,
+                train,
+            )
+            kept = kept_bytes(module, *skips) if train else None
+            print(
+                "%-10s %-10s %12.1f %12s %12s"
+                % (
+                    "training" if train else "inference",
+                    name,
+                    seconds * 1000,
+                    "-" if peak is None else "%.3f" % (peak / 1024**3),
+                    "-" if kept is None else "%.3f" % (kept / 1024**3),
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
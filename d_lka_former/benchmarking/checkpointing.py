@@ -0,0 +1,128 @@
+import argparse
+from time import time
+
+import numpy as np
+import torch
+from d_lka_former.benchmarking.fuse_for_inference import (
+    lhunet_synapse,
+    randomize_batch_norms,
+)
+from d_lka_former.network_architecture.synapse.lhunet.checkpointing import (
+    plan_checkpointing,
+    set_checkpointing,
+)
+
+
+def kept_bytes(network, *inputs):
+    """
+    bytes of the activations the autograd graph of a training forward pass of inputs keeps for backward (parameters
+    not counted), the output of the pass and the gradients are discarded
+    """
+    parameters = {p.untyped_storage().data_ptr() for p in network.parameters()}
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in parameters:
+            storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        output = network(*inputs)
+    del output
+    return sum(storages.values())
+
+
+def training_step(network, x):
+    """
+    forward and backward of x, returns the seconds it took and the peak memory (CUDA only, None on the CPU)
+    """
+    network.zero_grad(set_to_none=True)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time()
+    network(x).float().mean().backward()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return time() - start, torch.cuda.max_memory_allocated() if x.is_cuda else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Memory/throughput tradeoff of activation checkpointing for the Synapse LHUNet: plans the "
+        "checkpointed stages for a memory budget, then measures every configuration the planner considered (bytes "
+        "kept for backward, peak memory on the GPU, time of a training step) and checks that gradients and batch norm "
+        "statistics are the same as without checkpointing"
+    )
+    parser.add_argument(
+        "--patch_size",
+        nargs=3,
+        type=int,
+        default=[32, 64, 64],
+        help="the trainer uses 64 128 128, must be divisible by 16 32 32",
+    )
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=0,
+        help="memory budget in GB. The default of 0 makes the planner go through all stages",
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--no_gpu", action="store_true")
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() and not args.no_gpu else "cpu"
+    torch.manual_seed(0)
+    network = lhunet_synapse(args.patch_size)
+    randomize_batch_norms(network, 0)
+    # dropout would make the gradients of the configurations differ
+    for m in network.modules():
+        if isinstance(m, torch.nn.modules.dropout._DropoutNd):
+            m.p = 0.0
+    network = network.to(device).train()
+    x = torch.randn(args.batch_size, 1, *args.patch_size, device=device)
+
+    stages, configurations = plan_checkpointing(network, x, args.budget * 1024**3)
+    print("planned for %.2f GB: %s\n" % (args.budget, stages))
+
+    state = {k: v.clone() for k, v in network.state_dict().items()}
+    reference = None
+    print(
+        "%-60s %12s %12s %12s %12s %8s"
+        % ("checkpointed", "est. GB", "kept GB", "peak GB", "step ms", "same")
+    )
+    for config, estimate, _ in configurations:
+        set_checkpointing(network, config)
+        network.load_state_dict(state)
+        kept = kept_bytes(network, x)
+
+        network.load_state_dict(state)
+        _, peak = training_step(network, x)
+        gradients = [p.grad.clone() for p in network.parameters()]
+        buffers = [b.clone() for b in network.buffers()]
+        if reference is None:
+            reference = gradients, buffers
+        same = all(
+            torch.equal(a, b)
+            for a, b in zip(gradients + buffers, reference[0] + reference[1])
+        )
+
+        times = [training_step(network, x)[0] for _ in range(args.repeats)]
+        print(
+            "%-60s %12.3f %12.3f %12s %12.1f %8s"
+            % (
+                ", ".join(config) if len(config) > 0 else "none",
+                estimate / 1024**3,
+                kept / 1024**3,
+                "-" if peak is None else "%.3f" % (peak / 1024**3),
+                np.median(times) * 1000,
+                same,
+            )
+        )
+    set_checkpointing(network, None)
+
+
+if __name__ == "__main__":
+    main()
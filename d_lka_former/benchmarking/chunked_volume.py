@@ -0,0 +1,93 @@
+import argparse
+import os
+from time import time
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import isfile, join
+from d_lka_former.training.dataloading.dataset_loading import (
+    chunk_dataset,
+    get_case_identifiers,
+)
+from d_lka_former.utilities.chunked_volume import ChunkedVolume
+
+
+def random_patch_slicer(shape, patch_size):
+    slicer = [slice(None)]
+    for s, p in zip(shape[1:], patch_size):
+        lb = np.random.randint(0, max(s - p, 0) + 1)
+        slicer.append(slice(lb, lb + p))
+    return tuple(slicer)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares disk footprint and random patch read latency of the npz, npy and chunked storage of a "
+        "preprocessed dataset (a folder like nnFormer_preprocessed/TaskXXX/nnFormerData_plans_v2.1_stage1). Files are "
+        "read through the page cache, so run it twice if you want warm numbers for everything"
+    )
+    parser.add_argument("folder")
+    parser.add_argument(
+        "--patch_size",
+        nargs=3,
+        type=int,
+        default=[90, 186, 186],
+        help="patch size the data loader reads. Default is the basic_generator_patch_size for a final patch size "
+        "of 64x128x128 with our rotation and scaling",
+    )
+    parser.add_argument("--num_patches", type=int, default=20, help="per case")
+    parser.add_argument("--num_cases", type=int, default=5)
+    parser.add_argument(
+        "--convert",
+        action="store_true",
+        help="create the .chunks files first (chunk_dataset) if they are missing",
+    )
+    parser.add_argument("--chunk_shape", nargs=3, type=int, default=[32, 64, 64])
+    args = parser.parse_args()
+
+    if args.convert:
+        start = time()
+        chunk_dataset(args.folder, chunk_shape=args.chunk_shape)
+        print("chunk_dataset took %.1f s" % (time() - start))
+
+    case_identifiers = sorted(get_case_identifiers(args.folder))
+    sizes = {"npz": 0, "npy": 0, "chunks": 0}
+    for c in case_identifiers:
+        for ext in sizes.keys():
+            if isfile(join(args.folder, c + "." + ext)):
+                sizes[ext] += os.path.getsize(join(args.folder, c + "." + ext))
+    print("%d cases" % len(case_identifiers))
+    for ext, size in sizes.items():
+        print("%-8s %10.2f GB" % (ext, size / 1024**3))
+
+    readers = {
+        "npz": lambda f: np.load(f + ".npz")["data"],
+        "npy": lambda f: np.load(f + ".npy", "r"),
+        "chunks": lambda f: ChunkedVolume(f + ".chunks"),
+    }
+    cases = case_identifiers[: args.num_cases]
+    print("\nms per patch of %s:" % str(args.patch_size))
+    for name, reader in readers.items():
+        if not all([isfile(join(args.folder, c + "." + name)) for c in cases]):
+            print("%-8s   missing" % name)
+            continue
+        np.random.seed(1234)
+        times = []
+        for c in cases:
+            for _ in range(args.num_patches):
+                start = time()
+                # this is what DataLoader3D does for every sample
+                case_all_data = reader(join(args.folder, c))
+                patch = np.copy(
+                    case_all_data[
+                        random_patch_slicer(case_all_data.shape, args.patch_size)
+                    ]
+                )
+                times.append(time() - start)
+        print(
+            "%-8s %8.1f ms (median %.1f ms)"
+            % (name, np.mean(times) * 1000, np.median(times) * 1000)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import argparse
+import pickle
+import tempfile
+from time import time
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import isfile, join
+from d_lka_former.training.dataloading.dataset_loading import get_case_identifiers
+from d_lka_former.utilities.class_locations import (
+    ClassLocations,
+    compute_class_locations,
+    save_class_locations,
+)
+
+
+def class_locations_per_class(
+    seg, all_classes, num_samples=10000, min_percent_coverage=0.01
+):
+    """
+    what the preprocessing did before compute_class_locations (one np.argwhere per class)
+    """
+    rndst = np.random.RandomState(1234)
+    class_locs = {}
+    for c in all_classes:
+        all_locs = np.argwhere(seg == c)
+        if len(all_locs) == 0:
+            class_locs[c] = []
+            continue
+        target_num_samples = min(num_samples, len(all_locs))
+        target_num_samples = max(
+            target_num_samples, int(np.ceil(len(all_locs) * min_percent_coverage))
+        )
+        class_locs[c] = all_locs[
+            rndst.choice(len(all_locs), target_num_samples, replace=False)
+        ]
+    return class_locs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares the per class np.argwhere of the old preprocessing with compute_class_locations on the "
+        "segmentations of a preprocessed dataset (both must give the same voxels) and the cost of getting the "
+        "locations in the data loader: unpickling the properties vs loading the .classlocs file"
+    )
+    parser.add_argument(
+        "folder", help="preprocessed data folder (with the npz/npy files)"
+    )
+    parser.add_argument("--num_cases", type=int, default=5)
+    args = parser.parse_args()
+
+    cases = sorted(get_case_identifiers(args.folder))[: args.num_cases]
+    times_old, times_new, times_pickle, times_index = [], [], [], []
+    for c in cases:
+        if isfile(join(args.folder, c + ".npy")):
+            seg = np.load(join(args.folder, c + ".npy"), "r")[-1]
+        else:
+            seg = np.load(join(args.folder, c + ".npz"))["data"][-1]
+        seg = np.array(seg)
+        all_classes = [int(i) for i in np.unique(seg) if i > 0]
+
+        start = time()
+        old = class_locations_per_class(seg, all_classes)
+        times_old.append(time() - start)
+        start = time()
+        locations = compute_class_locations(seg, all_classes)
+        times_new.append(time() - start)
+        new = ClassLocations(**locations)
+        for k in all_classes:
+            assert np.array_equal(np.array(old[k]).reshape(-1, 3), new.voxels(k)), (
+                c,
+                k,
+            )
+
+        # what the data loader pays to get the locations of one sample
+        properties = {"class_locations": old}
+        pickled = pickle.dumps(properties)
+        start = time()
+        pickle.loads(pickled)
+        times_pickle.append(time() - start)
+        index_file = join(tempfile.gettempdir(), "%s.classlocs" % c)
+        save_class_locations(index_file, locations)
+        start = time()
+        ClassLocations.load(index_file)
+        times_index.append(time() - start)
+        print(
+            "%s: argwhere per class %.2f s, one pass %.2f s, %d classes, identical samples"
+            % (c, times_old[-1], times_new[-1], len(all_classes))
+        )
+
+    print(
+        "\npreprocessing: %.2f s -> %.2f s per case (%.1fx)"
+        % (
+            np.mean(times_old),
+            np.mean(times_new),
+            np.mean(times_old) / np.mean(times_new),
+        )
+    )
+    print(
+        "data loader: unpickling %.2f ms -> loading the index %.2f ms per case"
+        % (np.mean(times_pickle) * 1000, np.mean(times_index) * 1000)
+    )
+
+
+if __name__ == "__main__":
+    main()
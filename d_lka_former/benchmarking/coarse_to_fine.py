@@ -0,0 +1,150 @@
+import argparse
+from time import time
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, save_json
+from d_lka_former.training.model_restore import load_model_and_checkpoint_files
+
+
+def dice_per_class(seg, gt, classes):
+    dice = []
+    for c in classes:
+        pred_c = seg == c
+        gt_c = gt == c
+        denominator = pred_c.sum() + gt_c.sum()
+        if denominator == 0:
+            dice.append(np.nan)
+        else:
+            dice.append(2 * np.logical_and(pred_c, gt_c).sum() / denominator)
+    return dice
+
+
+def timed_prediction(trainer, data, coarse_to_fine, do_mirroring):
+    trainer.inference_coarse_to_fine = coarse_to_fine
+    if trainer.network.get_device() != "cpu":
+        torch.cuda.synchronize()
+    start = time()
+    seg = trainer.predict_preprocessed_data_return_seg_and_softmax(
+        data,
+        do_mirroring=do_mirroring,
+        mirror_axes=trainer.data_aug_params["mirror_axes"],
+        use_sliding_window=True,
+        step_size=0.5,
+        use_gaussian=True,
+        verbose=False,
+        mixed_precision=trainer.fp16,
+    )[0]
+    if trainer.network.get_device() != "cpu":
+        torch.cuda.synchronize()
+    return seg, time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Latency/accuracy report of coarse-to-fine inference (predict_3D_coarse_to_fine) against the "
+        "regular full resolution sliding window on the validation cases of a fold. Dice is computed in the "
+        "preprocessed space against the reference segmentation stored with the preprocessed data"
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        required=True,
+        help="model output folder (the one containing the fold_X subfolders)",
+    )
+    parser.add_argument("-f", "--fold", type=int, default=0)
+    parser.add_argument("-chk", "--checkpoint", default="model_final_checkpoint")
+    parser.add_argument("--coarse_scale", type=float, nargs="+", default=[0.5])
+    parser.add_argument("--roi_margin", type=int, nargs=3, default=[8, 16, 16])
+    parser.add_argument("--mirror", action="store_true", help="enable mirroring TTA")
+    parser.add_argument(
+        "-o",
+        "--output_file",
+        default=None,
+        help="json file for the per case results. Default: coarse_to_fine.json in the fold folder",
+    )
+    args = parser.parse_args()
+
+    trainer, params = load_model_and_checkpoint_files(
+        args.model, [args.fold], checkpoint_name=args.checkpoint
+    )
+    trainer.load_checkpoint_ram(params[0], False)
+    trainer.network.do_ds = False
+    trainer.inference_coarse_scale = (
+        args.coarse_scale[0]
+        if len(args.coarse_scale) == 1
+        else tuple(args.coarse_scale)
+    )
+    trainer.inference_roi_margin = tuple(args.roi_margin)
+    trainer.folder_with_preprocessed_data = join(
+        trainer.dataset_directory,
+        trainer.plans["data_identifier"] + "_stage%d" % trainer.stage,
+    )
+    trainer.load_dataset()
+    trainer.do_split()
+
+    classes = list(range(1, trainer.num_classes))
+    results = []
+    for k in trainer.dataset_val.keys():
+        data = np.load(trainer.dataset[k]["data_file"])["data"]
+        data[-1][data[-1] == -1] = 0
+
+        seg_full, time_full = timed_prediction(trainer, data[:-1], False, args.mirror)
+        seg_c2f, time_c2f = timed_prediction(trainer, data[:-1], True, args.mirror)
+
+        results.append(
+            {
+                "case": k,
+                "shape": list(data.shape[1:]),
+                "time_full": time_full,
+                "time_coarse_to_fine": time_c2f,
+                "dice_full": dice_per_class(seg_full, data[-1], classes),
+                "dice_coarse_to_fine": dice_per_class(seg_c2f, data[-1], classes),
+                "agreement": float(np.mean(seg_full == seg_c2f)),
+            }
+        )
+        print(
+            "%s: full %.2f s, coarse-to-fine %.2f s, mean Dice %.4f -> %.4f"
+            % (
+                k,
+                time_full,
+                time_c2f,
+                np.nanmean(results[-1]["dice_full"]),
+                np.nanmean(results[-1]["dice_coarse_to_fine"]),
+            )
+        )
+
+    dice_full = np.nanmean([r["dice_full"] for r in results], 0)
+    dice_c2f = np.nanmean([r["dice_coarse_to_fine"] for r in results], 0)
+    time_full = np.sum([r["time_full"] for r in results])
+    time_c2f = np.sum([r["time_coarse_to_fine"] for r in results])
+
+    print("\n%-8s %10s %15s" % ("class", "full", "coarse-to-fine"))
+    for c, d_full, d_c2f in zip(classes, dice_full, dice_c2f):
+        print("%-8d %10.4f %15.4f" % (c, d_full, d_c2f))
+    print("%-8s %10.4f %15.4f" % ("mean", np.mean(dice_full), np.mean(dice_c2f)))
+    print(
+        "\ntotal time: full %.1f s, coarse-to-fine %.1f s (%.2fx)"
+        % (time_full, time_c2f, time_full / time_c2f)
+    )
+
+    output_file = args.output_file
+    if output_file is None:
+        output_file = join(trainer.output_folder, "coarse_to_fine.json")
+    save_json(
+        {
+            "coarse_scale": args.coarse_scale,
+            "roi_margin": args.roi_margin,
+            "mirror": args.mirror,
+            "cases": results,
+            "mean_dice_full": list(dice_full),
+            "mean_dice_coarse_to_fine": list(dice_c2f),
+            "total_time_full": time_full,
+            "total_time_coarse_to_fine": time_c2f,
+        },
+        output_file,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import os
+import shutil
+import tempfile
+from time import time
+
+import numpy as np
+import SimpleITK as sitk
+from batchgenerators.utilities.file_and_folder_operations import load_json
+from d_lka_former.benchmarking.resampling import blocky_labels
+from d_lka_former.evaluation.evaluator import aggregate_scores
+from d_lka_former.postprocessing.connected_components import (
+    determine_postprocessing,
+)
+
+
+def write_cases(folder, shape, spacing, num_classes, num_cases, num_islands):
+    """
+    ground truth and raw predictions (with false positive islands and, for class 1, a second object that is also in
+    the ground truth) like validate leaves them for determine_postprocessing
+    """
+    raw_folder = os.path.join(folder, "validation_raw")
+    gt_folder = os.path.join(folder, "gt_niftis")
+    os.makedirs(raw_folder)
+    os.makedirs(gt_folder)
+    pred_gt_tuples = []
+    for case in range(num_cases):
+        gt = blocky_labels(shape, num_classes, case)[0].astype(np.uint8)
+        gt[:4, :8, :8] = 1
+        prediction = np.roll(gt, 1, axis=1)
+        rs = np.random.RandomState(case)
+        for _ in range(num_islands):
+            corner = [rs.randint(0, s - 3) for s in shape]
+            size = rs.randint(1, 4, 3)
+            prediction[tuple(slice(c, c + s) for c, s in zip(corner, size))] = (
+                rs.randint(1, num_classes)
+            )
+        for seg, f in ((gt, gt_folder), (prediction, raw_folder)):
+            image = sitk.GetImageFromArray(seg)
+            image.SetSpacing(spacing[::-1])
+            sitk.WriteImage(image, os.path.join(f, "case_%03d.nii.gz" % case))
+        pred_gt_tuples.append(
+            [
+                os.path.join(raw_folder, "case_%03d.nii.gz" % case),
+                os.path.join(gt_folder, "case_%03d.nii.gz" % case),
+            ]
+        )
+    aggregate_scores(
+        pred_gt_tuples,
+        labels=list(range(num_classes)),
+        json_output_file=os.path.join(raw_folder, "summary.json"),
+        num_threads=4,
+    )
+    return gt_folder
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs determine_postprocessing on synthetic validation predictions with the temporary nifti "
+        "folders and with in_memory=True and checks that postprocessing.json, the final predictions and their "
+        "summary.json are the same"
+    )
+    parser.add_argument("--shape", nargs=3, type=int, default=[100, 256, 256])
+    parser.add_argument("--spacing", nargs=3, type=float, default=[3.0, 1.52, 1.52])
+    parser.add_argument("--num_classes", type=int, default=9)
+    parser.add_argument("--num_cases", type=int, default=6)
+    parser.add_argument("--num_islands", type=int, default=50)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--advanced_postprocessing", action="store_true")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        gt_folder = write_cases(
+            folder,
+            args.shape,
+            args.spacing,
+            args.num_classes,
+            args.num_cases,
+            args.num_islands,
+        )
+        times = {}
+        for in_memory in (False, True):
+            start = time()
+            determine_postprocessing(
+                folder,
+                gt_folder,
+                final_subf_name="final_%s" % in_memory,
+                processes=args.processes,
+                advanced_postprocessing=args.advanced_postprocessing,
+                pp_filename="postprocessing_%s.json" % in_memory,
+                in_memory=in_memory,
+            )
+            times[in_memory] = time() - start
+
+        for f in ("postprocessing_%s.json", "final_%s/summary.json"):
+            old = load_json(os.path.join(folder, f % False))
+            new = load_json(os.path.join(folder, f % True))
+            if "results" in old:
+                for case_old, case_new in zip(
+                    old["results"]["all"], new["results"]["all"]
+                ):
+                    case_old.pop("test"), case_new.pop("test")
+                old, new = old["results"], new["results"]
+            else:
+                old.pop("validation_final"), new.pop("validation_final")
+            assert old == new, (f, old, new)
+        for case in range(args.num_cases):
+            segs = [
+                sitk.GetArrayFromImage(
+                    sitk.ReadImage(
+                        os.path.join(
+                            folder, "final_%s" % in_memory, "case_%03d.nii.gz" % case
+                        )
+                    )
+                )
+                for in_memory in (False, True)
+            ]
+            assert np.array_equal(*segs)
+        print(
+            "\ntemporary niftis %.1f s, in memory %.1f s (%.1fx), identical results"
+            % (times[False], times[True], times[False] / times[True])
+        )
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
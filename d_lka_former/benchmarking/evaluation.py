@@ -0,0 +1,83 @@
+import argparse
+from collections import OrderedDict
+from time import time
+
+import numpy as np
+from d_lka_former.benchmarking.resampling import blocky_labels
+from d_lka_former.evaluation.evaluator import Evaluator
+from d_lka_former.evaluation.metrics import ALL_METRICS, ConfusionMatrix
+
+
+def evaluate_per_label(test, reference, labels, metrics, **metric_kwargs):
+    """
+    what Evaluator.evaluate did before label_confusion_counts: full volume masks and a ConfusionMatrix per label
+    """
+    result = OrderedDict()
+    for l in labels:
+        confusion_matrix = ConfusionMatrix(test == l, reference == l)
+        result[str(l)] = OrderedDict(
+            (m, ALL_METRICS[m](confusion_matrix=confusion_matrix, **metric_kwargs))
+            for m in metrics
+        )
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares Evaluator.evaluate with the per label evaluation it replaced on synthetic Synapse sized "
+        "segmentations (the metrics must be identical) and reports the time per case"
+    )
+    parser.add_argument("--shape", nargs=3, type=int, default=[148, 512, 512])
+    parser.add_argument("--num_classes", type=int, default=14)
+    parser.add_argument("--num_cases", type=int, default=3)
+    parser.add_argument(
+        "--advanced",
+        action="store_true",
+        help="also compute Hausdorff Distance 95 (slow, the old way uses the full volume masks)",
+    )
+    args = parser.parse_args()
+
+    labels = list(range(1, args.num_classes))
+    metrics = sorted(Evaluator.default_metrics)
+    if args.advanced:
+        metrics.append("Hausdorff Distance 95")
+    times_old, times_new = [], []
+    for case in range(args.num_cases):
+        reference = blocky_labels(args.shape, args.num_classes, case)[0].astype(
+            np.uint8
+        )
+        # the prediction: the reference with some labels moved by a few voxels and some noise
+        test = np.roll(reference, (case % 3 + 1, 2), axis=(1, 2))
+        noise = np.random.RandomState(case).rand(*args.shape) < 0.001
+        test[noise] = np.random.RandomState(case).randint(
+            0, args.num_classes, noise.sum()
+        )
+
+        start = time()
+        old = evaluate_per_label(test, reference, labels, metrics)
+        times_old.append(time() - start)
+        start = time()
+        evaluator = Evaluator(test, reference, labels, metrics=metrics)
+        new = evaluator.evaluate()
+        times_new.append(time() - start)
+
+        for l in labels:
+            for m in metrics:
+                a, b = old[str(l)][m], new[str(l)][m]
+                assert (np.isnan(a) and np.isnan(b)) or np.isclose(a, b), (l, m, a, b)
+        print(
+            "case %d: per label %.2f s, one pass %.2f s, identical metrics"
+            % (case, times_old[-1], times_new[-1])
+        )
+    print(
+        "\n%.2f s -> %.2f s per case (%.1fx)"
+        % (
+            np.mean(times_old),
+            np.mean(times_new),
+            np.mean(times_old) / np.mean(times_new),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
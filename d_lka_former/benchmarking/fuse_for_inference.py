@@ -0,0 +1,132 @@
+import argparse
+from time import time
+
+import numpy as np
+import torch
+from d_lka_former.network_architecture.synapse.lhunet.fusion import fuse_for_inference
+from d_lka_former.network_architecture.synapse.lhunet.models.v8 import LHUNet
+from torch import nn
+
+
+def lhunet_synapse(patch_size, num_classes=14):
+    """
+    LHUNet as built by d_lka_former_trainer_synapse.initialize_network, for patches of patch_size
+    """
+    return LHUNet(
+        spatial_shapes=patch_size,
+        in_channels=1,
+        out_channels=num_classes,
+        do_ds=False,
+        cnn_kernel_sizes=[3, 3],
+        cnn_features=[12, 16],
+        cnn_strides=[[1, 2, 2], 2],
+        cnn_maxpools=[True, True],
+        cnn_dropouts=0.0,
+        cnn_blocks="nn",
+        hyb_kernel_sizes=[3, 3, 3],
+        hyb_features=[32, 64, 128],
+        hyb_strides=[2, 2, 2],
+        hyb_maxpools=[True, True, True],
+        hyb_cnn_dropouts=0.0,
+        hyb_tf_proj_sizes=[64, 32, 0],
+        hyb_tf_repeats=[1, 1, 1],
+        hyb_tf_num_heads=[8, 8, 16],
+        hyb_tf_dropouts=0.1,
+        hyb_cnn_blocks="nnn",
+        hyb_vit_blocks="SSC",
+        hyb_skip_mode="cat",
+        hyb_arch_mode="residual",
+        hyb_res_mode="sum",
+        dec_hyb_tcv_kernel_sizes=[5, 5, 5],
+        dec_cnn_tcv_kernel_sizes=[5, 7],
+        dec_hyb_arch_mode="collective",
+    )
+
+
+def randomize_batch_norms(network, seed):
+    """
+    freshly initialized batch norms are identities in eval mode, which would make folding them trivial
+    """
+    rs = torch.Generator().manual_seed(seed)
+    for m in network.modules():
+        if isinstance(m, nn.modules.batchnorm._BatchNorm):
+            m.running_mean.copy_(torch.randn(m.num_features, generator=rs) * 0.5)
+            m.running_var.copy_(torch.rand(m.num_features, generator=rs) + 0.5)
+            m.weight.data.copy_(torch.rand(m.num_features, generator=rs) + 0.5)
+            m.bias.data.copy_(torch.randn(m.num_features, generator=rs) * 0.1)
+
+
+def time_forward(network, x, repeats):
+    with torch.no_grad():
+        network(x)
+        times = []
+        for _ in range(repeats):
+            if x.is_cuda:
+                torch.cuda.synchronize()
+            start = time()
+            network(x)
+            if x.is_cuda:
+                torch.cuda.synchronize()
+            times.append(time() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Folds the Synapse LHUNet with fuse_for_inference, checks that the outputs stay the same and "
+        "compares the time of a forward pass"
+    )
+    parser.add_argument(
+        "--patch_size",
+        nargs=3,
+        type=int,
+        default=[32, 64, 64],
+        help="the trainer uses 64 128 128, must be divisible by 16 32 32",
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--no_gpu", action="store_true")
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() and not args.no_gpu else "cpu"
+    torch.manual_seed(0)
+    network = lhunet_synapse(args.patch_size)
+    randomize_batch_norms(network, 0)
+    network = network.to(device).eval()
+    x = torch.randn(1, 1, *args.patch_size, device=device)
+
+    start = time()
+    fused = fuse_for_inference(network, example_input=x)
+    print("fused (and checked) in %.2f s" % (time() - start))
+    num_norms = [
+        sum(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in n.modules())
+        for n in (network, fused)
+    ]
+    num_convs = [
+        sum(isinstance(m, nn.Conv3d) for m in n.modules()) for n in (network, fused)
+    ]
+    print(
+        "batch norms %d -> %d, Conv3d %d -> %d" % (*num_norms, *num_convs),
+    )
+
+    with torch.no_grad():
+        expected = network(x)
+        output = fused(x)
+    print(
+        "max abs difference %.3g (largest output %.3g)"
+        % ((expected - output).abs().max().item(), expected.abs().max().item())
+    )
+    original_times = time_forward(network, x, args.repeats)
+    fused_times = time_forward(fused, x, args.repeats)
+    print(
+        "%s forward: %.1f ms -> %.1f ms (%.2fx)"
+        % (
+            device,
+            np.median(original_times) * 1000,
+            np.median(fused_times) * 1000,
+            np.median(original_times) / np.median(fused_times),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
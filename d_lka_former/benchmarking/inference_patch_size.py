@@ -0,0 +1,142 @@
+import argparse
+from time import time
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, save_json
+from d_lka_former.benchmarking.coarse_to_fine import dice_per_class
+from d_lka_former.training.model_restore import load_model_and_checkpoint_files
+
+
+def timed_prediction(trainer, data, patch_size, token_projection, do_mirroring):
+    trainer.inference_patch_size = patch_size
+    trainer.inference_token_projection = token_projection
+    if trainer.network.get_device() != "cpu":
+        torch.cuda.synchronize()
+    start = time()
+    seg = trainer.predict_preprocessed_data_return_seg_and_softmax(
+        data,
+        do_mirroring=do_mirroring,
+        mirror_axes=trainer.data_aug_params["mirror_axes"],
+        use_sliding_window=True,
+        step_size=0.5,
+        use_gaussian=True,
+        verbose=False,
+        mixed_precision=trainer.fp16,
+    )[0]
+    if trainer.network.get_device() != "cpu":
+        torch.cuda.synchronize()
+    return seg, time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Accuracy/latency of sliding window prediction with larger tiles than the training patch size "
+        "(LHUNet with token_grid.enable_any_patch_size, both token projections) against tiles of the training patch "
+        "size on the validation cases of a fold. Dice is computed in the preprocessed space against the reference "
+        "segmentation stored with the preprocessed data"
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        required=True,
+        help="model output folder (the one containing the fold_X subfolders)",
+    )
+    parser.add_argument("-f", "--fold", type=int, default=0)
+    parser.add_argument("-chk", "--checkpoint", default="model_final_checkpoint")
+    parser.add_argument(
+        "--patch_size",
+        type=int,
+        nargs=3,
+        default=[128, 256, 256],
+        help="tile size to compare, must be divisible by 16 32 32 for the Synapse LHUNet",
+    )
+    parser.add_argument("--mirror", action="store_true", help="enable mirroring TTA")
+    parser.add_argument(
+        "-o",
+        "--output_file",
+        default=None,
+        help="json file for the per case results. Default: inference_patch_size.json in the fold folder",
+    )
+    args = parser.parse_args()
+
+    trainer, params = load_model_and_checkpoint_files(
+        args.model, [args.fold], checkpoint_name=args.checkpoint
+    )
+    trainer.load_checkpoint_ram(params[0], False)
+    trainer.network.do_ds = False
+    trainer.folder_with_preprocessed_data = join(
+        trainer.dataset_directory,
+        trainer.plans["data_identifier"] + "_stage%d" % trainer.stage,
+    )
+    trainer.load_dataset()
+    trainer.do_split()
+
+    variants = [
+        ("training", None, "pool"),
+        ("pool", args.patch_size, "pool"),
+        ("interpolate", args.patch_size, "interpolate"),
+    ]
+    classes = list(range(1, trainer.num_classes))
+    results = []
+    for k in trainer.dataset_val.keys():
+        data = np.load(trainer.dataset[k]["data_file"])["data"]
+        data[-1][data[-1] == -1] = 0
+
+        result = {"case": k, "shape": list(data.shape[1:])}
+        segs = {}
+        for name, patch_size, token_projection in variants:
+            segs[name], result["time_" + name] = timed_prediction(
+                trainer, data[:-1], patch_size, token_projection, args.mirror
+            )
+            result["dice_" + name] = dice_per_class(segs[name], data[-1], classes)
+            result["agreement_" + name] = float(np.mean(segs[name] == segs["training"]))
+        results.append(result)
+        print(
+            "%s: " % k
+            + ", ".join(
+                "%s %.2f s Dice %.4f"
+                % (name, result["time_" + name], np.nanmean(result["dice_" + name]))
+                for name, _, _ in variants
+            )
+        )
+
+    print("\n%-8s" % "class" + "".join("%13s" % name for name, _, _ in variants))
+    mean_dice = {
+        name: np.nanmean([r["dice_" + name] for r in results], 0)
+        for name, _, _ in variants
+    }
+    for i, c in enumerate(classes):
+        print(
+            "%-8d" % c
+            + "".join("%13.4f" % mean_dice[name][i] for name, _, _ in variants)
+        )
+    print(
+        "%-8s" % "mean"
+        + "".join("%13.4f" % np.mean(mean_dice[name]) for name, _, _ in variants)
+    )
+    total_time = {
+        name: np.sum([r["time_" + name] for r in results]) for name, _, _ in variants
+    }
+    print(
+        "\ntotal time: "
+        + ", ".join("%s %.1f s" % (name, total_time[name]) for name, _, _ in variants)
+    )
+
+    output_file = args.output_file
+    if output_file is None:
+        output_file = join(trainer.output_folder, "inference_patch_size.json")
+    save_json(
+        {
+            "patch_size": args.patch_size,
+            "mirror": args.mirror,
+            "cases": results,
+            "mean_dice": {name: list(d) for name, d in mean_dice.items()},
+            "total_time": total_time,
+        },
+        output_file,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import argparse
+import multiprocessing
+import resource
+from time import time
+
+import numpy as np
+import torch
+from d_lka_former.training.model_restore import load_model_and_checkpoint_files
+
+
+def measure_peak_rss(model, fold, checkpoint, shape, use_gpu, mirror, predict_kwargs):
+    """
+    Runs one sliding window prediction and returns (time, peak RSS before the prediction, peak RSS of the prediction),
+    RSS in MB. Must run in a fresh process because the peak RSS of a process can only go up
+    """
+    trainer, params = load_model_and_checkpoint_files(
+        model, [fold], checkpoint_name=checkpoint
+    )
+    trainer.load_checkpoint_ram(params[0], False)
+    network = trainer.network
+    network.do_ds = False
+    network.eval()
+    if use_gpu:
+        network.cuda()
+    else:
+        network.cpu()
+    data = np.random.random(shape).astype(np.float32)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    start = time()
+    network.predict_3D(
+        data,
+        do_mirroring=mirror,
+        mirror_axes=trainer.data_aug_params["mirror_axes"],
+        use_sliding_window=True,
+        step_size=0.5,
+        patch_size=trainer.patch_size,
+        use_gaussian=True,
+        all_in_gpu=False,
+        verbose=False,
+        mixed_precision=use_gpu,
+        **predict_kwargs
+    )
+    if use_gpu:
+        torch.cuda.synchronize()
+    end = time()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return end - start, rss_before, rss_after
+
+
+def check_float16(model, fold, checkpoint, num_channels, use_gpu, mirror):
+    """
+    Predicts a small random volume (1.5 patches along each axis) with float32 and with float16 accumulation and
+    returns (NaN voxels, segmentation voxels that differ although the float32 top two probabilities are more than 0.01
+    apart, largest probability difference) for the float16 result. The first two must be 0
+    """
+    trainer, params = load_model_and_checkpoint_files(
+        model, [fold], checkpoint_name=checkpoint
+    )
+    trainer.load_checkpoint_ram(params[0], False)
+    network = trainer.network
+    network.do_ds = False
+    network.eval()
+    if use_gpu:
+        network.cuda()
+    else:
+        network.cpu()
+    shape = [num_channels] + [int(i * 1.5) for i in trainer.patch_size]
+    data = np.random.RandomState(0).random(shape).astype(np.float32)
+
+    results = {}
+    for dtype in (np.float32, np.float16):
+        for return_probabilities in (True, False):
+            results[dtype, return_probabilities] = network.predict_3D(
+                data,
+                do_mirroring=mirror,
+                mirror_axes=trainer.data_aug_params["mirror_axes"],
+                use_sliding_window=True,
+                step_size=0.5,
+                patch_size=trainer.patch_size,
+                use_gaussian=True,
+                all_in_gpu=False,
+                verbose=False,
+                mixed_precision=use_gpu,
+                accumulation_dtype=dtype,
+                return_probabilities=return_probabilities,
+            )
+    reference_seg, reference = results[np.float32, True]
+    top_two = np.sort(reference, 0)[-2:]
+    decided = top_two[1] - top_two[0] > 0.01
+    probabilities = results[np.float16, True][1].astype(np.float32)
+    num_nan = int(np.isnan(probabilities).sum())
+    num_different = sum(
+        int(np.sum((results[np.float16, r][0] != reference_seg) & decided))
+        for r in (True, False)
+    )
+    return num_nan, num_different, float(np.nanmax(np.abs(probabilities - reference)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the peak host memory (RSS) of sliding window prediction (predict_3D with "
+        "all_in_gpu=False) for different accumulation settings. Each setting runs in its own process"
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        required=True,
+        help="model output folder (the one containing the fold_X subfolders)",
+    )
+    parser.add_argument("-f", "--fold", type=int, default=0)
+    parser.add_argument("-chk", "--checkpoint", default="model_final_checkpoint")
+    parser.add_argument(
+        "--shape",
+        nargs=4,
+        type=int,
+        default=[1, 148, 512, 512],
+        help="shape (c, x, y, z) of the random input volume. Default is roughly a preprocessed Synapse CT",
+    )
+    parser.add_argument("--mirror", action="store_true", help="enable mirroring TTA")
+    parser.add_argument("--no_gpu", action="store_true")
+    parser.add_argument(
+        "--default_only",
+        action="store_true",
+        help="only run predict_3D with default arguments. Use this to get the reference numbers on an older "
+        "version of the code",
+    )
+    args = parser.parse_args()
+
+    configurations = [("default", {})]
+    if not args.default_only:
+        configurations += [
+            ("float16 accumulation", {"accumulation_dtype": np.float16}),
+            ("argmax only", {"return_probabilities": False}),
+            (
+                "argmax only, float16",
+                {"return_probabilities": False, "accumulation_dtype": np.float16},
+            ),
+        ]
+    use_gpu = not args.no_gpu and torch.cuda.is_available()
+
+    # spawn so that the children do not inherit (and count) anything from this process
+    ctx = multiprocessing.get_context("spawn")
+    if not args.default_only:
+        with ctx.Pool(1) as pool:
+            num_nan, num_different, max_difference = pool.apply(
+                check_float16,
+                (
+                    args.model,
+                    args.fold,
+                    args.checkpoint,
+                    args.shape[0],
+                    use_gpu,
+                    args.mirror,
+                ),
+            )
+        print(
+            "float16 vs float32 accumulation: %d NaN voxels, %d segmentation voxels differ (not counting near ties), "
+            "largest probability difference %.3g"
+            % (num_nan, num_different, max_difference)
+        )
+        if num_nan > 0 or num_different > 0:
+            raise RuntimeError("float16 accumulation does not match float32")
+
+    results = []
+    for name, kwargs in configurations:
+        with ctx.Pool(1) as pool:
+            t, rss_before, rss_after = pool.apply(
+                measure_peak_rss,
+                (
+                    args.model,
+                    args.fold,
+                    args.checkpoint,
+                    args.shape,
+                    use_gpu,
+                    args.mirror,
+                    kwargs,
+                ),
+            )
+        results.append((name, t, rss_before, rss_after))
+        print(
+            "%s: %.2f s, peak RSS %.0f MB (%.0f MB for the prediction)"
+            % (name, t, rss_after, rss_after - rss_before)
+        )
+
+    print("\ninput shape %s, %s" % (str(args.shape), "GPU" if use_gpu else "CPU"))
+    print("%-24s %8s %14s %16s" % ("", "time", "peak RSS", "prediction RSS"))
+    for name, t, rss_before, rss_after in results:
+        print(
+            "%-24s %6.2f s %11.0f MB %13.0f MB"
+            % (name, t, rss_after, rss_after - rss_before)
+        )
+
+
+if __name__ == "__main__":
+    main()
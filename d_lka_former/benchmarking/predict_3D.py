@@ -0,0 +1,138 @@
+import argparse
+from time import time
+
+import numpy as np
+import torch
+from d_lka_former.network_architecture.neural_network import cpu_supports_bfloat16
+from d_lka_former.training.model_restore import load_model_and_checkpoint_files
+
+
+def time_predict_3D(network, data, patch_size, repeats=1, **predict_kwargs):
+    """
+    Returns the wall time (in seconds) of each of the repeats of network.predict_3D(data, ...). Before timing we run one
+    patch through the network so that cudnn/oneDNN can pick their kernels
+    """
+    network.eval()
+    network.predict_3D(
+        np.zeros([data.shape[0]] + list(patch_size), dtype=np.float32),
+        do_mirroring=False,
+        use_sliding_window=True,
+        patch_size=patch_size,
+        verbose=False,
+        **{k: v for k, v in predict_kwargs.items() if k != "do_mirroring"}
+    )
+    times = []
+    for _ in range(repeats):
+        if network.get_device() != "cpu":
+            torch.cuda.synchronize()
+        start = time()
+        network.predict_3D(
+            data,
+            use_sliding_window=True,
+            patch_size=patch_size,
+            verbose=False,
+            **predict_kwargs
+        )
+        if network.get_device() != "cpu":
+            torch.cuda.synchronize()
+        times.append(time() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares the wall time of sliding window prediction (predict_3D) on GPU and CPU for a volume of "
+        "Synapse size"
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        required=True,
+        help="model output folder (the one containing the fold_X subfolders)",
+    )
+    parser.add_argument("-f", "--fold", type=int, default=0)
+    parser.add_argument("-chk", "--checkpoint", default="model_final_checkpoint")
+    parser.add_argument(
+        "--shape",
+        nargs=4,
+        type=int,
+        default=[1, 148, 512, 512],
+        help="shape (c, x, y, z) of the random input volume. Default is roughly a preprocessed Synapse CT",
+    )
+    parser.add_argument("--step_size", type=float, default=0.5)
+    parser.add_argument("--mirror", action="store_true", help="enable mirroring TTA")
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=None,
+        help="intra-op threads for the CPU runs. Default: torch default",
+    )
+    parser.add_argument("--no_gpu", action="store_true")
+    parser.add_argument("--no_cpu", action="store_true")
+    args = parser.parse_args()
+
+    trainer, params = load_model_and_checkpoint_files(
+        args.model, [args.fold], checkpoint_name=args.checkpoint
+    )
+    trainer.load_checkpoint_ram(params[0], False)
+    network = trainer.network
+    network.do_ds = False
+    patch_size = trainer.patch_size
+    mirror_axes = trainer.data_aug_params["mirror_axes"] if args.mirror else ()
+
+    data = np.random.random(args.shape).astype(np.float32)
+
+    configurations = []
+    if not args.no_gpu and torch.cuda.is_available():
+        configurations.append(("gpu", "fp16 autocast", {"mixed_precision": True}))
+        configurations.append(("gpu", "fp32", {"mixed_precision": False}))
+    if not args.no_cpu:
+        configurations.append(("cpu", "fp32", {"mixed_precision": False}))
+        configurations.append(
+            (
+                "cpu",
+                "fp32 channels_last",
+                {"mixed_precision": False, "channels_last": True},
+            )
+        )
+        if cpu_supports_bfloat16():
+            configurations.append(
+                (
+                    "cpu",
+                    "bf16 channels_last",
+                    {"mixed_precision": True, "channels_last": True},
+                )
+            )
+        else:
+            print("CPU does not support bfloat16 natively, skipping bf16 runs")
+
+    results = []
+    for device, name, kwargs in configurations:
+        if device == "gpu":
+            network.cuda()
+        else:
+            network.cpu()
+            kwargs["num_threads"] = args.num_threads
+        times = time_predict_3D(
+            network,
+            data,
+            patch_size,
+            args.repeats,
+            do_mirroring=args.mirror,
+            mirror_axes=mirror_axes,
+            step_size=args.step_size,
+            use_gaussian=True,
+            **kwargs
+        )
+        results.append((device, name, np.mean(times)))
+        print("%s %s: %.2f s" % (device, name, np.mean(times)))
+
+    print("\ninput shape %s, patch size %s" % (str(args.shape), str(patch_size)))
+    reference = results[0][2]
+    for device, name, t in results:
+        print("%-4s %-20s %8.2f s  %6.2fx" % (device, name, t, t / reference))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import argparse
+from time import time
+
+import numpy as np
+from d_lka_former.preprocessing.preprocessing import (
+    resample_data_or_seg,
+    resample_data_or_seg_slicewise,
+)
+from scipy.ndimage import gaussian_filter, zoom
+
+
+def smooth_volume(shape, num_channels, seed):
+    """
+    random smooth intensities, roughly like a CT after normalization
+    """
+    rs = np.random.RandomState(seed)
+    coarse = rs.randn(num_channels, *[max(s // 8, 2) for s in shape])
+    return np.stack(
+        [zoom(c, [s / cs for s, cs in zip(shape, c.shape)], order=1) for c in coarse]
+    ).astype(np.float32)
+
+
+def blocky_labels(shape, num_classes, seed):
+    """
+    segmentation with num_classes labels (0 is background): one irregular blob per label, roughly organ sized
+    """
+    rs = np.random.RandomState(seed)
+    shape = np.array(shape)
+    seg = np.zeros(shape, dtype=np.float32)
+    for c in range(1, num_classes):
+        center = rs.uniform(0.2, 0.8, 3) * shape
+        radius = rs.uniform(0.03, 0.15, 3) * shape
+        box = tuple(
+            slice(int(max(m - r - 1, 0)), int(min(m + r + 2, s)))
+            for m, r, s in zip(center, radius, shape)
+        )
+        distance = sum(
+            ((g - m) / r) ** 2 for g, m, r in zip(np.ogrid[box], center, radius)
+        )
+        noise = zoom(rs.rand(4, 4, 4), np.array(distance.shape) / 4, order=1)
+        blob = seg[box]
+        blob[distance + 0.5 * noise < 1] = c
+    return seg[None]
+
+
+def softmax(logits):
+    e = np.exp(logits - logits.max(0, keepdims=True))
+    return (e / e.sum(0, keepdims=True)).astype(np.float32)
+
+
+def run(name, data, new_shape, is_seg, kwargs, num_threads):
+    start = time()
+    reference = resample_data_or_seg_slicewise(data, new_shape, is_seg, **kwargs)
+    time_reference = time() - start
+    start = time()
+    single = resample_data_or_seg(data, new_shape, is_seg, num_threads=1, **kwargs)
+    time_single = time() - start
+    start = time()
+    threaded = resample_data_or_seg(
+        data, new_shape, is_seg, num_threads=num_threads, **kwargs
+    )
+    time_threaded = time() - start
+
+    assert reference.shape == single.shape == threaded.shape
+    if is_seg:
+        difference = "%d voxels differ" % np.sum(reference != single)
+    else:
+        difference = "max abs difference %.2e" % np.max(
+            np.abs(reference.astype(float) - single)
+        )
+    assert np.array_equal(single, threaded)
+    print(
+        "%s %s -> %s: slicewise %.2f s, separable %.2f s, %d threads %.2f s (%.1fx), %s"
+        % (
+            name,
+            str(data.shape),
+            str(tuple(new_shape)),
+            time_reference,
+            time_single,
+            num_threads,
+            time_threaded,
+            time_reference / time_threaded,
+            difference,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares resample_data_or_seg with the original slice by slice implementation "
+        "(resample_data_or_seg_slicewise) on synthetic volumes of Synapse size: the preprocessing (data and "
+        "segmentation from the original to the target spacing) and the export of the softmax back to the original "
+        "spacing"
+    )
+    parser.add_argument(
+        "--shape",
+        nargs=3,
+        type=int,
+        default=[148, 512, 512],
+        help="shape of a case at the original spacing (Synapse CTs are 85-198 x 512 x 512)",
+    )
+    parser.add_argument(
+        "--original_spacing", nargs=3, type=float, default=[3.0, 0.76, 0.76]
+    )
+    parser.add_argument(
+        "--target_spacing", nargs=3, type=float, default=[3.0, 1.52, 1.52]
+    )
+    parser.add_argument("--num_classes", type=int, default=14)
+    parser.add_argument("--num_threads", type=int, default=8)
+    args = parser.parse_args()
+
+    shape = np.array(args.shape)
+    target_shape = np.round(
+        np.array(args.original_spacing) / np.array(args.target_spacing) * shape
+    ).astype(int)
+    # the low resolution axis, which resample_patient resamples separately
+    axis = [int(np.argmax(args.original_spacing))]
+
+    data = smooth_volume(shape, 1, 1234)
+    seg = blocky_labels(shape, args.num_classes, 1234)
+    run(
+        "data, separate z, order 3",
+        data,
+        target_shape,
+        False,
+        {"axis": axis, "order": 3, "do_separate_z": True, "order_z": 0},
+        args.num_threads,
+    )
+    run(
+        "data, order 3",
+        data,
+        target_shape,
+        False,
+        {"order": 3, "do_separate_z": False},
+        args.num_threads,
+    )
+    run(
+        "seg, separate z, order 1",
+        seg,
+        target_shape,
+        True,
+        {"axis": axis, "order": 1, "do_separate_z": True, "order_z": 0},
+        args.num_threads,
+    )
+    run(
+        "seg, order 1",
+        seg,
+        target_shape,
+        True,
+        {"order": 1, "do_separate_z": False},
+        args.num_threads,
+    )
+
+    # segmentation_export: the softmax of the network (at the target spacing) back to the original spacing
+    probabilities = softmax(
+        4 * smooth_volume(target_shape, args.num_classes, 4321).astype(float)
+    )
+    run(
+        "softmax, separate z, order 1",
+        probabilities,
+        shape,
+        False,
+        {"axis": axis, "order": 1, "do_separate_z": True, "order_z": 0},
+        args.num_threads,
+    )
+
+
+if __name__ == "__main__":
+    main()
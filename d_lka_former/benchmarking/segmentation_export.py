@@ -0,0 +1,93 @@
+import argparse
+import os
+import tempfile
+import tracemalloc
+from time import time
+
+import numpy as np
+import SimpleITK as sitk
+from d_lka_former.benchmarking.resampling import smooth_volume, softmax
+from d_lka_former.inference.segmentation_export import (
+    save_segmentation_nifti_from_softmax,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time and peak memory (numpy allocations, measured with tracemalloc) of "
+        "save_segmentation_nifti_from_softmax for each export_mode on a synthetic softmax of Synapse size, and how "
+        "many voxels of the exported segmentations differ from export_mode softmax"
+    )
+    parser.add_argument(
+        "--shape",
+        nargs=3,
+        type=int,
+        default=[148, 512, 512],
+        help="shape of the case at the original spacing",
+    )
+    parser.add_argument(
+        "--original_spacing", nargs=3, type=float, default=[3.0, 0.76, 0.76]
+    )
+    parser.add_argument(
+        "--target_spacing", nargs=3, type=float, default=[3.0, 1.52, 1.52]
+    )
+    parser.add_argument("--num_classes", type=int, default=14)
+    parser.add_argument(
+        "--save_npz",
+        action="store_true",
+        help="also write the resampled softmax (not possible with export_mode argmax)",
+    )
+    args = parser.parse_args()
+
+    shape = np.array(args.shape)
+    network_shape = np.round(
+        np.array(args.original_spacing) / np.array(args.target_spacing) * shape
+    ).astype(int)
+    probabilities = softmax(
+        4 * smooth_volume(network_shape, args.num_classes, 1234).astype(float)
+    )
+    properties = {
+        "size_after_cropping": tuple(shape),
+        "original_size_of_raw_data": tuple(shape),
+        "crop_bbox": [[0, s] for s in shape],
+        "original_spacing": np.array(args.original_spacing),
+        "spacing_after_resampling": np.array(args.target_spacing),
+        "itk_spacing": tuple(args.original_spacing[::-1]),
+        "itk_origin": (0.0, 0.0, 0.0),
+        "itk_direction": tuple(np.eye(3).ravel()),
+    }
+
+    output_folder = tempfile.mkdtemp()
+    modes = ["softmax", "channelwise"] + ([] if args.save_npz else ["argmax"])
+    reference = None
+    for mode in modes:
+        out_fname = os.path.join(output_folder, mode + ".nii.gz")
+        npz_fname = (
+            os.path.join(output_folder, mode + ".npz") if args.save_npz else None
+        )
+        tracemalloc.start()
+        start = time()
+        save_segmentation_nifti_from_softmax(
+            probabilities,
+            out_fname,
+            dict(properties, crop_bbox=[list(i) for i in properties["crop_bbox"]]),
+            1,
+            resampled_npz_fname=npz_fname,
+            verbose=False,
+            export_mode=mode,
+        )
+        end = time()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        seg = sitk.GetArrayFromImage(sitk.ReadImage(out_fname))
+        if reference is None:
+            reference = seg
+        print(
+            "%-12s %6.1f s, peak %6.2f GB, %d voxels differ from softmax"
+            % (mode, end - start, peak / 1024**3, np.sum(seg != reference))
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import argparse
+from time import time
+
+import numpy as np
+from d_lka_former.benchmarking.resampling import blocky_labels
+from d_lka_former.evaluation.surface_distance import surface_distances_per_label
+from medpy import metric
+from scipy.ndimage import binary_dilation
+
+# the organs the Synapse results are reported on (see inference_synapse.py)
+synapse_organs = [1, 2, 3, 4, 6, 7, 8, 11]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares HD, HD95, ASD and ASSD of medpy with SurfaceDistances on synthetic Synapse sized "
+        "segmentations (the values must be identical) and reports the time per case for the 8 organs of the Synapse "
+        "evaluation"
+    )
+    parser.add_argument("--shape", nargs=3, type=int, default=[148, 512, 512])
+    parser.add_argument("--spacing", nargs=3, type=float, default=[3.0, 0.76, 0.76])
+    parser.add_argument("--num_cases", type=int, default=2)
+    parser.add_argument("--num_threads", type=int, default=8)
+    args = parser.parse_args()
+
+    times_medpy, times_new, times_threads = [], [], []
+    for case in range(args.num_cases):
+        reference = blocky_labels(args.shape, 14, case)[0].astype(np.uint8)
+        # the prediction: the reference, shifted, with a grown organ and a few false positive voxels
+        test = np.roll(reference, (1, 3), axis=(1, 2))
+        test[binary_dilation(test == synapse_organs[0], iterations=2)] = synapse_organs[
+            0
+        ]
+        rs = np.random.RandomState(case)
+        for organ in synapse_organs:
+            test[tuple(rs.randint(0, s) for s in args.shape)] = organ
+
+        start = time()
+        medpy_values = []
+        for organ in synapse_organs:
+            t, r = test == organ, reference == organ
+            medpy_values.append(
+                [
+                    metric.binary.hd(t, r, args.spacing),
+                    metric.binary.hd95(t, r, args.spacing),
+                    metric.binary.asd(t, r, args.spacing),
+                    # assd of MedPy 0.4.0 (requirements.txt), newer versions average over all surface voxels instead
+                    np.mean(
+                        (
+                            metric.binary.asd(t, r, args.spacing),
+                            metric.binary.asd(r, t, args.spacing),
+                        )
+                    ),
+                ]
+            )
+        times_medpy.append(time() - start)
+
+        for num_threads, times in ((1, times_new), (args.num_threads, times_threads)):
+            start = time()
+            distances = surface_distances_per_label(
+                test, reference, synapse_organs, args.spacing, num_threads=num_threads
+            )
+            values = [
+                [
+                    d.hausdorff_distance(),
+                    d.hausdorff_distance_95(),
+                    d.avg_surface_distance(),
+                    d.avg_surface_distance_symmetric(),
+                ]
+                for d in distances
+            ]
+            times.append(time() - start)
+            assert np.allclose(values, medpy_values), (values, medpy_values)
+        print(
+            "case %d: medpy %.2f s, cropped and shared %.2f s, %d threads %.2f s, identical values"
+            % (
+                case,
+                times_medpy[-1],
+                times_new[-1],
+                args.num_threads,
+                times_threads[-1],
+            )
+        )
+    print(
+        "\n%.2f s -> %.2f s per case (%.1fx), %.2f s with %d threads"
+        % (
+            np.mean(times_medpy),
+            np.mean(times_new),
+            np.mean(times_medpy) / np.mean(times_new),
+            np.mean(times_threads),
+            args.num_threads,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
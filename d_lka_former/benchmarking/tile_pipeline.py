@@ -0,0 +1,142 @@
+import argparse
+from time import sleep, time
+
+import numpy as np
+import torch
+from torch import nn
+from d_lka_former.network_architecture.neural_network import SegmentationNetwork
+from d_lka_former.training.model_restore import load_model_and_checkpoint_files
+from d_lka_former.utilities.nd_softmax import softmax_helper
+
+
+class StandInNetwork(SegmentationNetwork):
+    def __init__(self, num_input_channels, num_classes, forward_time=0.0):
+        """
+        A single convolution with the inputs and outputs of the real network. Use it to check the tile pipeline
+        (buffering, ordering and timings) without a trained model. forward_time adds a sleep to every forward pass to
+        mimic a larger network
+        """
+        super(StandInNetwork, self).__init__()
+        self.conv_op = nn.Conv3d
+        self.num_classes = num_classes
+        self.inference_apply_nonlin = softmax_helper
+        self.forward_time = forward_time
+        self.conv = nn.Conv3d(num_input_channels, num_classes, 3, padding=1)
+
+    def forward(self, x):
+        if self.forward_time > 0:
+            sleep(self.forward_time)
+        return self.conv(x)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares sliding window prediction with and without the tile pipeline (predict_3D(pipelined=True)) "
+        "and prints the per stage timings. Without -m a single convolution stands in for the network"
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        default=None,
+        help="model output folder (the one containing the fold_X subfolders). If not given, a stand-in network is "
+        "used",
+    )
+    parser.add_argument("-f", "--fold", type=int, default=0)
+    parser.add_argument("-chk", "--checkpoint", default="model_final_checkpoint")
+    parser.add_argument(
+        "--shape",
+        nargs=4,
+        type=int,
+        default=[1, 148, 512, 512],
+        help="shape (c, x, y, z) of the random input volume. Default is roughly a preprocessed Synapse CT",
+    )
+    parser.add_argument(
+        "--patch_size",
+        nargs=3,
+        type=int,
+        default=[64, 128, 128],
+        help="only used for the stand-in network",
+    )
+    parser.add_argument(
+        "--num_classes", type=int, default=14, help="only used for the stand-in network"
+    )
+    parser.add_argument(
+        "--forward_time",
+        type=float,
+        default=0.0,
+        help="seconds the stand-in network sleeps in each forward pass",
+    )
+    parser.add_argument("--tiles_per_batch", type=int, default=1)
+    parser.add_argument("--mirror", action="store_true", help="enable mirroring TTA")
+    parser.add_argument(
+        "--cpu", action="store_true", help="run on CPU even if a GPU is available"
+    )
+    parser.add_argument("--repeats", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.model is None:
+        network = StandInNetwork(args.shape[0], args.num_classes, args.forward_time)
+        patch_size = args.patch_size
+        mirror_axes = (0, 1, 2)
+    else:
+        trainer, params = load_model_and_checkpoint_files(
+            args.model, [args.fold], checkpoint_name=args.checkpoint
+        )
+        trainer.load_checkpoint_ram(params[0], False)
+        network = trainer.network
+        network.do_ds = False
+        patch_size = trainer.patch_size
+        mirror_axes = trainer.data_aug_params["mirror_axes"]
+    network.eval()
+    if not args.cpu and torch.cuda.is_available():
+        network.cuda()
+    else:
+        network.cpu()
+
+    data = np.random.random(args.shape).astype(np.float32)
+    predict_kwargs = {
+        "do_mirroring": args.mirror,
+        "mirror_axes": mirror_axes,
+        "use_sliding_window": True,
+        "step_size": 0.5,
+        "patch_size": patch_size,
+        "use_gaussian": True,
+        "all_in_gpu": False,
+        "verbose": False,
+        "mixed_precision": network.get_device() != "cpu",
+        "tiles_per_batch": args.tiles_per_batch,
+    }
+
+    # warm up, so that cudnn/oneDNN have picked their kernels
+    network.predict_3D(
+        np.zeros([args.shape[0]] + list(patch_size), dtype=np.float32), **predict_kwargs
+    )
+
+    results = {}
+    for pipelined in (False, True):
+        times = []
+        for _ in range(args.repeats):
+            start = time()
+            seg, probabilities = network.predict_3D(
+                data, pipelined=pipelined, **predict_kwargs
+            )
+            times.append(time() - start)
+        results[pipelined] = (np.mean(times), seg, probabilities)
+        print("pipelined=%s: %.2f s" % (pipelined, np.mean(times)))
+
+    # both must give the same result, the pipeline only changes the order in which things happen
+    max_difference = np.abs(results[False][2] - results[True][2]).max()
+    print("max difference of the class probabilities: %.2e" % max_difference)
+    print("segmentations identical:", np.all(results[False][1] == results[True][1]))
+
+    print("\nstage timings of the last pipelined run:")
+    for stage, t in network._tile_pipeline_timings.items():
+        print("%-12s %8.3f s" % (stage, t))
+    print(
+        "\nspeedup: %.2fx (%.2f s -> %.2f s)"
+        % (results[False][0] / results[True][0], results[False][0], results[True][0])
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -9,3 +9,11 @@ RESAMPLING_SEPARATE_Z_ANISO_THRESHOLD = (
     3  # determines what threshold to use for resampling the low resolution axis
 )
 # separately (with NN)
+
+# how the preprocessing stores the cases: "npz" (np.savez_compressed, the default), "chunked" (see
+# utilities/chunked_volume.py, patches can be read without decompressing the whole case) or "both"
+default_storage_format = (
+    "npz"
+    if "nnFormer_storage_format" not in os.environ
+    else os.environ["nnFormer_storage_format"]
+)
@@ -15,6 +15,7 @@
 
 import collections
 import inspect
+from concurrent.futures import ThreadPoolExecutor
 import json
 import hashlib
 from datetime import datetime
@@ -22,7 +23,14 @@ from multiprocessing.pool import Pool
 import numpy as np
 import pandas as pd
 import SimpleITK as sitk
-from d_lka_former.evaluation.metrics import ConfusionMatrix, ALL_METRICS
+from d_lka_former.evaluation.metrics import (
+    ConfusionMatrix,
+    ALL_METRICS,
+    CONFUSION_MATRIX_METRICS,
+    SURFACE_DISTANCE_METRICS,
+    label_bounding_boxes,
+    label_confusion_counts,
+)
 from batchgenerators.utilities.file_and_folder_operations import (
     save_json,
     subfiles,
@@ -70,12 +78,17 @@ class Evaluator:
         metrics=None,
         advanced_metrics=None,
         nan_for_nonexisting=True,
+        num_threads=1,
     ):
+        """
+        :param num_threads: the surface distances (Hausdorff etc.) of the labels are computed by this many threads
+        """
         self.test = None
         self.reference = None
         self.confusion_matrix = ConfusionMatrix()
         self.labels = None
         self.nan_for_nonexisting = nan_for_nonexisting
+        self.num_threads = num_threads
         self.result = None
 
         self.metrics = []
@@ -202,43 +215,97 @@ class Evaluator:
         if advanced:
             eval_metrics += self.advanced_metrics
 
-        if isinstance(self.labels, dict):
-            for label, name in self.labels.items():
-                k = str(name)
-                self.result[k] = OrderedDict()
-                if not hasattr(label, "__iter__"):
-                    self.confusion_matrix.set_test(self.test == label)
-                    self.confusion_matrix.set_reference(self.reference == label)
-                else:
-                    current_test = 0
-                    current_reference = 0
-                    for l in label:
-                        current_test += self.test == l
-                        current_reference += self.reference == l
-                    self.confusion_matrix.set_test(current_test)
-                    self.confusion_matrix.set_reference(current_reference)
-                for metric in eval_metrics:
-                    self.result[k][metric] = _funcs[metric](
-                        confusion_matrix=self.confusion_matrix,
-                        nan_for_nonexisting=self.nan_for_nonexisting,
-                        **metric_kwargs
-                    )
+        # the confusion matrix of all labels in one pass. The metrics of each label are derived from it, only the
+        # surface distances (and user defined metrics) need the masks of the labels. These are cropped to the
+        # bounding box of the label in test and reference
+        values, counts = label_confusion_counts(self.test, self.reference)
+        size = int(counts.sum())
+        need_masks = any(
+            [_funcs[metric] not in CONFUSION_MATRIX_METRICS for metric in eval_metrics]
+        )
+        if need_masks:
+            test_boxes = label_bounding_boxes(self.test)
+            reference_boxes = label_bounding_boxes(self.reference)
 
+        if isinstance(self.labels, dict):
+            labels = [(label, str(name)) for label, name in self.labels.items()]
         else:
-            for i, l in enumerate(self.labels):
-                k = str(l)
-                self.result[k] = OrderedDict()
-                self.confusion_matrix.set_test(self.test == l)
-                self.confusion_matrix.set_reference(self.reference == l)
-                for metric in eval_metrics:
-                    self.result[k][metric] = _funcs[metric](
-                        confusion_matrix=self.confusion_matrix,
-                        nan_for_nonexisting=self.nan_for_nonexisting,
-                        **metric_kwargs
+            labels = [(l, str(l)) for l in self.labels]
+
+        confusion_matrices = []
+        for label, k in labels:
+            label_values = list(label) if hasattr(label, "__iter__") else [label]
+            in_label = np.isin(values, label_values)
+            tp = counts[in_label][:, in_label].sum()
+            fp = counts[in_label].sum() - tp
+            fn = counts[:, in_label].sum() - tp
+            confusion_matrix = ConfusionMatrix()
+            if need_masks:
+                slicer = self._bounding_box(label_values, test_boxes, reference_boxes)
+                confusion_matrix.set_test(np.isin(self.test[slicer], label_values))
+                confusion_matrix.set_reference(
+                    np.isin(self.reference[slicer], label_values)
+                )
+            confusion_matrix.set_counts(tp, fp, size - tp - fp - fn, fn)
+            confusion_matrices.append((k, confusion_matrix))
+
+        if self.num_threads > 1 and any(
+            [_funcs[metric] in SURFACE_DISTANCE_METRICS for metric in eval_metrics]
+        ):
+            # the distance transforms of all labels in parallel, the metrics below reuse them
+            def compute_surface_distances(confusion_matrix):
+                if not any(confusion_matrix.get_existence()):
+                    confusion_matrix.get_surface_distances(
+                        metric_kwargs.get("voxel_spacing"),
+                        metric_kwargs.get("connectivity", 1),
+                    ).compute()
+
+            with ThreadPoolExecutor(self.num_threads) as executor:
+                list(
+                    executor.map(
+                        compute_surface_distances,
+                        [c for _, c in confusion_matrices],
                     )
+                )
+
+        for k, confusion_matrix in confusion_matrices:
+            self.result[k] = OrderedDict()
+            self.confusion_matrix = confusion_matrix
+            for metric in eval_metrics:
+                self.result[k][metric] = _funcs[metric](
+                    confusion_matrix=confusion_matrix,
+                    nan_for_nonexisting=self.nan_for_nonexisting,
+                    **metric_kwargs
+                )
 
         return self.result
 
+    def _bounding_box(self, label_values, test_boxes, reference_boxes):
+        """
+        Joint bounding box of label_values in test and reference (a voxel larger on each side). The whole volume if
+        one of the values has no bounding box (background, negative values, ...), none of them occurs at all or the
+        bounding boxes could not be determined (see label_bounding_boxes)
+        """
+        if test_boxes is None or reference_boxes is None:
+            return tuple([slice(None)] * self.test.ndim)
+        boxes = []
+        for l in label_values:
+            if isinstance(l, (int, np.integer)) and l > 0:
+                boxes += [
+                    b[int(l)] for b in (test_boxes, reference_boxes) if int(l) in b
+                ]
+            else:
+                return tuple([slice(None)] * self.test.ndim)
+        if len(boxes) == 0:
+            return tuple([slice(None)] * self.test.ndim)
+        return tuple(
+            slice(
+                max(min([b[d].start for b in boxes]) - 1, 0),
+                max([b[d].stop for b in boxes]) + 1,
+            )
+            for d in range(self.test.ndim)
+        )
+
     def to_dict(self):
         if self.result is None:
             self.evaluate()
@@ -367,10 +434,6 @@ def aggregate_scores(
     if labels is not None:
         evaluator.set_labels(labels)
 
-    all_scores = OrderedDict()
-    all_scores["all"] = []
-    all_scores["mean"] = OrderedDict()
-
     test = [i[0] for i in test_ref_pairs]
     ref = [i[1] for i in test_ref_pairs]
     p = Pool(num_threads)
@@ -381,6 +444,35 @@ def aggregate_scores(
     p.close()
     p.join()
 
+    return summarize_scores(
+        all_res,
+        nanmean,
+        json_output_file,
+        json_name,
+        json_description,
+        json_author,
+        json_task,
+    )
+
+
+def summarize_scores(
+    all_res,
+    nanmean=True,
+    json_output_file=None,
+    json_name="",
+    json_description="",
+    json_author="Fabian",
+    json_task="",
+):
+    """
+    the second half of aggregate_scores, for scores that were computed elsewhere (see run_evaluation)
+    :param all_res: list with the scores of each case
+    :return:
+    """
+    all_scores = OrderedDict()
+    all_scores["all"] = []
+    all_scores["mean"] = OrderedDict()
+
     for i in range(len(all_res)):
         all_scores["all"].append(all_res[i])
 
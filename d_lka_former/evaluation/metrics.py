@@ -13,7 +13,8 @@
 #    limitations under the License.
 
 import numpy as np
-from medpy import metric
+from d_lka_former.evaluation.surface_distance import SurfaceDistances
+from scipy.ndimage import find_objects
 
 
 def assert_shape(test, reference):
@@ -54,6 +55,21 @@ class ConfusionMatrix:
         self.test_full = None
         self.reference_empty = None
         self.reference_full = None
+        self.surface_distances = None
+
+    def set_counts(self, tp, fp, tn, fn):
+        """
+        Sets the confusion matrix directly, for example from label_confusion_counts. test and reference are then only
+        used by the metrics that need the masks (the surface distances), so they can be crops of the full masks as
+        long as the crops contain all foreground (see Evaluator.evaluate). Call this after set_test and
+        set_reference, they reset the counts
+        """
+        self.tp, self.fp, self.tn, self.fn = int(tp), int(fp), int(tn), int(fn)
+        self.size = self.tp + self.fp + self.tn + self.fn
+        self.test_empty = self.tp + self.fp == 0
+        self.test_full = self.tp + self.fp == self.size
+        self.reference_empty = self.tp + self.fn == 0
+        self.reference_full = self.tp + self.fn == self.size
 
     def compute(self):
         if self.test is None or self.reference is None:
@@ -81,6 +97,24 @@ class ConfusionMatrix:
 
         return self.tp, self.fp, self.tn, self.fn
 
+    def get_surface_distances(self, voxel_spacing=None, connectivity=1):
+        """
+        SurfaceDistances of test and reference. They are kept until test or reference change, so all surface metrics
+        of a label share the same distance transforms
+        """
+        key = (
+            None if voxel_spacing is None else tuple(np.atleast_1d(voxel_spacing)),
+            connectivity,
+        )
+        if self.surface_distances is None or self.surface_distances[0] != key:
+            self.surface_distances = (
+                key,
+                SurfaceDistances(
+                    self.test, self.reference, voxel_spacing, connectivity
+                ),
+            )
+        return self.surface_distances[1]
+
     def get_size(self):
         if self.size is None:
             self.compute()
@@ -105,6 +139,63 @@ class ConfusionMatrix:
         )
 
 
+def label_confusion_counts(test, reference, max_bins=2**22):
+    """
+    Confusion matrix of all labels at once, with a single bincount over the volume
+
+    :param test: segmentation, same shape as reference
+    :param reference:
+    :param max_bins: non-negative integer segmentations are counted directly (label values are the indices of counts) if
+    (max label + 1) ** 2 is at most this. Everything else (negative, large or float labels) goes through np.unique first
+    :return: values, counts with counts[i, j] = number of voxels where test == values[i] and reference == values[j]
+    """
+    assert_shape(test, reference)
+    test = np.asarray(test).ravel()
+    reference = np.asarray(reference).ravel()
+    if (
+        test.dtype.kind in "biu"
+        and reference.dtype.kind in "biu"
+        and len(test) > 0
+        and min(test.min(), reference.min()) >= 0
+        and (int(max(test.max(), reference.max())) + 1) ** 2 <= max_bins
+    ):
+        n = int(max(test.max(), reference.max())) + 1
+        values = np.arange(n)
+        index = test.astype(np.int32) * n
+        np.add(index, reference, out=index, casting="unsafe")
+    else:
+        values, inverse = np.unique(
+            np.concatenate((test, reference)), return_inverse=True
+        )
+        n = len(values)
+        inverse = inverse.ravel()
+        index = inverse[: len(test)] * n
+        index += inverse[len(test) :]
+    counts = np.bincount(index, minlength=n * n).reshape(n, n)
+    return values, counts
+
+
+def label_bounding_boxes(segmentation):
+    """
+    :return: dict label -> bounding box (tuple of slices) for all labels > 0 of a non-negative integer segmentation
+    (found in a single pass with scipy's find_objects). None for any other segmentation
+    """
+    segmentation = np.asarray(segmentation)
+    if segmentation.dtype.kind == "b":
+        segmentation = segmentation.view(np.uint8)
+    if (
+        segmentation.dtype.kind not in "iu"
+        or segmentation.size == 0
+        or segmentation.min() < 0
+    ):
+        return None
+    return {
+        i + 1: box
+        for i, box in enumerate(find_objects(segmentation))
+        if box is not None
+    }
+
+
 def dice(
     test=None, reference=None, confusion_matrix=None, nan_for_nonexisting=True, **kwargs
 ):
@@ -410,9 +501,9 @@ def hausdorff_distance(
         else:
             return 0
 
-    test, reference = confusion_matrix.test, confusion_matrix.reference
-
-    return metric.hd(test, reference, voxel_spacing, connectivity)
+    return confusion_matrix.get_surface_distances(
+        voxel_spacing, connectivity
+    ).hausdorff_distance()
 
 
 def hausdorff_distance_95(
@@ -440,9 +531,9 @@ def hausdorff_distance_95(
         else:
             return 0
 
-    test, reference = confusion_matrix.test, confusion_matrix.reference
-
-    return metric.hd95(test, reference, voxel_spacing, connectivity)
+    return confusion_matrix.get_surface_distances(
+        voxel_spacing, connectivity
+    ).hausdorff_distance_95()
 
 
 def avg_surface_distance(
@@ -470,9 +561,9 @@ def avg_surface_distance(
         else:
             return 0
 
-    test, reference = confusion_matrix.test, confusion_matrix.reference
-
-    return metric.asd(test, reference, voxel_spacing, connectivity)
+    return confusion_matrix.get_surface_distances(
+        voxel_spacing, connectivity
+    ).avg_surface_distance()
 
 
 def avg_surface_distance_symmetric(
@@ -500,10 +591,75 @@ def avg_surface_distance_symmetric(
         else:
             return 0
 
-    test, reference = confusion_matrix.test, confusion_matrix.reference
+    return confusion_matrix.get_surface_distances(
+        voxel_spacing, connectivity
+    ).avg_surface_distance_symmetric()
 
-    return metric.assd(test, reference, voxel_spacing, connectivity)
 
+def normalized_surface_dice(
+    test=None,
+    reference=None,
+    confusion_matrix=None,
+    nan_for_nonexisting=True,
+    voxel_spacing=None,
+    connectivity=1,
+    nsd_threshold=1.0,
+    **kwargs
+):
+    """
+    see evaluation.surface_dice.normalized_surface_dice, nsd_threshold is in mm (voxels if voxel_spacing is None)
+    """
+    if confusion_matrix is None:
+        confusion_matrix = ConfusionMatrix(test, reference)
+
+    (
+        test_empty,
+        test_full,
+        reference_empty,
+        reference_full,
+    ) = confusion_matrix.get_existence()
+
+    if test_empty or test_full or reference_empty or reference_full:
+        if nan_for_nonexisting:
+            return float("NaN")
+        else:
+            return 0
+
+    return confusion_matrix.get_surface_distances(
+        voxel_spacing, connectivity
+    ).normalized_surface_dice(nsd_threshold)
+
+
+# metrics that only need the counts of the confusion matrix. Evaluator.evaluate does not build the masks of the labels
+# if it only computes these
+CONFUSION_MATRIX_METRICS = (
+    false_positive_rate,
+    dice,
+    jaccard,
+    precision,
+    recall,
+    sensitivity,
+    specificity,
+    accuracy,
+    fscore,
+    false_omission_rate,
+    negative_predictive_value,
+    false_negative_rate,
+    true_negative_rate,
+    false_discovery_rate,
+    total_positives_test,
+    total_negatives_test,
+    total_positives_reference,
+    total_negatives_reference,
+)
+
+SURFACE_DISTANCE_METRICS = (
+    hausdorff_distance,
+    hausdorff_distance_95,
+    avg_surface_distance,
+    avg_surface_distance_symmetric,
+    normalized_surface_dice,
+)
 
 ALL_METRICS = {
     "False Positive Rate": false_positive_rate,
@@ -515,6 +671,7 @@ ALL_METRICS = {
     "Recall": recall,
     "Avg. Symmetric Surface Distance": avg_surface_distance_symmetric,
     "Avg. Surface Distance": avg_surface_distance,
+    "Normalized Surface Dice": normalized_surface_dice,
     "Accuracy": accuracy,
     "False Omission Rate": false_omission_rate,
     "Negative Predictive Value": negative_predictive_value,
@@ -14,7 +14,7 @@
 
 
 import numpy as np
-from medpy.metric.binary import __surface_distances
+from d_lka_former.evaluation.surface_distance import SurfaceDistances
 
 
 def normalized_surface_dice(
@@ -29,8 +29,8 @@ def normalized_surface_dice(
 
     The normalized surface dice is symmetric, so it should not matter whether a or b is the reference image
 
-    This implementation natively supports 2D and 3D images. Whether other dimensions are supported depends on the
-    __surface_distances implementation in medpy
+    This implementation natively supports 2D and 3D images. The surface distances are computed like medpy's
+    __surface_distances, but only within the bounding box of a and b, see SurfaceDistances
 
     :param a: image 1, must have the same shape as b
     :param b: image 2, must have the same shape as a
@@ -50,19 +50,6 @@ def normalized_surface_dice(
     )
     if spacing is None:
         spacing = tuple([1 for _ in range(len(a.shape))])
-    a_to_b = __surface_distances(a, b, spacing, connectivity)
-    b_to_a = __surface_distances(b, a, spacing, connectivity)
-
-    numel_a = len(a_to_b)
-    numel_b = len(b_to_a)
-
-    tp_a = np.sum(a_to_b <= threshold) / numel_a
-    tp_b = np.sum(b_to_a <= threshold) / numel_b
-
-    fp = np.sum(a_to_b > threshold) / numel_a
-    fn = np.sum(b_to_a > threshold) / numel_b
-
-    dc = (tp_a + tp_b) / (
-        tp_a + tp_b + fp + fn + 1e-8
-    )  # 1e-8 just so that we don't get div by 0
-    return dc
+    return SurfaceDistances(a, b, spacing, connectivity).normalized_surface_dice(
+        threshold
+    )
@@ -179,7 +179,8 @@ def predict_cases(
     segmentation_export_kwargs: dict = None,
 ):
     """
-    :param segmentation_export_kwargs:
+    :param segmentation_export_kwargs: force_separate_z, interpolation_order and interpolation_order_z (and optionally
+    export_mode, see save_segmentation_nifti_from_softmax)
     :param model: folder where the model is saved, must contain fold_x subfolders
     :param list_of_lists: [[case0_0000.nii.gz, case0_0001.nii.gz], [case1_0000.nii.gz, case1_0001.nii.gz], ...]
     :param output_filenames: [output_file_case0.nii.gz, output_file_case1.nii.gz, ...]
@@ -257,6 +258,11 @@ def predict_cases(
         force_separate_z = segmentation_export_kwargs["force_separate_z"]
         interpolation_order = segmentation_export_kwargs["interpolation_order"]
         interpolation_order_z = segmentation_export_kwargs["interpolation_order_z"]
+    # see save_segmentation_nifti_from_softmax
+    if segmentation_export_kwargs is not None:
+        export_mode = segmentation_export_kwargs.get("export_mode", "softmax")
+    else:
+        export_mode = "softmax"
 
     print("starting preprocessing generator")
     preprocessing = preprocess_multithreaded(
@@ -348,6 +354,8 @@ def predict_cases(
                         None,
                         force_separate_z,
                         interpolation_order_z,
+                        True,
+                        export_mode,
                     ),
                 ),
             )
@@ -633,6 +641,8 @@ def predict_cases_fastest(
     trainer, params = load_model_and_checkpoint_files(
         model, folds, mixed_precision=mixed_precision, checkpoint_name=checkpoint_name
     )
+    # with a single model we only need the segmentation, not the softmax
+    trainer.inference_return_probabilities = len(params) > 1
 
     print("starting preprocessing generator")
     preprocessing = preprocess_multithreaded(
@@ -656,9 +666,10 @@ def predict_cases_fastest(
 
         # preallocate the output arrays
         # same dtype as the return value in predict_preprocessed_data_return_seg_and_softmax (saves time)
-        all_softmax_outputs = np.zeros(
-            (len(params), trainer.num_classes, *d.shape[1:]), dtype=np.float16
-        )
+        if len(params) > 1:
+            all_softmax_outputs = np.zeros(
+                (len(params), trainer.num_classes, *d.shape[1:]), dtype=np.float16
+            )
         all_seg_outputs = np.zeros((len(params), *d.shape[1:]), dtype=int)
         print("predicting", output_filename)
 
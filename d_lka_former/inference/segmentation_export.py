@@ -25,6 +25,7 @@ from d_lka_former.preprocessing.preprocessing import (
     get_do_separate_z,
     resample_data_or_seg,
 )
+from d_lka_former.utilities.shared_memory import array_from_shared_memory
 from batchgenerators.utilities.file_and_folder_operations import *
 
 
@@ -41,6 +42,7 @@ def save_segmentation_nifti_from_softmax(
     force_separate_z: bool = None,
     interpolation_order_z: int = 0,
     verbose: bool = True,
+    export_mode: str = "softmax",
 ):
     """
     This is a utility for writing segmentations to nifto and npz. It requires the data to have been preprocessed by
@@ -70,8 +72,21 @@ def save_segmentation_nifti_from_softmax(
     /never resample along z separately. Do not touch unless you know what you are doing
     :param interpolation_order_z: if separate z resampling is done then this is the order for resampling in z
     :param verbose:
+    :param export_mode: how the softmax is brought back to the original spacing:
+    softmax: resample the whole softmax at once (as float64) and take the argmax
+    channelwise: resample one channel at a time and keep a running argmax. The segmentation (and the npz, if
+    resampled_npz_fname is given) is the same as with softmax, but only one channel is ever held in float64. Memory use
+    drops from C float64 volumes to about 2 (4 with the npz) at the original spacing
+    argmax: take the argmax at the network spacing and resample the segmentation (label by label, with order and
+    interpolation_order_z). Much faster, but not identical along boundaries. Cannot write resampled_npz_fname
     :return:
     """
+    assert export_mode in ("softmax", "channelwise", "argmax"), (
+        "unknown export_mode %s" % export_mode
+    )
+    assert not (
+        export_mode == "argmax" and resampled_npz_fname is not None
+    ), "export_mode argmax cannot save the softmax, use softmax or channelwise"
     if verbose:
         print("force_separate_z:", force_separate_z, "interpolation order:", order)
 
@@ -125,43 +140,82 @@ def save_segmentation_nifti_from_softmax(
 
         if verbose:
             print("separate z:", do_separate_z, "lowres axis", lowres_axis)
-        seg_old_spacing = resample_data_or_seg(
+        resampling_kwargs = {
+            "axis": lowres_axis,
+            "order": order,
+            "do_separate_z": do_separate_z,
+            "cval": 0,
+            "order_z": interpolation_order_z,
+        }
+    else:
+        if verbose:
+            print("no resampling necessary")
+        resampling_kwargs = None
+
+    if export_mode == "softmax":
+        if resampling_kwargs is not None:
+            seg_old_spacing = resample_data_or_seg(
+                segmentation_softmax,
+                shape_original_after_cropping,
+                is_seg=False,
+                **resampling_kwargs
+            )
+            # seg_old_spacing = resize_softmax_output(segmentation_softmax, shape_original_after_cropping, order=order)
+        else:
+            seg_old_spacing = segmentation_softmax
+
+        if resampled_npz_fname is not None:
+            np.savez_compressed(
+                resampled_npz_fname, softmax=seg_old_spacing.astype(np.float16)
+            )
+
+        if region_class_order is None:
+            seg_old_spacing = seg_old_spacing.argmax(0)
+        else:
+            seg_old_spacing_final = np.zeros(seg_old_spacing.shape[1:])
+            for i, c in enumerate(region_class_order):
+                seg_old_spacing_final[seg_old_spacing[i] > 0.5] = c
+            seg_old_spacing = seg_old_spacing_final
+    elif export_mode == "channelwise":
+        seg_old_spacing, softmax_old_spacing = _resample_softmax_channelwise(
             segmentation_softmax,
             shape_original_after_cropping,
-            is_seg=False,
-            axis=lowres_axis,
-            order=order,
-            do_separate_z=do_separate_z,
-            cval=0,
-            order_z=interpolation_order_z,
+            region_class_order,
+            resampled_npz_fname is not None,
+            resampling_kwargs,
         )
-        # seg_old_spacing = resize_softmax_output(segmentation_softmax, shape_original_after_cropping, order=order)
+        if resampled_npz_fname is not None:
+            np.savez_compressed(resampled_npz_fname, softmax=softmax_old_spacing)
+        del softmax_old_spacing
     else:
-        if verbose:
-            print("no resampling necessary")
-        seg_old_spacing = segmentation_softmax
+        if region_class_order is None:
+            seg = segmentation_softmax.argmax(0).astype(np.uint8)
+        else:
+            seg = np.zeros(segmentation_softmax.shape[1:], dtype=np.uint8)
+            for i, c in enumerate(region_class_order):
+                seg[segmentation_softmax[i] > 0.5] = c
+        if resampling_kwargs is not None:
+            seg = resample_data_or_seg(
+                seg[None],
+                shape_original_after_cropping,
+                is_seg=True,
+                **resampling_kwargs
+            )[0]
+        seg_old_spacing = seg
 
     if resampled_npz_fname is not None:
-        np.savez_compressed(
-            resampled_npz_fname, softmax=seg_old_spacing.astype(np.float16)
-        )
         # this is needed for ensembling if the nonlinearity is sigmoid
         if region_class_order is not None:
             properties_dict["regions_class_order"] = region_class_order
         save_pickle(properties_dict, resampled_npz_fname[:-4] + ".pkl")
 
-    if region_class_order is None:
-        seg_old_spacing = seg_old_spacing.argmax(0)
-    else:
-        seg_old_spacing_final = np.zeros(seg_old_spacing.shape[1:])
-        for i, c in enumerate(region_class_order):
-            seg_old_spacing_final[seg_old_spacing[i] > 0.5] = c
-        seg_old_spacing = seg_old_spacing_final
-
     bbox = properties_dict.get("crop_bbox")
 
     if bbox is not None:
-        seg_old_size = np.zeros(shape_original_before_cropping)
+        seg_old_size = np.zeros(
+            shape_original_before_cropping,
+            dtype=float if export_mode == "softmax" else np.uint8,
+        )
         for c in range(3):
             bbox[c][1] = np.min(
                 (
@@ -198,6 +252,74 @@ def save_segmentation_nifti_from_softmax(
         sitk.WriteImage(seg_resized_itk, non_postprocessed_fname)
 
 
+def _resample_softmax_channelwise(
+    segmentation_softmax,
+    new_shape,
+    region_class_order=None,
+    return_softmax=False,
+    resampling_kwargs=None,
+):
+    """
+    Resamples the softmax one channel at a time and keeps the argmax (or the regions) of what was resampled so far.
+    resample_data_or_seg treats the channels independently and casts back to the dtype of the input, so the result is
+    the same as resampling everything at once
+    :param resampling_kwargs: passed on to resample_data_or_seg, None if no resampling is needed
+    :return: segmentation (uint8) and the resampled softmax as float16 (None if not return_softmax)
+    """
+    num_channels = segmentation_softmax.shape[0]
+    new_shape = tuple(new_shape)
+    seg = np.zeros(new_shape, dtype=np.uint8)
+    best = None
+    softmax = (
+        np.zeros((num_channels,) + new_shape, dtype=np.float16)
+        if return_softmax
+        else None
+    )
+    for i in range(num_channels):
+        if resampling_kwargs is not None:
+            channel = resample_data_or_seg(
+                segmentation_softmax[i : i + 1],
+                new_shape,
+                is_seg=False,
+                **resampling_kwargs
+            )[0]
+        else:
+            channel = segmentation_softmax[i]
+        if return_softmax:
+            softmax[i] = channel
+        if region_class_order is not None:
+            seg[channel > 0.5] = region_class_order[i]
+        elif best is None:
+            best = np.array(channel)
+        else:
+            # strictly greater, argmax(0) also returns the first channel if there is a tie
+            better = channel > best
+            seg[better] = i
+            best[better] = channel[better]
+    return seg, softmax
+
+
+def save_segmentation_nifti_from_shared_softmax(
+    shared_softmax: Tuple[str, tuple, str], *args, **kwargs
+):
+    """
+    save_segmentation_nifti_from_softmax for a softmax that was handed over with array_to_shared_memory. This avoids
+    pickling the softmax (and the 2 GB limit that comes with it, see above). The shared memory is released afterwards.
+    All other arguments are passed on to save_segmentation_nifti_from_softmax
+    """
+    segmentation_softmax, shm = array_from_shared_memory(shared_softmax)
+    try:
+        save_segmentation_nifti_from_softmax(segmentation_softmax, *args, **kwargs)
+    finally:
+        del segmentation_softmax
+        shm.unlink()
+        try:
+            shm.close()
+        except BufferError:
+            # an exception traceback may still reference the array. The memory is released once this process exits
+            pass
+
+
 def save_segmentation_nifti(
     segmentation, out_fname, dct, order=1, force_separate_z=None, order_z=0
 ):
@@ -3,7 +3,7 @@ import os
 import SimpleITK as sitk
 import numpy as np
 import argparse
-from medpy import metric
+from d_lka_former.evaluation.surface_distance import SurfaceDistances
 
 
 def read_nii(path):
@@ -19,7 +19,7 @@ def dice(pred, label):
 
 def hd(pred, gt):
     if pred.sum() > 0 and gt.sum() > 0:
-        hd95 = metric.binary.hd95(pred, gt)
+        hd95 = SurfaceDistances(pred, gt).hausdorff_distance_95()
         return hd95
     else:
         return 0
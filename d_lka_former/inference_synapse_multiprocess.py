@@ -3,7 +3,7 @@ import glob
 import SimpleITK as sitk
 import numpy as np
 import argparse
-from medpy import metric
+from d_lka_former.evaluation.surface_distance import SurfaceDistances
 from joblib import Parallel, delayed
 from tqdm import tqdm
 
@@ -21,7 +21,7 @@ def calculate_dice(pred, label):
 def calculate_hd(pred, gt):
     """Calculate Hausdorff distance."""
     if pred.sum() > 0 and gt.sum() > 0:
-        return metric.binary.hd95(pred, gt)
+        return SurfaceDistances(pred, gt).hausdorff_distance_95()
     else:
         return 0
 
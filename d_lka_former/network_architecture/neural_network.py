@@ -15,9 +15,12 @@
 
 import numpy as np
 from batchgenerators.augmentations.utils import pad_nd_image
+from d_lka_former.network_architecture.tile_pipeline import TilePipeline
+from d_lka_former.preprocessing.cropping import create_nonzero_mask, get_bbox_from_mask
 from d_lka_former.utilities.random_stuff import no_op
-from d_lka_former.utilities.to_torch import to_cuda, maybe_to_torch
+from d_lka_former.utilities.to_torch import to_device, maybe_to_torch
 from torch import nn
+from torch.nn import functional as F
 import torch
 from scipy.ndimage.filters import gaussian_filter
 from typing import Union, Tuple, List
@@ -25,12 +28,29 @@ from typing import Union, Tuple, List
 from torch.cuda.amp import autocast
 
 
+def cpu_supports_bfloat16() -> bool:
+    """
+    bfloat16 autocast on CPU is only faster than float32 if the CPU has native bfloat16 instructions (AVX512-BF16 or
+    AMX). On everything else it is emulated and slower, so we only use it if we find the corresponding cpu flags
+    """
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            cpuinfo = f.read()
+    except OSError:
+        return False
+    return any(i in cpuinfo for i in ("avx512_bf16", "amx_bf16"))
+
+
+def cpu_bfloat16_autocast():
+    return torch.autocast("cpu", dtype=torch.bfloat16)
+
+
 class NeuralNetwork(nn.Module):
     def __init__(self):
         super(NeuralNetwork, self).__init__()
 
     def get_device(self):
-        if next(self.parameters()).device == "cpu":
+        if next(self.parameters()).device.type == "cpu":
             return "cpu"
         else:
             return next(self.parameters()).device.index
@@ -72,6 +92,16 @@ class SegmentationNetwork(NeuralNetwork):
         self._gaussian_3d = self._patch_size_for_gaussian_3d = None
         self._gaussian_2d = self._patch_size_for_gaussian_2d = None
 
+        # memory layout of the network inputs during inference, see predict_3D(channels_last=...)
+        self._inference_memory_format = torch.contiguous_format
+
+        # how many tiles can be predicted in one batch when running sliding window with tiles_per_batch='auto'. Stored
+        # as (key, tiles_per_batch) where key describes the inputs the estimate was made for
+        self._tiles_per_batch = None
+
+        # per stage timings of the last pipelined sliding window prediction, see predict_3D(pipelined=True)
+        self._tile_pipeline_timings = None
+
     def predict_3D(
         self,
         x: np.ndarray,
@@ -87,6 +117,16 @@ class SegmentationNetwork(NeuralNetwork):
         all_in_gpu: bool = False,
         verbose: bool = True,
         mixed_precision: bool = True,
+        tiles_per_batch: Union[int, str] = 1,
+        num_threads: int = None,
+        channels_last: bool = False,
+        mirror_combinations: Tuple[Tuple[int, ...], ...] = None,
+        mirror_chunks: int = 1,
+        sparse_tile_threshold: float = None,
+        sparse_tile_min_foreground: float = 0.0,
+        accumulation_dtype: type = np.float32,
+        return_probabilities: bool = True,
+        pipelined: bool = False,
     ) -> Tuple[np.ndarray, np.ndarray]:
         """
         Use this function to predict a 3D image. It does not matter whether the network is a 2D or 3D U-Net, it will
@@ -117,7 +157,36 @@ class SegmentationNetwork(NeuralNetwork):
         :param pad_kwargs: leave this alone
         :param all_in_gpu: experimental. You probably want to leave this as is it
         :param verbose: Do you want a wall of text? If yes then set this to True
-        :param mixed_precision: if True, will run inference in mixed precision with autocast()
+        :param mixed_precision: if True, will run inference in mixed precision with autocast(). On CPU this is bfloat16
+        autocast and only used if the CPU supports bfloat16 natively
+        :param tiles_per_batch: (Only applies to sliding window prediction) number of tiles that are stacked into one
+        batch and pushed through the network together. Use 'auto' to pick the largest number that fits into the free
+        GPU memory
+        :param num_threads: (Only applies to CPU prediction) number of intra-op threads torch may use. None leaves the
+        torch default alone
+        :param channels_last: if True, network and inputs use the channels_last_3d memory layout. This is mostly useful
+        on CPU where the oneDNN convolutions are considerably faster in this layout
+        :param mirror_combinations: (Only applies if do_mirroring) subset of mirror combinations to use for test time
+        augmentation, given as tuples of axes that are flipped together, for example ((), (2,), (0, 2)). () is the
+        unmirrored prediction. None uses all 2 ** len(mirror_axes) combinations
+        :param mirror_chunks: the mirrored versions of each patch are stacked into one batch. This batch is split into
+        mirror_chunks forward passes. Increase this if a single forward pass runs out of memory
+        :param sparse_tile_threshold: (Only applies to sliding window prediction) if not None, voxels of x with an
+        intensity above this value are considered to be inside the body. Tiles in which the fraction of body voxels is
+        not larger than sparse_tile_min_foreground are not predicted, they are filled with background instead. For CT
+        the lower clipping bound of the intensity normalization (x.min()) is a good choice
+        :param sparse_tile_min_foreground: see sparse_tile_threshold. The default of 0 only skips tiles that do not
+        contain a single body voxel
+        :param accumulation_dtype: (Only applies to sliding window prediction without all_in_gpu) dtype of the array
+        the tile predictions are aggregated in. np.float16 halves the host memory, the returned class probabilities
+        will then be float16 as well
+        :param return_probabilities: if False, only the segmentation is returned and the class probabilities are None.
+        Sliding window prediction without all_in_gpu then only keeps the part of the image in memory that the current
+        tiles cover and converts everything behind them into the segmentation right away. Use this if you do not need
+        the softmax, it reduces the peak memory considerably
+        :param pipelined: (Only applies to sliding window prediction without all_in_gpu) overlap the host to device
+        copies, forward passes, device to host copies and the aggregation of consecutive batches of tiles. The time
+        spent in each stage of the last prediction is stored in self._tile_pipeline_timings
         :return:
         """
         torch.cuda.empty_cache()
@@ -130,7 +199,9 @@ class SegmentationNetwork(NeuralNetwork):
         if verbose:
             print("debug: mirroring", do_mirroring, "mirror_axes", mirror_axes)
 
-        assert self.get_device() != "cpu", "CPU not implemented"
+        if self.get_device() == "cpu" and all_in_gpu:
+            # on CPU the numpy aggregation is what all_in_gpu would do anyway
+            all_in_gpu = False
 
         if pad_kwargs is None:
             pad_kwargs = {"constant_values": 0}
@@ -153,10 +224,14 @@ class SegmentationNetwork(NeuralNetwork):
 
         assert len(x.shape) == 4, "data must have shape (c,x,y,z)"
 
-        if mixed_precision:
-            context = autocast
-        else:
-            context = no_op
+        context = self._get_inference_context(mixed_precision)
+
+        num_threads_before = torch.get_num_threads()
+        if self.get_device() == "cpu" and num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        if channels_last:
+            self._set_inference_memory_format(torch.channels_last_3d)
 
         with context():
             with torch.no_grad():
@@ -174,6 +249,14 @@ class SegmentationNetwork(NeuralNetwork):
                             pad_kwargs=pad_kwargs,
                             all_in_gpu=all_in_gpu,
                             verbose=verbose,
+                            tiles_per_batch=tiles_per_batch,
+                            mirror_combinations=mirror_combinations,
+                            mirror_chunks=mirror_chunks,
+                            sparse_tile_threshold=sparse_tile_threshold,
+                            sparse_tile_min_foreground=sparse_tile_min_foreground,
+                            accumulation_dtype=accumulation_dtype,
+                            return_probabilities=return_probabilities,
+                            pipelined=pipelined,
                         )
                     else:
                         res = self._internal_predict_3D_3Dconv(
@@ -185,6 +268,8 @@ class SegmentationNetwork(NeuralNetwork):
                             pad_border_mode,
                             pad_kwargs=pad_kwargs,
                             verbose=verbose,
+                            mirror_combinations=mirror_combinations,
+                            mirror_chunks=mirror_chunks,
                         )
                 elif self.conv_op == nn.Conv2d:
                     if use_sliding_window:
@@ -218,8 +303,111 @@ class SegmentationNetwork(NeuralNetwork):
                         "Invalid conv op, cannot determine what dimensionality (2d/3d) the network is"
                     )
 
+        if channels_last:
+            self._set_inference_memory_format(torch.contiguous_format)
+        torch.set_num_threads(num_threads_before)
+
+        if not return_probabilities:
+            res = (res[0], None)
         return res
 
+    def predict_3D_coarse_to_fine(
+        self,
+        x: np.ndarray,
+        patch_size: Tuple[int, ...],
+        coarse_scale: Union[float, Tuple[float, ...]] = 0.5,
+        roi_margin: Tuple[int, ...] = (8, 16, 16),
+        coarse_predict_kwargs: dict = None,
+        verbose: bool = True,
+        **predict_kwargs
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Two pass inference. A cheap first pass predicts a downsampled version of x (with the same network, without
+        mirroring) to find the bounding box of the foreground. The second pass runs the regular predict_3D only on that
+        region (plus roi_margin voxels on each side) at full resolution. Everything outside of the region is background.
+
+        This only pays off if the foreground is considerably smaller than the image, which is the case for abdominal
+        CT. Organs that the coarse pass misses completely are also missing in the result, so check the Dice on your
+        validation set before using this.
+
+        :param x: (c, x, y, z)
+        :param patch_size: the patch size of the network. Used for both passes
+        :param coarse_scale: factor by which x is downsampled for the coarse pass, either one for all axes or one per
+        axis
+        :param roi_margin: margin (in voxels at full resolution) that is added to the bounding box of the coarse
+        segmentation on each side
+        :param coarse_predict_kwargs: overwrites predict_kwargs for the coarse pass
+        :param predict_kwargs: everything else is passed to predict_3D. use_sliding_window is always True
+        :return: segmentation (x, y, z) and class probabilities (c, x, y, z), just like predict_3D. The class
+        probabilities are None if return_probabilities=False is passed
+        """
+        assert len(x.shape) == 4, "data must have shape (c,x,y,z)"
+        if not isinstance(coarse_scale, (tuple, list)):
+            coarse_scale = [coarse_scale] * 3
+        predict_kwargs["use_sliding_window"] = True
+        predict_kwargs["patch_size"] = patch_size
+        predict_kwargs["verbose"] = verbose
+        regions_class_order = predict_kwargs.get("regions_class_order")
+        return_probabilities = predict_kwargs.get("return_probabilities", True)
+
+        # coarse pass
+        coarse_shape = [max(int(round(i * j)), 1) for i, j in zip(x.shape[1:], coarse_scale)]
+        x_coarse = F.interpolate(
+            torch.from_numpy(x[None].astype(np.float32)),
+            size=coarse_shape,
+            mode="trilinear",
+            align_corners=False,
+        )[0].numpy()
+        coarse_kwargs = dict(predict_kwargs)
+        coarse_kwargs["do_mirroring"] = False
+        coarse_kwargs["return_probabilities"] = False
+        if coarse_predict_kwargs is not None:
+            coarse_kwargs.update(coarse_predict_kwargs)
+        coarse_seg = self.predict_3D(x_coarse, **coarse_kwargs)[0]
+
+        if not np.any(coarse_seg > 0):
+            if verbose:
+                print("coarse pass did not find any foreground, returning background")
+            seg = np.zeros(x.shape[1:], dtype=coarse_seg.dtype)
+            if not return_probabilities:
+                return seg, None
+            probabilities = np.zeros([self.num_classes] + list(x.shape[1:]), dtype=np.float32)
+            if regions_class_order is None:
+                probabilities[0] = 1
+            return seg, probabilities
+
+        # bounding box of the coarse foreground, scaled to full resolution and enlarged by the margin
+        bbox = get_bbox_from_mask(coarse_seg > 0)
+        roi = tuple(
+            slice(
+                max(int(np.floor(lb / f)) - m, 0),
+                min(int(np.ceil(ub / f)) + m, s),
+            )
+            for (lb, ub), f, m, s in zip(bbox, coarse_scale, roi_margin, x.shape[1:])
+        )
+        if verbose:
+            print(
+                "coarse pass: image shape %s, region of interest %s"
+                % (str(x.shape[1:]), str([(i.start, i.stop) for i in roi]))
+            )
+
+        # fine pass
+        seg_roi, probabilities_roi = self.predict_3D(
+            x[(slice(None),) + roi], **predict_kwargs
+        )
+
+        seg = np.zeros(x.shape[1:], dtype=seg_roi.dtype)
+        seg[roi] = seg_roi
+        if probabilities_roi is None:
+            return seg, None
+        probabilities = np.zeros(
+            [probabilities_roi.shape[0]] + list(x.shape[1:]), dtype=probabilities_roi.dtype
+        )
+        if regions_class_order is None:
+            probabilities[0] = 1
+        probabilities[(slice(None),) + roi] = probabilities_roi
+        return seg, probabilities
+
     def predict_2D(
         self,
         x,
@@ -280,7 +468,8 @@ class SegmentationNetwork(NeuralNetwork):
         if verbose:
             print("debug: mirroring", do_mirroring, "mirror_axes", mirror_axes)
 
-        assert self.get_device() != "cpu", "CPU not implemented"
+        if self.get_device() == "cpu" and all_in_gpu:
+            all_in_gpu = False
 
         if pad_kwargs is None:
             pad_kwargs = {"constant_values": 0}
@@ -298,10 +487,7 @@ class SegmentationNetwork(NeuralNetwork):
 
         assert len(x.shape) == 3, "data must have shape (c,x,y)"
 
-        if mixed_precision:
-            context = autocast
-        else:
-            context = no_op
+        context = self._get_inference_context(mixed_precision)
 
         with context():
             with torch.no_grad():
@@ -338,6 +524,21 @@ class SegmentationNetwork(NeuralNetwork):
 
         return res
 
+    def _set_inference_memory_format(self, memory_format):
+        # only the 5d parameters (3d conv weights) have a channels_last_3d representation. nn.Module.to(memory_format=)
+        # would also try to convert 4d parameters and fail
+        for p in self.parameters():
+            if p.dim() == 5:
+                p.data = p.data.contiguous(memory_format=memory_format)
+        self._inference_memory_format = memory_format
+
+    def _get_inference_context(self, mixed_precision: bool):
+        if not mixed_precision:
+            return no_op
+        if self.get_device() == "cpu":
+            return cpu_bfloat16_autocast if cpu_supports_bfloat16() else no_op
+        return autocast
+
     @staticmethod
     def _get_gaussian(patch_size, sigma_scale=1.0 / 8) -> np.ndarray:
         tmp = np.zeros(patch_size)
@@ -398,6 +599,106 @@ class SegmentationNetwork(NeuralNetwork):
 
         return steps
 
+    @staticmethod
+    def _get_sparse_tiles(
+        x: np.ndarray,
+        tiles: List[Tuple[slice, ...]],
+        offsets: Tuple[int, ...],
+        threshold: float,
+        min_foreground: float,
+        downsampling: int = 4,
+    ) -> List[bool]:
+        """
+        Returns for each tile whether it can be skipped because it (almost) only covers air or padding. We threshold a
+        low resolution version of x (every downsampling-th voxel) and fill the holes of the resulting body mask so that
+        air inside the body (lungs, bowel gas) does not count as background.
+
+        :param x: the unpadded input (c, x, y, z)
+        :param tiles: the tiles as slices into the padded input
+        :param offsets: where x starts in the padded input
+        """
+        mask = create_nonzero_mask(
+            x[:, ::downsampling, ::downsampling, ::downsampling] > threshold
+        )
+        is_sparse = []
+        for tile in tiles:
+            # the voxels of x that are sampled in mask are the multiples of downsampling. Anything outside of x is
+            # padding and therefore background
+            tile_in_mask = tuple(
+                slice(
+                    int(np.ceil(max(t.start - o, 0) / downsampling)),
+                    int(np.ceil(max(t.stop - o, 0) / downsampling)),
+                )
+                for t, o in zip(tile, offsets)
+            )
+            num_samples = np.prod(
+                [np.ceil((t.stop - t.start) / downsampling) for t in tile]
+            )
+            foreground = mask[tile_in_mask].sum() / num_samples
+            is_sparse.append(foreground <= min_foreground)
+        return is_sparse
+
+    def _get_tiles_per_batch(
+        self,
+        num_input_channels: int,
+        patch_size: Tuple[int, ...],
+        mirror_axes: tuple,
+        do_mirroring: bool,
+        mirror_combinations: Tuple[Tuple[int, ...], ...] = None,
+        mirror_chunks: int = 1,
+        max_tiles_per_batch: int = 32,
+        verbose: bool = True,
+    ) -> int:
+        """
+        Determines how many tiles fit into one forward pass. We run a single (dummy) tile through the network, measure
+        how much GPU memory that takes and divide the free memory by it. Just like the Gaussian this is cached because
+        it only depends on the patch size and the mirroring configuration.
+        """
+        if self.get_device() == "cpu":
+            return 1
+
+        key = (
+            num_input_channels,
+            tuple(patch_size),
+            tuple(mirror_axes),
+            do_mirroring,
+            None if mirror_combinations is None else tuple(mirror_combinations),
+            mirror_chunks,
+            max_tiles_per_batch,
+        )
+        if self._tiles_per_batch is not None and self._tiles_per_batch[0] == key:
+            return self._tiles_per_batch[1]
+
+        device = self.get_device()
+        dummy = torch.zeros(
+            [1, num_input_channels] + list(patch_size), dtype=torch.float
+        ).cuda(device)
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        memory_before = torch.cuda.memory_allocated(device)
+        _ = self._internal_maybe_mirror_and_pred_3D(
+            dummy, mirror_axes, do_mirroring, None, mirror_combinations, mirror_chunks
+        )
+        torch.cuda.synchronize(device)
+        memory_per_tile = torch.cuda.max_memory_allocated(device) - memory_before
+        del dummy, _
+
+        # memory that is held by the caching allocator but not in use can be handed out to us as well
+        free_memory = torch.cuda.mem_get_info(device)[0] + (
+            torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+        )
+        # keep a safety margin, activations do not necessarily scale perfectly linear with the batch size
+        tiles_per_batch = int(0.8 * free_memory // max(memory_per_tile, 1))
+        tiles_per_batch = int(np.clip(tiles_per_batch, 1, max_tiles_per_batch))
+        if verbose:
+            print(
+                "memory per tile: %.1f MB, free memory: %.1f MB, tiles per batch: %d"
+                % (memory_per_tile / 1024**2, free_memory / 1024**2, tiles_per_batch)
+            )
+
+        self._tiles_per_batch = (key, tiles_per_batch)
+        return tiles_per_batch
+
     def _internal_predict_3D_3Dconv_tiled(
         self,
         x: np.ndarray,
@@ -411,10 +712,17 @@ class SegmentationNetwork(NeuralNetwork):
         pad_kwargs: dict,
         all_in_gpu: bool,
         verbose: bool,
+        tiles_per_batch: Union[int, str] = 1,
+        mirror_combinations: Tuple[Tuple[int, ...], ...] = None,
+        mirror_chunks: int = 1,
+        sparse_tile_threshold: float = None,
+        sparse_tile_min_foreground: float = 0.0,
+        accumulation_dtype: type = np.float32,
+        return_probabilities: bool = True,
+        pipelined: bool = False,
     ) -> Tuple[np.ndarray, np.ndarray]:
         # better safe than sorry
         assert len(x.shape) == 4, "x must be (c, x, y, z)"
-        assert self.get_device() != "cpu"
         if verbose:
             print("step_size:", step_size)
         if verbose:
@@ -460,8 +768,8 @@ class SegmentationNetwork(NeuralNetwork):
                     print("using precomputed Gaussian")
                 gaussian_importance_map = self._gaussian_3d
 
-            gaussian_importance_map = torch.from_numpy(gaussian_importance_map).cuda(
-                self.get_device(), non_blocking=True
+            gaussian_importance_map = to_device(
+                torch.from_numpy(gaussian_importance_map), self.get_device()
             )
 
         else:
@@ -484,7 +792,7 @@ class SegmentationNetwork(NeuralNetwork):
                 add_for_nb_of_preds = gaussian_importance_map
             else:
                 add_for_nb_of_preds = torch.ones(
-                    data.shape[1:], device=self.get_device()
+                    patch_size, dtype=torch.half, device=self.get_device()
                 )
 
             if verbose:
@@ -497,56 +805,232 @@ class SegmentationNetwork(NeuralNetwork):
 
             if verbose:
                 print("moving data to GPU")
-            data = torch.from_numpy(data).cuda(self.get_device(), non_blocking=True)
+            data = to_device(torch.from_numpy(data), self.get_device())
 
             if verbose:
                 print("initializing result_numsamples (on GPU)")
+            # the weights are the same for all classes, one channel is enough
             aggregated_nb_of_predictions = torch.zeros(
-                [self.num_classes] + list(data.shape[1:]),
+                [1] + list(data.shape[1:]),
                 dtype=torch.half,
                 device=self.get_device(),
             )
         else:
             if use_gaussian and num_tiles > 1:
                 add_for_nb_of_preds = self._gaussian_3d
+                if np.finfo(accumulation_dtype).bits < 32:
+                    # float16 can not represent the tail of the Gaussian: its smallest weights would round to 0 (and
+                    # the border of the tiles end up with 0 / 0) or lose all precision. The weights are scaled up by
+                    # the largest power of 2 for which the aggregated (probability weighted) sums can not overflow,
+                    # which cancels out in the normalization. The predictions are weighted with the same map
+                    max_overlap = 1
+                    for axis_steps, axis_size in zip(steps, patch_size):
+                        axis_steps = np.array(axis_steps)
+                        max_overlap *= max(
+                            np.sum((axis_steps <= s) & (axis_steps > s - axis_size))
+                            for s in axis_steps
+                        )
+                    scale = 2.0 ** np.floor(
+                        np.log2(np.finfo(accumulation_dtype).max / 2 / max_overlap)
+                    )
+                    add_for_nb_of_preds = np.maximum(
+                        add_for_nb_of_preds * scale, np.finfo(accumulation_dtype).tiny
+                    ).astype(accumulation_dtype)
+                    gaussian_importance_map = to_device(
+                        torch.from_numpy(add_for_nb_of_preds.astype(np.float32)),
+                        self.get_device(),
+                    )
             else:
-                add_for_nb_of_preds = np.ones(data.shape[1:], dtype=np.float32)
+                # these are added per tile, so they must have the shape of a tile
+                add_for_nb_of_preds = np.ones(patch_size, dtype=np.float32)
 
+            if return_probabilities:
+                aggregated_shape = list(data.shape[1:])
+            else:
+                # we only need to hold the slab of the image that the tiles at the current x position cover. Everything
+                # in front of it is final and goes straight into the segmentation
+                aggregated_shape = [patch_size[0]] + list(data.shape[2:])
+                predicted_segmentation = np.zeros(
+                    data.shape[1:],
+                    dtype=np.uint8 if self.num_classes < 256 else np.int16,
+                )
+            if verbose:
+                print("initializing result arrays with shape", aggregated_shape)
             aggregated_results = np.zeros(
-                [self.num_classes] + list(data.shape[1:]), dtype=np.float32
+                [self.num_classes] + aggregated_shape, dtype=accumulation_dtype
             )
+            # the weights are the same for all classes, one channel is enough
             aggregated_nb_of_predictions = np.zeros(
-                [self.num_classes] + list(data.shape[1:]), dtype=np.float32
+                [1] + aggregated_shape, dtype=accumulation_dtype
             )
 
-        for x in steps[0]:
-            lb_x = x
-            ub_x = x + patch_size[0]
-            for y in steps[1]:
-                lb_y = y
-                ub_y = y + patch_size[1]
-                for z in steps[2]:
-                    lb_z = z
-                    ub_z = z + patch_size[2]
+        if tiles_per_batch == "auto":
+            tiles_per_batch = self._get_tiles_per_batch(
+                data.shape[0],
+                patch_size,
+                mirror_axes,
+                do_mirroring,
+                mirror_combinations,
+                mirror_chunks,
+                verbose=verbose,
+            )
+        assert (
+            isinstance(tiles_per_batch, int) and tiles_per_batch > 0
+        ), "tiles_per_batch must be a positive integer or 'auto'"
+
+        tiles = [
+            (
+                slice(lb_x, lb_x + patch_size[0]),
+                slice(lb_y, lb_y + patch_size[1]),
+                slice(lb_z, lb_z + patch_size[2]),
+            )
+            for lb_x in steps[0]
+            for lb_y in steps[1]
+            for lb_z in steps[2]
+        ]
 
-                    predicted_patch = self._internal_maybe_mirror_and_pred_3D(
-                        data[None, :, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z],
-                        mirror_axes,
-                        do_mirroring,
-                        gaussian_importance_map,
-                    )[0]
+        if sparse_tile_threshold is not None:
+            is_sparse = self._get_sparse_tiles(
+                x,
+                tiles,
+                [i.start for i in slicer[1:]],
+                sparse_tile_threshold,
+                sparse_tile_min_foreground,
+            )
+            sparse_tiles = [t for t, sparse in zip(tiles, is_sparse) if sparse]
+            tiles = [t for t, sparse in zip(tiles, is_sparse) if not sparse]
+            if verbose:
+                print("skipping %d of %d tiles" % (len(sparse_tiles), num_tiles))
+        else:
+            sparse_tiles = []
 
+        def predict_batch(batch_data):
+            return self._internal_maybe_mirror_and_pred_3D(
+                batch_data,
+                mirror_axes,
+                do_mirroring,
+                gaussian_importance_map,
+                mirror_combinations,
+                mirror_chunks,
+            )
+
+        def add_predictions(batch_tiles, predicted_patches):
+            for tile, predicted_patch in zip(batch_tiles, predicted_patches):
+                if streaming:
+                    tile = (slice(0, patch_size[0]),) + tile[1:]
+                aggregated_results[(slice(None),) + tile] += predicted_patch
+                aggregated_nb_of_predictions[
+                    (slice(None),) + tile
+                ] += add_for_nb_of_preds
+
+        if pipelined and not all_in_gpu:
+            # uploads, forward passes, downloads and the aggregation overlap, see TilePipeline
+            pipeline = TilePipeline(predict_batch, self.get_device())
+        else:
+            pipeline = None
+
+        # without the class probabilities we go through the image one x position at a time. The result arrays only hold
+        # the slab [lb_x, lb_x + patch_size[0]) and the tiles are written to them relative to lb_x
+        streaming = not all_in_gpu and not return_probabilities
+        if streaming:
+            tile_groups = [
+                (
+                    lb_x,
+                    [t for t in tiles if t[0].start == lb_x],
+                    [t for t in sparse_tiles if t[0].start == lb_x],
+                )
+                for lb_x in steps[0]
+            ]
+        else:
+            tile_groups = [(0, tiles, sparse_tiles)]
+
+        for group_idx, (lb_x, group_tiles, group_sparse_tiles) in enumerate(
+            tile_groups
+        ):
+            # skipped tiles are predicted as background with full confidence. With regions there is no background
+            # channel, all regions are simply absent
+            for tile in group_sparse_tiles:
+                if streaming:
+                    tile = (slice(0, patch_size[0]),) + tile[1:]
+                if regions_class_order is None:
+                    aggregated_results[(0,) + tile] += add_for_nb_of_preds
+                aggregated_nb_of_predictions[
+                    (slice(None),) + tile
+                ] += add_for_nb_of_preds
+
+            batches = [
+                group_tiles[batch_start : batch_start + tiles_per_batch]
+                for batch_start in range(0, len(group_tiles), tiles_per_batch)
+            ]
+            if pipeline is not None:
+                pipeline.run(
+                    batches,
+                    lambda batch_tiles: np.stack(
+                        [data[(slice(None),) + tile] for tile in batch_tiles]
+                    ),
+                    add_predictions,
+                )
+            else:
+                for batch_tiles in batches:
                     if all_in_gpu:
-                        predicted_patch = predicted_patch.half()
+                        batch_data = torch.stack(
+                            [data[(slice(None),) + tile] for tile in batch_tiles]
+                        )
                     else:
-                        predicted_patch = predicted_patch.cpu().numpy()
+                        batch_data = np.stack(
+                            [data[(slice(None),) + tile] for tile in batch_tiles]
+                        )
+
+                    predicted_patches = predict_batch(batch_data)
+
+                    if all_in_gpu:
+                        predicted_patches = predicted_patches.half()
+                    else:
+                        # one device to host copy per batch, not per tile
+                        predicted_patches = predicted_patches.cpu().numpy()
+
+                    add_predictions(batch_tiles, predicted_patches)
+
+            if streaming:
+                # no tile that comes after this one reaches below the next x position, so everything up to there is
+                # final. The last x position finishes the whole slab
+                if group_idx == len(tile_groups) - 1:
+                    num_final = patch_size[0]
+                else:
+                    num_final = tile_groups[group_idx + 1][0] - lb_x
+
+                if regions_class_order is None:
+                    # all classes are weighted the same, so we can take the argmax without normalizing
+                    predicted_segmentation[lb_x : lb_x + num_final] = aggregated_results[
+                        :, :num_final
+                    ].argmax(0)
+                else:
+                    class_probabilities_here = (
+                        aggregated_results[:, :num_final]
+                        / aggregated_nb_of_predictions[:, :num_final]
+                    )
+                    for i, c in enumerate(regions_class_order):
+                        predicted_segmentation[lb_x : lb_x + num_final][
+                            class_probabilities_here[i] > 0.5
+                        ] = c
+
+                # move the slab forward
+                aggregated_results[:, :-num_final] = aggregated_results[:, num_final:]
+                aggregated_results[:, -num_final:] = 0
+                aggregated_nb_of_predictions[
+                    :, :-num_final
+                ] = aggregated_nb_of_predictions[:, num_final:]
+                aggregated_nb_of_predictions[:, -num_final:] = 0
 
-                    aggregated_results[
-                        :, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z
-                    ] += predicted_patch
-                    aggregated_nb_of_predictions[
-                        :, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z
-                    ] += add_for_nb_of_preds
+        if pipeline is not None:
+            self._tile_pipeline_timings = pipeline.timings
+            if verbose:
+                pipeline.print_timings()
+
+        if streaming:
+            if verbose:
+                print("prediction done")
+            return predicted_segmentation[tuple(slicer[1:])], None
 
         # we reverse the padding here (remeber that we padded the input to be at least as large as the patch size
         slicer = tuple(
@@ -557,10 +1041,14 @@ class SegmentationNetwork(NeuralNetwork):
             + slicer[1:]
         )
         aggregated_results = aggregated_results[slicer]
-        aggregated_nb_of_predictions = aggregated_nb_of_predictions[slicer]
+        aggregated_nb_of_predictions = aggregated_nb_of_predictions[
+            (slice(None),) + slicer[1:]
+        ]
 
-        # computing the class_probabilities by dividing the aggregated result with result_numsamples
-        class_probabilities = aggregated_results / aggregated_nb_of_predictions
+        # computing the class_probabilities by dividing the aggregated result with result_numsamples. This is done in
+        # place so that we do not need another array of the size of the result
+        aggregated_results /= aggregated_nb_of_predictions
+        class_probabilities = aggregated_results
 
         if regions_class_order is None:
             predicted_segmentation = class_probabilities.argmax(0)
@@ -582,7 +1070,10 @@ class SegmentationNetwork(NeuralNetwork):
             if regions_class_order is None:
                 predicted_segmentation = predicted_segmentation.detach().cpu().numpy()
 
-            class_probabilities = class_probabilities.detach().cpu().numpy()
+            if return_probabilities:
+                class_probabilities = class_probabilities.detach().cpu().numpy()
+            else:
+                class_probabilities = None
 
         if verbose:
             print("prediction done")
@@ -603,7 +1094,6 @@ class SegmentationNetwork(NeuralNetwork):
         This one does fully convolutional inference. No sliding window
         """
         assert len(x.shape) == 3, "x must be (c, x, y)"
-        assert self.get_device() != "cpu"
         assert self.input_shape_must_be_divisible_by is not None, (
             "input_shape_must_be_divisible_by must be set to "
             "run _internal_predict_2D_2Dconv"
@@ -657,12 +1147,13 @@ class SegmentationNetwork(NeuralNetwork):
         pad_border_mode: str = "constant",
         pad_kwargs: dict = None,
         verbose: bool = True,
+        mirror_combinations: Tuple[Tuple[int, ...], ...] = None,
+        mirror_chunks: int = 1,
     ) -> Tuple[np.ndarray, np.ndarray]:
         """
         This one does fully convolutional inference. No sliding window
         """
         assert len(x.shape) == 4, "x must be (c, x, y, z)"
-        assert self.get_device() != "cpu"
         assert self.input_shape_must_be_divisible_by is not None, (
             "input_shape_must_be_divisible_by must be set to "
             "run _internal_predict_3D_3Dconv"
@@ -680,7 +1171,12 @@ class SegmentationNetwork(NeuralNetwork):
         )
 
         predicted_probabilities = self._internal_maybe_mirror_and_pred_3D(
-            data[None], mirror_axes, do_mirroring, None
+            data[None],
+            mirror_axes,
+            do_mirroring,
+            None,
+            mirror_combinations,
+            mirror_chunks,
         )[0]
 
         slicer = tuple(
@@ -706,69 +1202,81 @@ class SegmentationNetwork(NeuralNetwork):
 
         return predicted_segmentation, predicted_probabilities
 
+    @staticmethod
+    def _get_mirror_combinations(
+        mirror_axes: tuple,
+        do_mirroring: bool,
+        mirror_combinations: Tuple[Tuple[int, ...], ...] = None,
+    ) -> List[Tuple[int, ...]]:
+        """
+        Returns the mirror combinations that are used for test time augmentation as tuples of (spatial) axes that are
+        flipped together. () is the unmirrored prediction. If mirror_combinations is None this is every combination
+        of mirror_axes (2 ** len(mirror_axes) of them), otherwise it is mirror_combinations
+        """
+        if not do_mirroring:
+            return [()]
+        if mirror_combinations is None:
+            mirror_combinations = [
+                tuple(a for j, a in enumerate(sorted(mirror_axes)) if (i >> j) & 1)
+                for i in range(2 ** len(mirror_axes))
+            ]
+        for c in mirror_combinations:
+            assert all([a in mirror_axes for a in c]), (
+                "mirror combination %s contains axes that are not in mirror_axes %s"
+                % (str(c), str(mirror_axes))
+            )
+        return [tuple(c) for c in mirror_combinations]
+
     def _internal_maybe_mirror_and_pred_3D(
         self,
         x: Union[np.ndarray, torch.tensor],
         mirror_axes: tuple,
         do_mirroring: bool = True,
         mult: np.ndarray or torch.tensor = None,
+        mirror_combinations: Tuple[Tuple[int, ...], ...] = None,
+        mirror_chunks: int = 1,
     ) -> torch.tensor:
+        """
+        All mirrored versions of x are stacked along the batch axis and predicted in mirror_chunks forward passes
+        (instead of one forward pass per mirror combination). The predictions are flipped back and averaged.
+        """
         assert len(x.shape) == 5, "x must be (b, c, x, y, z)"
-        # everything in here takes place on the GPU. If x and mult are not yet on GPU this will be taken care of here
-        # we now return a cuda tensor! Not numpy array!
+        # everything in here takes place on the device of the network. If x and mult are not yet there this will be
+        # taken care of here. We now return a torch tensor! Not numpy array!
 
-        x = to_cuda(maybe_to_torch(x), gpu_id=self.get_device())
+        x = to_device(maybe_to_torch(x), self.get_device())
+        if self._inference_memory_format is not torch.contiguous_format:
+            x = x.contiguous(memory_format=self._inference_memory_format)
         result_torch = torch.zeros(
-            [1, self.num_classes] + list(x.shape[2:]), dtype=torch.float
-        ).cuda(self.get_device(), non_blocking=True)
+            [x.shape[0], self.num_classes] + list(x.shape[2:]), dtype=torch.float
+        ).to(x.device)
 
         if mult is not None:
-            mult = to_cuda(maybe_to_torch(mult), gpu_id=self.get_device())
-
-        if do_mirroring:
-            mirror_idx = 8
-            num_results = 2 ** len(mirror_axes)
-        else:
-            mirror_idx = 1
-            num_results = 1
+            mult = to_device(maybe_to_torch(mult), self.get_device())
 
-        for m in range(mirror_idx):
-            if m == 0:
-                pred = self.inference_apply_nonlin(self(x))
-                result_torch += 1 / num_results * pred
-
-            if m == 1 and (2 in mirror_axes):
-                pred = self.inference_apply_nonlin(self(torch.flip(x, (4,))))
-                result_torch += 1 / num_results * torch.flip(pred, (4,))
-
-            if m == 2 and (1 in mirror_axes):
-                pred = self.inference_apply_nonlin(self(torch.flip(x, (3,))))
-                result_torch += 1 / num_results * torch.flip(pred, (3,))
-
-            if m == 3 and (2 in mirror_axes) and (1 in mirror_axes):
-                pred = self.inference_apply_nonlin(self(torch.flip(x, (4, 3))))
-                result_torch += 1 / num_results * torch.flip(pred, (4, 3))
-
-            if m == 4 and (0 in mirror_axes):
-                pred = self.inference_apply_nonlin(self(torch.flip(x, (2,))))
-                result_torch += 1 / num_results * torch.flip(pred, (2,))
-
-            if m == 5 and (0 in mirror_axes) and (2 in mirror_axes):
-                pred = self.inference_apply_nonlin(self(torch.flip(x, (4, 2))))
-                result_torch += 1 / num_results * torch.flip(pred, (4, 2))
-
-            if m == 6 and (0 in mirror_axes) and (1 in mirror_axes):
-                pred = self.inference_apply_nonlin(self(torch.flip(x, (3, 2))))
-                result_torch += 1 / num_results * torch.flip(pred, (3, 2))
+        # spatial axes -> tensor axes (b, c, x, y, z)
+        flip_dims = [
+            tuple(a + 2 for a in c)
+            for c in self._get_mirror_combinations(
+                mirror_axes, do_mirroring, mirror_combinations
+            )
+        ]
+        num_results = len(flip_dims)
+        mirrors_per_forward = int(np.ceil(num_results / max(mirror_chunks, 1)))
 
-            if (
-                m == 7
-                and (0 in mirror_axes)
-                and (1 in mirror_axes)
-                and (2 in mirror_axes)
-            ):
-                pred = self.inference_apply_nonlin(self(torch.flip(x, (4, 3, 2))))
-                result_torch += 1 / num_results * torch.flip(pred, (4, 3, 2))
+        for chunk_start in range(0, num_results, mirrors_per_forward):
+            chunk = flip_dims[chunk_start : chunk_start + mirrors_per_forward]
+            batch = torch.cat(
+                [torch.flip(x, dims) if len(dims) else x for dims in chunk]
+            )
+            pred = self.inference_apply_nonlin(self(batch))
+            # (mirrors * b, c, x, y, z) -> (mirrors, b, c, x, y, z)
+            pred = pred.view((len(chunk), x.shape[0]) + tuple(pred.shape[1:]))
+            for i, dims in enumerate(chunk):
+                if len(dims):
+                    # flip the prediction back so that it is aligned with x again
+                    pred[i] = torch.flip(pred[i], dims)
+            result_torch += pred.sum(0) / num_results
 
         if mult is not None:
             result_torch[:, :] *= mult
@@ -786,13 +1294,13 @@ class SegmentationNetwork(NeuralNetwork):
         # we now return a cuda tensor! Not numpy array!
         assert len(x.shape) == 4, "x must be (b, c, x, y)"
 
-        x = to_cuda(maybe_to_torch(x), gpu_id=self.get_device())
+        x = to_device(maybe_to_torch(x), self.get_device())
         result_torch = torch.zeros(
             [x.shape[0], self.num_classes] + list(x.shape[2:]), dtype=torch.float
-        ).cuda(self.get_device(), non_blocking=True)
+        ).to(x.device)
 
         if mult is not None:
-            mult = to_cuda(maybe_to_torch(mult), gpu_id=self.get_device())
+            mult = to_device(maybe_to_torch(mult), self.get_device())
 
         if do_mirroring:
             mirror_idx = 4
@@ -839,7 +1347,6 @@ class SegmentationNetwork(NeuralNetwork):
     ) -> Tuple[np.ndarray, np.ndarray]:
         # better safe than sorry
         assert len(x.shape) == 3, "x must be (c, x, y)"
-        assert self.get_device() != "cpu"
         if verbose:
             print("step_size:", step_size)
         if verbose:
@@ -885,8 +1392,8 @@ class SegmentationNetwork(NeuralNetwork):
                     print("using precomputed Gaussian")
                 gaussian_importance_map = self._gaussian_2d
 
-            gaussian_importance_map = torch.from_numpy(gaussian_importance_map).cuda(
-                self.get_device(), non_blocking=True
+            gaussian_importance_map = to_device(
+                torch.from_numpy(gaussian_importance_map), self.get_device()
             )
         else:
             gaussian_importance_map = None
@@ -921,7 +1428,7 @@ class SegmentationNetwork(NeuralNetwork):
 
             if verbose:
                 print("moving data to GPU")
-            data = torch.from_numpy(data).cuda(self.get_device(), non_blocking=True)
+            data = to_device(torch.from_numpy(data), self.get_device())
 
             if verbose:
                 print("initializing result_numsamples (on GPU)")
@@ -10,7 +10,15 @@ from torch.autograd import Function
 from torch.nn.modules.utils import _triple
 from torch.autograd.function import once_differentiable
 
-import D3D
+try:
+    import D3D
+except ImportError:
+    # the extension is not built (see dcn/setup.py), DeformConvFunction falls back to plain PyTorch
+    D3D = None
+
+from d_lka_former.network_architecture.synapse.deform_conv_torch import (
+    DeformConvFunctionTorch,
+)
 
 
 class DeformConvFunction(Function):
@@ -98,3 +106,7 @@ class DeformConvFunction(Function):
             None,
             None,
         )
+
+
+if D3D is None:
+    DeformConvFunction = DeformConvFunctionTorch
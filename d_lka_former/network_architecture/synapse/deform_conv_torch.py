@@ -0,0 +1,101 @@
+import torch
+import torch.nn.functional as F
+from torch.nn.modules.utils import _triple
+
+
+def deform_conv3d(
+    input, offset, weight, bias, stride, padding, dilation, groups, deformable_groups
+):
+    """
+    3D deformable convolution in plain PyTorch, with the semantics of the D3D extension (dcn/src): every input channel
+    is sampled at the deformed kernel positions of every output voxel with one F.grid_sample (trilinear, zero outside
+    of the volume) and the samples are multiplied with the weight of each group. It needs about as much memory as the
+    columns of the extension and autograd computes the backward. At exactly integer sampling positions the gradient of
+    the offsets may be the one sided difference of the other side than the one of the extension
+
+    :param input: (b, c, d, h, w)
+    :param offset: (b, deformable_groups * kd * kh * kw * 3, od, oh, ow), (d, h, w) offset of every kernel tap
+    :param weight: (c_out, c / groups, kd, kh, kw)
+    :param bias: (c_out,) or None
+    :return: (b, c_out, od, oh, ow)
+    """
+    stride, padding, dilation = _triple(stride), _triple(padding), _triple(dilation)
+    b, c = input.shape[:2]
+    size = input.shape[2:]
+    c_out = weight.shape[0]
+    kernel_size = weight.shape[2:]
+    out_size = [
+        (s + 2 * p - (d * (k - 1) + 1)) // st + 1
+        for s, p, d, k, st in zip(size, padding, dilation, kernel_size, stride)
+    ]
+    taps = kernel_size[0] * kernel_size[1] * kernel_size[2]
+    assert offset.shape[1] == deformable_groups * taps * 3 and list(
+        offset.shape[2:]
+    ) == list(out_size), "offset shape %s does not fit" % str(tuple(offset.shape))
+
+    offset = offset.reshape(b * deformable_groups, *kernel_size, 3, *out_size)
+    grid = []
+    for axis in range(3):
+        # position of each kernel tap (rows) for each output voxel (columns) along this axis without offset
+        position = torch.arange(
+            kernel_size[axis], device=input.device, dtype=input.dtype
+        )[:, None] * dilation[axis] + (
+            torch.arange(out_size[axis], device=input.device, dtype=input.dtype)[None]
+            * stride[axis]
+            - padding[axis]
+        )
+        shape = [1] * 6
+        shape[axis], shape[3 + axis] = kernel_size[axis], out_size[axis]
+        position = offset[:, :, :, :, axis] + position.view(shape)
+        # align_corners=False: -1 and 1 are the outer borders of the first and the last voxel
+        grid.append((2 * position + 1) / size[axis] - 1)
+    # grid_sample wants (x, y, z), that is (w, h, d)
+    grid = torch.stack(grid[::-1], -1).view(
+        b * deformable_groups, taps * out_size[0], out_size[1], out_size[2], 3
+    )
+
+    columns = F.grid_sample(
+        input.reshape(b * deformable_groups, c // deformable_groups, *size),
+        grid,
+        mode="bilinear",
+        padding_mode="zeros",
+        align_corners=False,
+    )
+    # (b * deformable_groups, c / deformable_groups, taps * od, oh, ow) -> (b, groups, c / groups * taps, od * oh * ow)
+    columns = columns.view(b, groups, c // groups * taps, -1)
+    output = torch.matmul(weight.view(groups, c_out // groups, -1), columns)
+    output = output.view(b, c_out, *out_size)
+    if bias is not None:
+        output = output + bias.view(1, c_out, 1, 1, 1)
+    return output
+
+
+class DeformConvFunctionTorch(object):
+    """
+    Stands in for DeformConvFunction if D3D is not importable: apply takes the same arguments (im2col_step is ignored)
+    """
+
+    @staticmethod
+    def apply(
+        input,
+        offset,
+        weight,
+        bias,
+        stride,
+        padding,
+        dilation,
+        group,
+        deformable_groups,
+        im2col_step,
+    ):
+        return deform_conv3d(
+            input,
+            offset,
+            weight,
+            bias,
+            stride,
+            padding,
+            dilation,
+            group,
+            deformable_groups,
+        )
@@ -1,9 +1,11 @@
+from contextlib import contextmanager, nullcontext
 from typing import Optional, Sequence, Tuple, Union, Any
 
 import numpy as np
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 
 from timm.models.layers import trunc_normal_
 
@@ -11,7 +13,13 @@ from monai.networks.blocks.convolutions import Convolution
 from monai.networks.layers.factories import Act, Norm
 
 
-__all__ = ["BaseBlock", "get_conv_layer", "get_padding", "get_output_padding"]
+__all__ = [
+    "BaseBlock",
+    "StageCheckpointing",
+    "get_conv_layer",
+    "get_padding",
+    "get_output_padding",
+]
 
 
 class BaseBlock(nn.Module):
@@ -28,6 +36,67 @@ class BaseBlock(nn.Module):
             nn.init.constant_(m.weight, 1.0)
 
 
+@contextmanager
+def frozen_batch_norm_statistics(module):
+    """
+    the forward pass that checkpointing repeats in backward must not update the running statistics a second time
+    """
+    # momentum 0 keeps the running mean and variance, the counter has to be reset afterwards (the running statistics
+    # themselves can not be, backward needs them unmodified)
+    norms = [
+        m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)
+    ]
+    momenta = [m.momentum for m in norms]
+    counts = [
+        None if m.num_batches_tracked is None else m.num_batches_tracked.clone()
+        for m in norms
+    ]
+    for m in norms:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, momentum, count in zip(norms, momenta, counts):
+            m.momentum = momentum
+            if count is not None:
+                m.num_batches_tracked.copy_(count)
+
+
+class StageCheckpointing:
+    """
+    Mixin for blocks that run their stages through run_stage: stages whose index is in checkpoint_stages keep only
+    their inputs for backward and recompute everything else there (activation checkpointing). Set by
+    lhunet.checkpointing.set_checkpointing, which also explains the stage names
+    """
+
+    checkpoint_stages = ()
+    # context manager factory (block, stage index, stage inputs), see lhunet.checkpointing.profile_stages
+    stage_observer = None
+
+    @property
+    def num_stages(self):
+        raise NotImplementedError
+
+    def run_stage(self, index, function, *args):
+        observer = (
+            nullcontext()
+            if self.stage_observer is None
+            else self.stage_observer(self, index, args)
+        )
+        with observer:
+            if index in self.checkpoint_stages and torch.is_grad_enabled():
+                return checkpoint(
+                    function,
+                    *args,
+                    use_reentrant=False,
+                    context_fn=lambda: (
+                        nullcontext(),
+                        frozen_batch_norm_statistics(self),
+                    ),
+                )
+            return function(*args)
+
+
 def get_conv_layer(
     spatial_dims: int,
     in_channels: int,
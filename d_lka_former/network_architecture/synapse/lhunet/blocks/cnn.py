@@ -390,7 +390,7 @@ class CNNEncoder(BaseBlock):
         layer_features = []
         for block in self.encoder_blocks:
             x = block(x)
-            layer_features.append(x.clone())
+            layer_features.append(x)
         return x, layer_features
 
 
@@ -481,5 +481,5 @@ class CNNDecoder(BaseBlock):
 
             x = conv(x)
             if return_outs:
-                outs.append(x.clone())
+                outs.append(x)
         return (x, outs) if return_outs else x
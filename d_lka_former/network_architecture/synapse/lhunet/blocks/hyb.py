@@ -42,7 +42,7 @@ from ..modules.vit.new import (
     HybAttn_DLKA3D_Parallel_ChannelViT
 )
 
-from .base import BaseBlock, get_conv_layer
+from .base import BaseBlock, StageCheckpointing, get_conv_layer
 from .cnn import get_cnn_block
 
 
@@ -107,7 +107,7 @@ class BaseHybridBlock():
 
 
 
-class HybridEncoder(BaseBlock, BaseHybridBlock):
+class HybridEncoder(BaseBlock, BaseHybridBlock, StageCheckpointing):
     def __init__(
         self,
         in_channels: int,
@@ -202,30 +202,38 @@ class HybridEncoder(BaseBlock, BaseHybridBlock):
 
         self.apply(self._init_weights)
 
+    @property
+    def num_stages(self):
+        return len(self.downs)
+
+    def stage(self, i, x):
+        down, vit, conv = self.downs[i], self.vits[i], self.convs[i]
+        x = down(x)
+        if self.arch_mode == "sequential":
+            x = conv(vit(x))
+        elif self.arch_mode == "residual":
+            x = self.combine([x, vit(x)])
+            x = conv(x)
+        elif self.arch_mode == "parallel":
+            x = self.combine([x, vit(x), conv(x)])
+        elif self.arch_mode == "collective":
+            x_v = vit(x)
+            x = conv(self.combine([x, x_v]))
+            x = self.combine([x, x_v])
+        else:
+            raise NotImplementedError("Not implementer Arch. for Hybrid Encoder!")
+        return x
+
     def forward(self, x):
         layer_features = []
-        for down, vit, conv in zip(self.downs, self.vits, self.convs):
-            x = down(x)
-            if self.arch_mode == "sequential":
-                x = conv(vit(x))
-            elif self.arch_mode == "residual":
-                x = self.combine([x, vit(x)])
-                x = conv(x)
-            elif self.arch_mode == "parallel":
-                x = self.combine([x, vit(x), conv(x)])
-            elif self.arch_mode == "collective":
-                x_v = vit(x)
-                x = conv(self.combine([x, x_v]))
-                x = self.combine([x, x_v])
-            else:
-                raise NotImplementedError("Not implementer Arch. for Hybrid Encoder!")
-            
-            layer_features.append(x.clone())
+        for i in range(len(self.downs)):
+            x = self.run_stage(i, self.stage, i, x)
+            layer_features.append(x)
         return x, layer_features
 
 
         
-class HybridDecoder(BaseBlock, BaseHybridBlock):
+class HybridDecoder(BaseBlock, BaseHybridBlock, StageCheckpointing):
     def __init__(self,
         in_channels, skip_channels, features,
         
@@ -344,31 +352,38 @@ class HybridDecoder(BaseBlock, BaseHybridBlock):
         self.apply(self._init_weights)
 
 
+    @property
+    def num_stages(self):
+        return len(self.ups)
+
+    def stage(self, i, x, skip):
+        up, conv, vit, conv_o = self.ups[i], self.convs[i], self.vits[i], self.convs_o[i]
+        x = up(x)
+        if self.skip_mode=="sum":
+            x = x + skip
+        else:
+            x = torch.cat((x, skip), dim=1)
+        
+        if self.arch_mode == "sequential":
+            x = conv_o(vit(x))
+        elif self.arch_mode == "residual":
+            x = self.combine([x, vit(x)])
+            x = conv_o(x)
+        elif self.arch_mode == "parallel":
+            x = self.combine([x, vit(x), conv(x)])
+            x = conv_o(x)
+        elif self.arch_mode == "sequential-lite":
+            x = vit(conv_o(x))
+        elif self.arch_mode == "collective":
+            x = conv_o(x)
+            x = self.combine([x, vit(x)])
+        else:
+            raise NotImplementedError("Not implementer Arch. for Hybrid Decoder!")
+        return x
+
     def forward(self, x, skips:list, return_outs=False):
         outs = []
-        for up, conv, vit, conv_o in zip(self.ups, self.convs, self.vits, self.convs_o):
-            
-            x = up(x)
-            if self.skip_mode=="sum":
-                x = x + skips.pop()
-            else:
-                x = torch.cat((x, skips.pop()), dim=1)
-            
-            if self.arch_mode == "sequential":
-                x = conv_o(vit(x))
-            elif self.arch_mode == "residual":
-                x = self.combine([x, vit(x)])
-                x = conv_o(x)
-            elif self.arch_mode == "parallel":
-                x = self.combine([x, vit(x), conv(x)])
-                x = conv_o(x)
-            elif self.arch_mode == "sequential-lite":
-                x = vit(conv_o(x))
-            elif self.arch_mode == "collective":
-                x = conv_o(x)
-                x = self.combine([x, vit(x)])
-            else:
-                raise NotImplementedError("Not implementer Arch. for Hybrid Decoder!")
-            
-            if return_outs: outs.append(x.clone())
+        for i in range(len(self.ups)):
+            x = self.run_stage(i, self.stage, i, x, skips.pop())
+            if return_outs: outs.append(x)
         return (x, outs) if return_outs else x
@@ -23,6 +23,7 @@ from .modules.vit.transformers import (
 )
 
 from timm.models.layers import trunc_normal_
+from .blocks.base import StageCheckpointing
 from monai.networks.layers.utils import get_norm_layer
 from .modules.layers import LayerNorm
 from .modules.dynunet_blocks import get_conv_layer, UnetResBlock
@@ -31,7 +32,7 @@ from .modules.dynunet_blocks import get_padding
 from functools import partial
 
 
-class BridgeModule(nn.Module):
+class BridgeModule(nn.Module, StageCheckpointing):
     def __init__(
         self,
         feats: list[int],
@@ -96,50 +97,81 @@ class BridgeModule(nn.Module):
     #                 nn.BatchNorm3d(f1)
     #             )
 
-    def _aggregate(self, skips, out_shape):
-        feat = out_shape[1]
-        special_shape = out_shape[2:]
-        agg = torch.zeros(out_shape).to(skips[0].device)
+    def _aggregate(self, skips):
+        """
+        the multi-scale inputs of the m_atts, for all levels at once: for every level the sum over all skips of
+        projs[f"{skip channels}->{level channels}"](skip) (nearest) resized to the level. The projections are
+        pointwise and commute with nearest resizing, so each one runs at the lower of the two resolutions, and the
+        projections of a skip to the levels at least as large as itself share one convolution
+
+        :return: list of aggregates, in the order of the levels (skips[::-1])
+        """
+        levels = skips[::-1][: self.num_stages]
+        terms = [[] for _ in levels]
         for skip in skips:
-            #             if (skip.shape == out_shape).all(): continue
-            ps = self.projs[f"{skip.shape[1]}->{feat}"](skip)
-            ps = F.interpolate(ps, size=special_shape)
-            #             ps = self.proj_norms[f"{skip.shape[1]}->{feat}"](ps)
-            agg = agg + ps
-        #         agg = self.proj_norms[f"n{feat}"](agg)
-        return agg
+            size = skip.shape[2:]
+            up = [
+                i for i, x in enumerate(levels) if x.shape[2:].numel() >= size.numel()
+            ]
+            if len(up) > 0:
+                projs = [
+                    self.projs[f"{skip.shape[1]}->{levels[i].shape[1]}"] for i in up
+                ]
+                ps = F.conv3d(
+                    skip,
+                    torch.cat([proj[0].weight for proj in projs]),
+                    torch.cat([proj[0].bias for proj in projs]),
+                )
+                ps = projs[0][1](ps).split([proj[0].out_channels for proj in projs], 1)
+                for i, p in zip(up, ps):
+                    if levels[i].shape[2:] != size:
+                        p = F.interpolate(p, size=levels[i].shape[2:])
+                    terms[i].append(p)
+            for i, x in enumerate(levels):
+                if i not in up:
+                    proj = self.projs[f"{skip.shape[1]}->{x.shape[1]}"]
+                    terms[i].append(proj(F.interpolate(skip, size=x.shape[2:])))
+
+        aggregates = []
+        for ps in terms:
+            agg = ps[0]
+            for p in ps[1:]:
+                agg = agg + p
+            aggregates.append(agg)
+        return aggregates
+
+    @property
+    def num_stages(self):
+        return len(self.norms)
+
+    def stage(self, i, x, last_x, aggregate):
+        ca, sa, ma, norm = self.c_atts[i], self.s_atts[i], self.m_atts[i], self.norms[i]
+        skip = x
+        if i > 0:
+            x = x + self.ups[i - 1](last_x)
+
+        c_att = ca(skip) if self.use_c else 0
+        s_att = sa(x) if self.use_c else 0
+        m_att = ma(skip + aggregate) if self.use_m else 0
+
+        if self.use_weigths:
+            att = self.c_w[i] * c_att + self.s_w[i] * s_att + self.m_w[i] * m_att
+        else:
+            att = c_att + s_att + m_att
+
+        #         att = F.layer_norm(att, normalized_shape=att.shape[2:])
+        #         x = F.layer_norm(x, normalized_shape=x.shape[2:])
+
+        return norm(att + x)
 
     def forward(self, *skips):
-        i = 0
+        levels = skips[::-1][: self.num_stages]
+        aggregates = self._aggregate(skips) if self.use_m else [None] * len(levels)
         last_x = None
         outs = []
-        for x, ca, sa, ma, norm in zip(
-            skips[::-1],
-            self.c_atts,
-            self.s_atts,
-            self.m_atts,
-            self.norms,  # , self.norms_atts, self.norms_x
-        ):
-            _x = x.clone()
-            if i > 0:
-                x = x + self.ups[i - 1](last_x)
-
-            c_att = ca(_x) if self.use_c else 0
-            s_att = sa(x) if self.use_c else 0
-            m_att = ma(_x + self._aggregate(skips, x.shape)) if self.use_m else 0
-
-            if self.use_weigths:
-                att = self.c_w[i] * c_att + self.s_w[i] * s_att + self.m_w[i] * m_att
-            else:
-                att = c_att + s_att + m_att
-
-            #             att = F.layer_norm(att, normalized_shape=att.shape[2:])
-            #             x = F.layer_norm(x, normalized_shape=x.shape[2:])
-
-            x = norm(att + x)
+        for i, (x, aggregate) in enumerate(zip(levels, aggregates)):
+            x = self.run_stage(i, self.stage, i, x, last_x, aggregate)
             outs.append(x)
-
-            last_x = x.clone()
-            i += 1
+            last_x = x
 
         return outs[::-1]
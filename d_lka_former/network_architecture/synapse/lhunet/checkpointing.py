@@ -0,0 +1,150 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import time
+
+import torch
+
+from .blocks.base import StageCheckpointing
+
+__all__ = ["set_checkpointing", "profile_stages", "plan_checkpointing"]
+
+
+# A stage is named after the block it belongs to and its index there, e.g. "hyb_encoder.0" (the first, highest
+# resolution stage of LHUNet's HybridEncoder), "hyb_decoder.2" (the last stage of the HybridDecoder) or "bridge.1"
+
+
+def _stage_blocks(model):
+    return [
+        (name, module)
+        for name, module in model.named_modules()
+        if isinstance(module, StageCheckpointing)
+    ]
+
+
+def set_checkpointing(model, stages):
+    """
+    Checkpoints the given stages of model (and no others): their activations are recomputed in backward instead of
+    being kept from the forward pass
+
+    :param model:
+    :param stages: list of stage names, None or [] turns checkpointing off
+    :return: model
+    """
+    stages = set(stages or [])
+    blocks = _stage_blocks(model)
+    unknown = stages - {
+        "%s.%d" % (name, i) for name, block in blocks for i in range(block.num_stages)
+    }
+    if len(unknown) > 0:
+        raise ValueError("Unknown stages: %s" % str(sorted(unknown)))
+    for name, block in blocks:
+        block.checkpoint_stages = tuple(
+            i for i in range(block.num_stages) if "%s.%d" % (name, i) in stages
+        )
+    return model
+
+
+def _storage(tensor):
+    return tensor.untyped_storage().data_ptr()
+
+
+def profile_stages(model, example_input):
+    """
+    One training forward and backward pass of example_input (without checkpointing). Weights, running statistics and
+    gradients of model are the same as before afterwards
+
+    :return: OrderedDict stage name -> (bytes kept for backward, seconds of forward), the bytes of all activations kept
+    for backward and the peak memory of the step (bytes, CUDA only, None on the CPU)
+    """
+    blocks = _stage_blocks(model)
+    checkpoint_stages = [block.checkpoint_stages for _, block in blocks]
+    names = {id(block): name for name, block in blocks}
+    state = {k: v.clone() for k, v in model.state_dict().items()}
+    parameters = {_storage(p) for p in model.parameters()}
+    cuda = example_input.is_cuda
+
+    seen = set()
+    stats = OrderedDict()
+    current = []
+    total = [0]
+
+    def pack(tensor):
+        storage = _storage(tensor)
+        if storage not in parameters and storage not in seen:
+            seen.add(storage)
+            nbytes = tensor.untyped_storage().nbytes()
+            total[0] += nbytes
+            if len(current) > 0:
+                stats[current[-1]][0] += nbytes
+        return tensor
+
+    @contextmanager
+    def observer(block, index, args):
+        name = "%s.%d" % (names[id(block)], index)
+        stats[name] = [0, 0.0]
+        # the inputs of a checkpointed stage are kept anyway
+        seen.update(_storage(a) for a in args if isinstance(a, torch.Tensor))
+        current.append(name)
+        if cuda:
+            torch.cuda.synchronize()
+        start = time()
+        yield
+        if cuda:
+            torch.cuda.synchronize()
+        stats[name][1] = time() - start
+        current.pop()
+
+    set_checkpointing(model, None)
+    for _, block in blocks:
+        block.stage_observer = observer
+    training = model.training
+    model.train()
+    if cuda:
+        torch.cuda.reset_peak_memory_stats()
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            output = model(example_input)
+        if not isinstance(output, torch.Tensor):
+            output = sum(o.float().mean() for o in output)
+        output.float().mean().backward()
+        del output
+        peak = torch.cuda.max_memory_allocated() if cuda else None
+    finally:
+        for (_, block), stages in zip(blocks, checkpoint_stages):
+            block.stage_observer = None
+            block.checkpoint_stages = stages
+        model.train(training)
+        model.load_state_dict(state)
+        model.zero_grad(set_to_none=True)
+    return OrderedDict((k, tuple(v)) for k, v in stats.items()), total[0], peak
+
+
+def plan_checkpointing(model, example_input, memory_budget, extra_memory=0):
+    """
+    Picks the stages to checkpoint so that a training step of example_input fits into memory_budget. Stages are taken
+    greedily, most bytes saved per second of recomputation first, until the estimate fits. The estimate is the
+    measured peak of profile_stages (on the CPU: parameters, gradients and all activations) minus the bytes kept by
+    the checkpointed stages, plus extra_memory (e.g. the momentum of the optimizer, which the dry run does not have)
+
+    :param model:
+    :param example_input: a batch of the size training will use
+    :param memory_budget: bytes
+    :param extra_memory: bytes
+    :return: list of stage names (the first configuration that fits, all stages if none does) and a list of
+    (stage names, estimated peak bytes, estimated extra seconds per step) for every configuration considered
+    """
+    stats, total, peak = profile_stages(model, example_input)
+    if peak is None:
+        peak = total + 2 * sum(p.numel() * p.element_size() for p in model.parameters())
+    peak += extra_memory
+    order = sorted(stats, key=lambda s: -stats[s][0] / max(stats[s][1], 1e-6))
+
+    configurations = [([], peak, 0.0)]
+    for stage in order:
+        stages, memory, seconds = configurations[-1]
+        if memory <= memory_budget:
+            break
+        configurations.append(
+            (stages + [stage], memory - stats[stage][0], seconds + stats[stage][1])
+        )
+    return configurations[-1][0], configurations
@@ -0,0 +1,151 @@
+import copy
+
+import torch
+from torch import nn
+
+from .blocks.cnn import DCNNBlock, UnetBasicBlock, UnetResBlock
+from .modules import dynunet_blocks
+from .modules.cnn.attentions import DLKA3D, DLKA3D_Static, LKA3D_5731
+
+__all__ = ["fuse_for_inference", "fold_batch_norm", "merge_pointwise"]
+
+
+# blocks whose forward applies each of these batch norms directly to the output of the convolution next to it
+conv_norm_pairs = (
+    (
+        (UnetResBlock, dynunet_blocks.UnetResBlock),
+        (("conv1", "norm1"), ("conv2", "norm2"), ("conv3", "norm3")),
+    ),
+    (
+        (UnetBasicBlock, dynunet_blocks.UnetBasicBlock),
+        (("conv1", "norm1"), ("conv2", "norm2")),
+    ),
+    # the dropout in between is gone in eval mode
+    ((DCNNBlock,), (("dconv", "norm"),)),
+)
+
+# blocks whose forward applies the 1x1 convolution (second name) directly to the output of the first one. The depthwise
+# convolutions in front of them are not merged: the zero padding of the intermediate result makes that inexact at the
+# borders, and a depthwise followed by a pointwise convolution would become a much more expensive dense one
+conv_pointwise_pairs = (
+    ((DLKA3D, DLKA3D_Static), (("deform_conv", "conv1"),)),
+    ((LKA3D_5731,), (("conv3", "conv1"),)),
+)
+
+
+def _unwrap(layer):
+    # monai's Convolution (get_conv_layer with conv_only=True) is a Sequential holding just the convolution
+    if isinstance(layer, nn.Sequential) and len(layer) == 1:
+        return layer[0]
+    return layer
+
+
+def fold_batch_norm(conv, norm):
+    """
+    Folds an eval mode batch norm into the weight and bias of the (not transposed) convolution in front of it, so that
+    conv(x) equals norm(conv(x)) of before. DeformConv works as well, only its weight and bias are changed
+
+    :return: False (and nothing changed) if norm does not keep running statistics
+    """
+    if norm.running_mean is None or getattr(conv, "transposed", False):
+        return False
+    with torch.no_grad():
+        scale = torch.rsqrt(norm.running_var + norm.eps)
+        shift = -norm.running_mean * scale
+        if norm.affine:
+            scale = scale * norm.weight
+            shift = shift * norm.weight + norm.bias
+        bias = shift if conv.bias is None else conv.bias * scale + shift
+        conv.weight.mul_(scale.view(-1, *[1] * (conv.weight.dim() - 1)))
+    conv.bias = nn.Parameter(bias)
+    return True
+
+
+def merge_pointwise(conv, pointwise):
+    """
+    Merges a 1x1 convolution into the convolution whose output it is applied to: afterwards conv(x) equals
+    pointwise(conv(x)) of before, at the cost of conv alone. Both must be ungrouped
+
+    :return: False (and nothing changed) if the two can not be merged
+    """
+    if (
+        conv.groups != 1
+        or pointwise.groups != 1
+        or any(k != 1 for k in pointwise.kernel_size)
+        or any(s != 1 for s in pointwise.stride)
+        or any(p != 0 for p in pointwise.padding)
+    ):
+        return False
+    with torch.no_grad():
+        mixing = pointwise.weight.flatten(1)
+        weight = torch.einsum("oc,c...->o...", mixing, conv.weight)
+        bias = pointwise.bias
+        if conv.bias is not None:
+            bias = mixing @ conv.bias if bias is None else mixing @ conv.bias + bias
+    conv.weight = nn.Parameter(weight)
+    conv.bias = None if bias is None else nn.Parameter(bias)
+    return True
+
+
+def check_parity(model, fused, example_input, rtol=1e-4):
+    """
+    Raises a RuntimeError if the outputs of model (in eval mode) and fused differ by more than rtol times the largest
+    output magnitude
+    """
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        expected, output = model(example_input), fused(example_input)
+    model.train(training)
+    if isinstance(expected, torch.Tensor):
+        expected, output = [expected], [output]
+    for e, o in zip(expected, output):
+        error = (e - o).abs().max().item()
+        if not error <= rtol * e.abs().max().item():
+            raise RuntimeError(
+                "The fused network deviates from the original one by up to %s (largest output %s)"
+                % (error, e.abs().max().item())
+            )
+
+
+def fuse_for_inference(model, example_input=None):
+    """
+    Eval only copy of model (usually an LHUNet) for faster forward passes: the batch norms of the CNN blocks are folded
+    into the convolutions in front of them, the 1x1 convolutions that directly follow the deformable (or dense)
+    convolution of the LKA attentions are merged into it and all dropouts are removed. The copy computes the same as
+    model.eval() up to floating point rounding and has gradients disabled. Train and keep saving model, not the copy
+
+    :param model:
+    :param example_input: if given, the outputs of model and the copy for this input are compared (see check_parity)
+    :return: the fused copy, with is_fused = True
+    """
+    fused = copy.deepcopy(model).eval()
+
+    for module in list(fused.modules()):
+        for types, pairs in conv_norm_pairs:
+            if not isinstance(module, types):
+                continue
+            for conv_name, norm_name in pairs:
+                norm = getattr(module, norm_name, None)
+                if isinstance(
+                    norm, nn.modules.batchnorm._BatchNorm
+                ) and fold_batch_norm(_unwrap(getattr(module, conv_name)), norm):
+                    setattr(module, norm_name, nn.Identity())
+        for types, pairs in conv_pointwise_pairs:
+            if not isinstance(module, types):
+                continue
+            for conv_name, pointwise_name in pairs:
+                if merge_pointwise(
+                    getattr(module, conv_name), getattr(module, pointwise_name)
+                ):
+                    setattr(module, pointwise_name, nn.Identity())
+        # these are no-ops in eval mode anyway, but still a module call each
+        for name, child in module.named_children():
+            if isinstance(child, nn.modules.dropout._DropoutNd):
+                setattr(module, name, nn.Identity())
+    fused.requires_grad_(False)
+    fused.is_fused = True
+
+    if example_input is not None:
+        check_parity(model, fused, example_input)
+    return fused
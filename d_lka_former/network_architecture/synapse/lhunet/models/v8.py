@@ -351,9 +351,9 @@ class LHUNet(BaseBlock, SegmentationNetwork):
         # self.apply(self._init_weights)
 
     def forward(self, x):
-        in_x = x.clone()
+        in_x = x
         x = self.init(x)
-        r = x.clone()
+        r = x
 
         x, cnn_skips = self.cnn_encoder(x)
         x, hyb_skips = self.hyb_encoder(x)
@@ -35,11 +35,10 @@ class LKA3D_571(nn.Module):
         self.conv1 = nn.Conv3d(dim, dim, 1)
 
     def forward(self, x):
-        u = x.clone()
         attn = self.conv5(x)
         attn = self.conv_spatial(attn)
         attn = self.conv1(attn)
-        return u * attn
+        return x * attn
 
 
 class LKA3D_5731(nn.Module):
@@ -51,12 +50,11 @@ class LKA3D_5731(nn.Module):
         self.conv1 = nn.Conv3d(dim, dim, 1)
 
     def forward(self, x):
-        u = x.clone()        
         attn = self.conv5(x)
         attn = self.conv_lk(attn)
         attn = self.conv3(attn)
         attn = self.conv1(attn)
-        return u * attn
+        return x * attn
 
 
 class DLKA3D(nn.Module):
@@ -89,13 +87,12 @@ class DLKA3D(nn.Module):
         self.conv1 = nn.Conv3d(dim, dim, 1)
 
     def forward(self, x):
-        u = x.clone()        
         attn = self.conv0(x)
         attn = self.conv_spatial(attn)
         attn = attn.contiguous()
         attn = self.deform_conv(attn)
         attn = self.conv1(attn)
-        return u * attn
+        return x * attn
     
 
 class DLKA3D_Static(nn.Module):
@@ -128,13 +125,12 @@ class DLKA3D_Static(nn.Module):
         self.conv1 = nn.Conv3d(dim, dim, 1)
 
     def forward(self, x):
-        u = x.clone()        
         attn = self.conv0(x)
         attn = self.conv_spatial(attn)
         attn = attn.contiguous()
         attn = self.deform_conv(attn)
         attn = self.conv1(attn)
-        return u * attn
+        return x * attn
     
 
 
@@ -150,7 +146,6 @@ class DLKA3D_Block_onTensor(nn.Module):
         self.proj_2 = nn.Conv3d(d_model, d_model, 1)
 
     def forward(self, x):
-        shortcut = x.clone()
         x = self.proj_1(x)
         x = self.activation(x)
         x = x*self.spatial_gating_unit(x)
@@ -169,7 +164,7 @@ class LKA3D_Block(nn.Module):
     def forward(self, x, B, C, H, W, D):
         if x.shape != 5: #[B, N, C]
             x = x.permute(0,2,1).reshape(B, C, H, W, D) # B N C --> B C N --> B C H W D 
-        shortcut = x.clone()
+        shortcut = x
         x = self.proj_1(x)
         x = self.activation(x)
         x = self.spatial_gating_unit(x)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import os
+import sys
 import glob
 
 import torch
@@ -28,6 +29,16 @@ def get_extensions():
     extra_compile_args = {"cxx": []}
     define_macros = []
 
+    # the CPU kernels split their loops with at::parallel_for, which only runs in parallel if the extension is
+    # compiled with OpenMP as well (when torch uses OpenMP as its parallel backend)
+    info = torch.__config__.parallel_info()
+    if "backend: OpenMP" in info and sys.platform != "darwin":
+        define_macros += [("AT_PARALLEL_OPENMP", None)]
+        if sys.platform == "win32":
+            extra_compile_args["cxx"] += ["/openmp"]
+        else:
+            extra_compile_args["cxx"] += ["-fopenmp"]
+
     if torch.cuda.is_available() and CUDA_HOME is not None:
         extension = CUDAExtension
         sources += source_cuda
@@ -38,8 +49,6 @@ def get_extensions():
             "-D__CUDA_NO_HALF_CONVERSIONS__",
             "-D__CUDA_NO_HALF2_OPERATORS__",
         ]
-    else:
-        raise NotImplementedError("Cuda is not availabel")
 
     sources = [os.path.join(extensions_dir, s) for s in sources]
     include_dirs = [extensions_dir]
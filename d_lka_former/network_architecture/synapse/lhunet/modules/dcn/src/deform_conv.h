@@ -28,7 +28,7 @@ deform_conv_forward(const at::Tensor &input,
                const int deformable_group,
                const int im2col_step)
 {
-    if (input.type().is_cuda())
+    if (input.is_cuda())
     {
 #ifdef WITH_CUDA
         return deform_conv_cuda_forward(input, weight, bias, offset,
@@ -43,7 +43,14 @@ deform_conv_forward(const at::Tensor &input,
         AT_ERROR("Not compiled with GPU support");
 #endif
     }
-    AT_ERROR("Not implemented on the CPU");
+    return deform_conv_cpu_forward(input, weight, bias, offset,
+                                   kernel_d, kernel_h, kernel_w,
+                                   stride_d, stride_h, stride_w,
+                                   pad_d, pad_h, pad_w,
+                                   dilation_d, dilation_h, dilation_w,
+                                   group,
+                                   deformable_group,
+                                   im2col_step);
 }
 
 std::vector<at::Tensor>
@@ -68,7 +75,7 @@ deform_conv_backward(const at::Tensor &input,
                 const int deformable_group,
                 const int im2col_step)
 {
-    if (input.type().is_cuda())
+    if (input.is_cuda())
     {
 #ifdef WITH_CUDA
         return deform_conv_cuda_backward(input,
@@ -87,6 +94,17 @@ deform_conv_backward(const at::Tensor &input,
         AT_ERROR("Not compiled with GPU support");
 #endif
     }
-    AT_ERROR("Not implemented on the CPU");
+    return deform_conv_cpu_backward(input,
+                                    weight,
+                                    bias,
+                                    offset,
+                                    grad_output,
+                                    kernel_d, kernel_h, kernel_w,
+                                    stride_d, stride_h, stride_w,
+                                    pad_d, pad_h, pad_w,
+                                    dilation_d, dilation_h, dilation_w,
+                                    group,
+                                    deformable_group,
+                                    im2col_step);
 }
 
@@ -10,6 +10,8 @@ from torch.autograd import gradcheck
 
 from modules.deform_conv import DeformConv, _DeformConv, DeformConvPack
 from modules.deform_conv import DeformConv_d, _DeformConv, DeformConvPack_d
+from functions.deform_conv_func import DeformConvFunction, D3D
+from functions.deform_conv_torch import deform_conv3d
 
 # from dcn.modules.deform_conv import DeformConv, _DeformConv, DeformConvPack
 # from dcn.modules.deform_conv import DeformConv_d, _DeformConv, DeformConvPack_d
@@ -149,8 +151,73 @@ def example_dconv_offset_d():
     print("output.shape: ", output.shape)
 
 
+def check_cpu_backends():
+    print("======D3D on the CPU against the PyTorch fallback======")
+    # random offsets: no sampling position is an integer (where the offset gradients are one sided), some are
+    # outside of the volume
+    configs = [
+        # groups, deformable_groups, kernel, stride, padding, dilation, im2col_step
+        (1, 1, (3, 3, 3), (1, 1, 1), (1, 1, 1), (1, 1, 1), 2),
+        (2, 2, (3, 2, 3), (2, 1, 2), (1, 0, 2), (2, 1, 1), 1),
+        (4, 1, (5, 5, 5), (1, 1, 1), (2, 2, 2), (1, 1, 1), 64),
+        (4, 4, (3, 3, 3), (1, 2, 1), (3, 3, 3), (3, 1, 2), 2),
+    ]
+    for groups, dg, kernel, stride, padding, dilation, step in configs:
+        torch.manual_seed(0)
+        input = torch.randn(2, 4, 5, 6, 7, dtype=torch.double, requires_grad=True)
+        weight = torch.randn(
+            8, 4 // groups, *kernel, dtype=torch.double, requires_grad=True
+        )
+        bias = torch.randn(8, dtype=torch.double, requires_grad=True)
+        out_size = [
+            (s + 2 * p - (d * (k - 1) + 1)) // t + 1
+            for s, p, d, k, t in zip(input.shape[2:], padding, dilation, kernel, stride)
+        ]
+        offset = torch.rand(
+            2, dg * 3 * kernel[0] * kernel[1] * kernel[2], *out_size, dtype=torch.double
+        )
+        offset = (4 * offset - 2).requires_grad_()
+        args = (stride, padding, dilation, groups, dg)
+        output = DeformConvFunction.apply(input, offset, weight, bias, *args, step)
+        output_torch = deform_conv3d(input, offset, weight, bias, *args)
+        grad_output = torch.randn_like(output)
+        grads = torch.autograd.grad(output, (input, offset, weight, bias), grad_output)
+        grads_torch = torch.autograd.grad(
+            output_torch, (input, offset, weight, bias), grad_output
+        )
+        errors = [(output - output_torch).abs().max().item()] + [
+            (g - g_torch).abs().max().item() for g, g_torch in zip(grads, grads_torch)
+        ]
+        print(
+            "groups %d, deformable groups %d, kernel %s: max abs difference of output, "
+            "grad input, offset, weight, bias %s"
+            % (groups, dg, str(kernel), ", ".join("%.1e" % e for e in errors))
+        )
+        assert max(errors) < 1e-10
+
+    input = torch.randn(1, 2, 3, 4, 3, dtype=torch.double, requires_grad=True)
+    offset = (
+        3 * torch.rand(1, 2 * 3 * 8, 4, 3, 4, dtype=torch.double) - 1.5
+    ).requires_grad_()
+    weight = torch.randn(2, 2, 2, 2, 2, dtype=torch.double, requires_grad=True)
+    bias = torch.randn(2, dtype=torch.double, requires_grad=True)
+    print(
+        "gradcheck:",
+        gradcheck(
+            lambda *tensors: DeformConvFunction.apply(
+                *tensors, (1, 1, 1), (1, 0, 1), (1, 1, 1), 1, 2, 1
+            ),
+            (input, offset, weight, bias),
+        ),
+    )
+
+
 if __name__ == "__main__":
     print("==================Deformable 3D convolution==================", "\n")
+    if D3D is not None:
+        check_cpu_backends()
+    if not torch.cuda.is_available():
+        exit()
     # D3D deform in three dimensions
     print("=============D3D deform in three dimensions===========")
     # example_dconv() # DCN using its own offsets
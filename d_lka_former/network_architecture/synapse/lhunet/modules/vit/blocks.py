@@ -6,6 +6,7 @@ from torch.nn import functional as F
 
 from ..dynunet_blocks import UnetResBlock
 from ..cnn import *
+from .token_grid import project_tokens, resize_position_embedding
 
 
 
@@ -60,6 +61,8 @@ class TransformerBlock_LKA3D(nn.Module):
         self.pos_embed = None
         if pos_embed:
             self.pos_embed = nn.Parameter(torch.zeros(1, input_size, hidden_size))
+        # (H, W, D) of the training patch, see token_grid.enable_any_patch_size
+        self.token_grid = None
 
     def forward(self, x):
         B, C, H, W, D = x.shape
@@ -67,7 +70,9 @@ class TransformerBlock_LKA3D(nn.Module):
         x = x.reshape(B, C, H * W * D).permute(0, 2, 1)
 
         if self.pos_embed is not None:
-            x = x + self.pos_embed
+            x = x + resize_position_embedding(
+                self.pos_embed, (H, W, D), self.token_grid
+            )
         attn = x + self.gamma * self.epa(self.norm(x), B, C, H, W, D)
 
         attn_skip = attn.reshape(B, H, W, D, C).permute(0, 4, 1, 2, 3)  # (B, C, H, W, D)
@@ -229,6 +234,9 @@ class SpatialAttention_LKA3D(nn.Module):
         # E and F are projection matrices with shared weights used in spatial attention module to project
         # keys and values from HWD-dimension to P-dimension
         self.E = self.F = nn.Linear(input_size, proj_size)
+        # (H, W, D) of the training patch and how E and F adapt to other ones, see token_grid.enable_any_patch_size
+        self.token_grid = None
+        self.token_projection = "pool"
         
         if lka_attn_drop:
             self.attn_drop_lka = nn.Dropout(lka_attn_drop)
@@ -269,7 +277,7 @@ class SpatialAttention_LKA3D(nn.Module):
             x_LKA = self.attn_drop_lka(x_LKA)        
         return self.norm_lka(x_LKA) if self.use_norm_lka else x_LKA
 
-    def spatial_vit_attention(self, x):
+    def spatial_vit_attention(self, x, grid):
         B, N, C = x.shape
 
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads)
@@ -280,8 +288,12 @@ class SpatialAttention_LKA3D(nn.Module):
         key = key.transpose(-2, -1)
         v_SA = v_SA.transpose(-2, -1)
 
-        k_projected = self.E(key)
-        v_SA_projected = self.F(v_SA)
+        k_projected = project_tokens(
+            self.E, key, grid, self.token_grid, self.token_projection
+        )
+        v_SA_projected = project_tokens(
+            self.F, v_SA, grid, self.token_grid, self.token_projection
+        )
 
         query = torch.nn.functional.normalize(query, dim=-1)
         #key = torch.nn.functional.normalize(key, dim=-1)
@@ -301,7 +313,7 @@ class SpatialAttention_LKA3D(nn.Module):
         special_shape=(H, W, D)
         
         # Spatial Attention (ViT)
-        x_SA = self.spatial_vit_attention(x)
+        x_SA = self.spatial_vit_attention(x, special_shape)
         
         if self.sequential: 
             x = x_SA.permute(0, 2, 1).reshape(B, C, *special_shape) # B N C --> B C N --> B C H W D
@@ -473,6 +485,9 @@ class EPA(nn.Module):
         # E and F are projection matrices with shared weights used in spatial attention module to project
         # keys and values from HWD-dimension to P-dimension
         self.E = self.F = nn.Linear(input_size, proj_size)
+        # (H, W, D) of the training patch and how E and F adapt to other ones, see token_grid.enable_any_patch_size
+        self.token_grid = None
+        self.token_projection = "pool"
 
         self.attn_drop = nn.Dropout(channel_attn_drop)
         self.attn_drop_2 = nn.Dropout(spatial_attn_drop)
@@ -480,8 +495,9 @@ class EPA(nn.Module):
         self.out_proj = nn.Linear(hidden_size, int(hidden_size // 2))
         self.out_proj2 = nn.Linear(hidden_size, int(hidden_size // 2))
 
-    def forward(self, x):
+    def forward(self, x, B_in=None, C_in=None, H=None, W=None, D=None):
         B, N, C = x.shape
+        grid = (H, W, D)
 
         qkvv = self.qkvv(x).reshape(B, N, 4, self.num_heads, C // self.num_heads)
         qkvv = qkvv.permute(2, 0, 3, 1, 4)
@@ -492,8 +508,12 @@ class EPA(nn.Module):
         v_CA = v_CA.transpose(-2, -1)
         v_SA = v_SA.transpose(-2, -1)
 
-        k_shared_projected = self.E(k_shared)
-        v_SA_projected = self.F(v_SA)
+        k_shared_projected = project_tokens(
+            self.E, k_shared, grid, self.token_grid, self.token_projection
+        )
+        v_SA_projected = project_tokens(
+            self.F, v_SA, grid, self.token_grid, self.token_projection
+        )
 
         q_shared = torch.nn.functional.normalize(q_shared, dim=-1)
         k_shared = torch.nn.functional.normalize(k_shared, dim=-1)
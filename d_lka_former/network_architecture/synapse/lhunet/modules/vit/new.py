@@ -6,6 +6,7 @@ from torch.nn import functional as F
 
 from ..dynunet_blocks import UnetResBlock
 from ..cnn import *
+from .token_grid import project_tokens, resize_position_embedding
 
 
 
@@ -65,11 +66,13 @@ class AttBlock_ViT_Parallel_DLKA3D(nn.Module):
             self.conv1 = nn.Conv3d(hidden_size, hidden_size, 1)
 
         self.pos_embed = nn.Parameter(1e-6 + torch.zeros(1, input_size, hidden_size))
+        # (H, W, D) of the training patch, see token_grid.enable_any_patch_size
+        self.token_grid = None
             
     def vit_attn(self, x):
         B, C, H, W, D = x.shape
         x = x.reshape(B, C, H*W*D).permute(0, 2, 1)
-        x = x + self.pos_embed
+        x = x + resize_position_embedding(self.pos_embed, (H, W, D), self.token_grid)
         attn = self.attn(self.norm(x), B, C, H, W, D)
         return attn.reshape(B, H, W, D, C).permute(0, 4, 1, 2, 3)  # (B, C, H, W, D)
 
@@ -161,6 +164,9 @@ class SpatialAttention(nn.Module):
         # E and F are projection matrices with shared weights used in spatial attention module to project
         # keys and values from HWD-dimension to P-dimension
         self.E = self.F = nn.Linear(input_size, proj_size)
+        # (H, W, D) of the training patch and how E and F adapt to other ones, see token_grid.enable_any_patch_size
+        self.token_grid = None
+        self.token_projection = "pool"
         
         # qkvv are 3 linear layers (query_shared, key_shared, value_spatial, value_channlka)
         self.qkv = nn.Linear(hidden_size, hidden_size * 3, bias=qkv_bias)
@@ -173,7 +179,7 @@ class SpatialAttention(nn.Module):
         if use_norm:
             self.norm = nn.LayerNorm(hidden_size)
 
-    def vit_attention(self, x):
+    def vit_attention(self, x, grid):
         B, N, C = x.shape
 
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads)
@@ -184,8 +190,12 @@ class SpatialAttention(nn.Module):
         key = key.transpose(-2, -1)
         v_SA = v_SA.transpose(-2, -1)
 
-        k_projected = self.E(key)
-        v_SA_projected = self.F(v_SA)
+        k_projected = project_tokens(
+            self.E, key, grid, self.token_grid, self.token_projection
+        )
+        v_SA_projected = project_tokens(
+            self.F, v_SA, grid, self.token_grid, self.token_projection
+        )
 
         query = torch.nn.functional.normalize(query, dim=-1)
         #key = torch.nn.functional.normalize(key, dim=-1)
@@ -200,7 +210,7 @@ class SpatialAttention(nn.Module):
         return self.norm(x_SA) if self.use_norm else x_SA
 
     def forward(self, x, B_in, C_in, H, W, D):
-        x = self.vit_attention(x)
+        x = self.vit_attention(x, (H, W, D))
         x = self.out(x)
         return x
 
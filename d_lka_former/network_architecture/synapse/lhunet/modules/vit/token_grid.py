@@ -0,0 +1,115 @@
+import torch
+from torch.nn import functional as F
+
+__all__ = ["enable_any_patch_size", "project_tokens", "resize_position_embedding"]
+
+
+# The spatial attentions project keys and values from the H*W*D tokens to proj_size with nn.Linear(input_size,
+# proj_size) and the blocks add a position embedding of input_size tokens, so by default they only work for the token
+# count of the training patch. Modules that can adapt have a token_grid attribute: the (H, W, D) they were trained on,
+# None until enable_any_patch_size has found it. Tokens are ordered like x.reshape(B, C, H * W * D) of a
+# (B, C, H, W, D) tensor
+
+
+def _is_token_grid(grid, token_grid, num_tokens, trained_tokens):
+    if token_grid is None:
+        return num_tokens == trained_tokens
+    return tuple(grid) == tuple(token_grid)
+
+
+def project_tokens(linear, x, grid, token_grid, mode="pool"):
+    """
+    linear(x) for x with the tokens of grid on the last axis, where linear was trained on the tokens of token_grid.
+    mode 'pool' adaptive average pools x to token_grid first, 'interpolate' resizes the weight of linear to grid
+    (trilinear, scaled by the ratio of token counts so that the sums keep their magnitude). Both are linear(x) for the
+    training grid
+    """
+    if _is_token_grid(grid, token_grid, x.shape[-1], linear.in_features):
+        return linear(x)
+    if token_grid is None:
+        raise RuntimeError(
+            "This attention was trained on %d tokens and got %d (%s). Call enable_any_patch_size first"
+            % (linear.in_features, x.shape[-1], str(tuple(grid)))
+        )
+    if mode == "pool":
+        lead = x.shape[:-1]
+        x = F.adaptive_avg_pool3d(x.reshape(1, -1, *grid), token_grid)
+        return linear(x.reshape(*lead, linear.in_features))
+    elif mode == "interpolate":
+        weight = F.interpolate(
+            linear.weight.reshape(1, linear.out_features, *token_grid),
+            size=tuple(grid),
+            mode="trilinear",
+            align_corners=False,
+        ).reshape(linear.out_features, -1)
+        return F.linear(x, weight * (linear.in_features / x.shape[-1]), linear.bias)
+    else:
+        raise ValueError("Unknown mode %s" % mode)
+
+
+def resize_position_embedding(pos_embed, grid, token_grid):
+    """
+    pos_embed (1, tokens of token_grid, C) trilinearly resized to the tokens of grid
+    """
+    if _is_token_grid(
+        grid, token_grid, int(torch.Size(grid).numel()), pos_embed.shape[1]
+    ):
+        return pos_embed
+    if token_grid is None:
+        raise RuntimeError(
+            "This position embedding has %d tokens and the input %s. Call enable_any_patch_size first"
+            % (pos_embed.shape[1], str(tuple(grid)))
+        )
+    channels = pos_embed.shape[-1]
+    pos_embed = F.interpolate(
+        pos_embed.transpose(1, 2).reshape(1, channels, *token_grid),
+        size=tuple(grid),
+        mode="trilinear",
+        align_corners=False,
+    )
+    return pos_embed.reshape(1, channels, -1).transpose(1, 2)
+
+
+def enable_any_patch_size(model, patch_size, num_input_channels, mode="pool"):
+    """
+    Lets model (e.g. an LHUNet) predict patches of other sizes than the one it was trained on: one forward pass of a
+    patch of patch_size records the token grid of every module with a token_grid attribute, afterwards their key/value
+    projections and position embeddings are adapted to the input (see project_tokens and resize_position_embedding).
+    Nothing changes for patches of patch_size. Other patch sizes still have to be divisible by the total stride
+
+    :param model:
+    :param patch_size: the training patch size
+    :param num_input_channels:
+    :param mode: 'pool' or 'interpolate', see project_tokens
+    :return: model
+    """
+    if getattr(model, "any_patch_size", None) == (tuple(patch_size), mode):
+        return model
+    modules = [m for m in model.modules() if hasattr(m, "token_grid")]
+
+    def record(module, args):
+        x = args[0]
+        # blocks get (B, C, H, W, D), attentions (B, N, C) and B, C, H, W, D as separate arguments
+        module.token_grid = tuple(x.shape[2:]) if x.dim() == 5 else tuple(args[3:6])
+
+    handles = [m.register_forward_pre_hook(record) for m in modules]
+    parameter = next(model.parameters())
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        model(
+            torch.zeros(
+                1,
+                num_input_channels,
+                *patch_size,
+                device=parameter.device,
+                dtype=parameter.dtype,
+            )
+        )
+    model.train(training)
+    for h in handles:
+        h.remove()
+    for m in modules:
+        m.token_projection = mode
+    model.any_patch_size = (tuple(patch_size), mode)
+    return model
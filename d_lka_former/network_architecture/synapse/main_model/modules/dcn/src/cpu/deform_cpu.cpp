@@ -1,8 +1,235 @@
+#include <algorithm>
+#include <cmath>
 #include <vector>
 
 #include <ATen/ATen.h>
-#include <ATen/cuda/CUDAContext.h>
+#include <ATen/Parallel.h>
 
+// CPU version of cuda/deform_im2col_cuda.cuh and cuda/deform_conv_cuda.cu: the same layouts (the columns are
+// (c * kd * kh * kw, batch_n, od, oh, ow)), the same trilinear sampling (zero outside of the volume) and the same
+// gradients. The sampling positions and weights of a kernel tap are computed once per deformable group into a table
+// and then used for all channels of the group, the loops are split over threads with at::parallel_for such that
+// every thread writes its own part of the output (no atomics).
+
+namespace {
+
+struct Geometry
+{
+    int channels, depth, height, width;
+    int depth_out, height_out, width_out;
+    int kernel_d, kernel_h, kernel_w;
+    int pad_d, pad_h, pad_w;
+    int stride_d, stride_h, stride_w;
+    int dilation_d, dilation_h, dilation_w;
+    int deformable_group;
+
+    int64_t volume() const { return (int64_t)depth * height * width; }
+    int64_t volume_out() const { return (int64_t)depth_out * height_out * width_out; }
+    int64_t taps() const { return (int64_t)kernel_d * kernel_h * kernel_w; }
+    int channels_per_group() const { return channels / deformable_group; }
+};
+
+// the 8 corners of the trilinear interpolation of every output position for one kernel tap: index (into a
+// depth * height * width volume) and weight per corner and, if grad is not null, the derivatives of the weights
+// along d, h and w (grad[(p * 3 + axis) * 8 + corner]). Corners outside of the volume and all corners of positions
+// with d <= -1, d >= depth, ... (which the GPU skips) get index 0 and weight 0
+template <typename scalar_t>
+void sampling_table(const scalar_t *data_offset, const int64_t tap, const Geometry &g,
+                    int64_t *index, scalar_t *weight, scalar_t *grad)
+{
+    const int64_t length = g.volume_out();
+    const int i = tap / (g.kernel_h * g.kernel_w);
+    const int j = (tap / g.kernel_w) % g.kernel_h;
+    const int k = tap % g.kernel_w;
+    const scalar_t *offset_d = data_offset + 3 * tap * length;
+    const scalar_t *offset_h = offset_d + length;
+    const scalar_t *offset_w = offset_h + length;
+
+    int64_t p = 0;
+    for (int d_out = 0; d_out < g.depth_out; ++d_out)
+    {
+        for (int h_out = 0; h_out < g.height_out; ++h_out)
+        {
+            for (int w_out = 0; w_out < g.width_out; ++w_out, ++p)
+            {
+                const scalar_t d = d_out * g.stride_d - g.pad_d + i * g.dilation_d + offset_d[p];
+                const scalar_t h = h_out * g.stride_h - g.pad_h + j * g.dilation_h + offset_h[p];
+                const scalar_t w = w_out * g.stride_w - g.pad_w + k * g.dilation_w + offset_w[p];
+                int64_t *index_p = index + 8 * p;
+                scalar_t *weight_p = weight + 8 * p;
+                scalar_t *grad_p = grad == nullptr ? nullptr : grad + 24 * p;
+                std::fill(index_p, index_p + 8, 0);
+                std::fill(weight_p, weight_p + 8, static_cast<scalar_t>(0));
+                if (grad_p != nullptr)
+                    std::fill(grad_p, grad_p + 24, static_cast<scalar_t>(0));
+                if (!(d > -1 && h > -1 && w > -1 && d < g.depth && h < g.height && w < g.width))
+                    continue;
+
+                const int d_low = std::floor(d);
+                const int h_low = std::floor(h);
+                const int w_low = std::floor(w);
+                // weights of the low and the high corner per axis
+                const scalar_t wd[2] = {d_low + 1 - d, d - d_low};
+                const scalar_t wh[2] = {h_low + 1 - h, h - h_low};
+                const scalar_t ww[2] = {w_low + 1 - w, w - w_low};
+                for (int corner = 0; corner < 8; ++corner)
+                {
+                    const int cd = corner >> 2, ch = (corner >> 1) & 1, cw = corner & 1;
+                    const int dd = d_low + cd, hh = h_low + ch, wi = w_low + cw;
+                    if (dd < 0 || dd >= g.depth || hh < 0 || hh >= g.height || wi < 0 || wi >= g.width)
+                        continue;
+                    index_p[corner] = ((int64_t)dd * g.height + hh) * g.width + wi;
+                    weight_p[corner] = wd[cd] * wh[ch] * ww[cw];
+                    if (grad_p != nullptr)
+                    {
+                        grad_p[corner] = (cd ? 1 : -1) * wh[ch] * ww[cw];
+                        grad_p[8 + corner] = (ch ? 1 : -1) * wd[cd] * ww[cw];
+                        grad_p[16 + corner] = (cw ? 1 : -1) * wd[cd] * wh[ch];
+                    }
+                }
+            }
+        }
+    }
+}
+
+// calls fn(b, group, first, last) for the runs of channels [first, last) (counted over batch_n * channels) of the same
+// batch element and deformable group, split over threads
+template <typename Function>
+void for_each_channel_run(const int batch_n, const Geometry &g, const Function &fn)
+{
+    const int channels_per_group = g.channels_per_group();
+    at::parallel_for(0, (int64_t)batch_n * g.channels, 1, [&](int64_t begin, int64_t end) {
+        for (int64_t first = begin; first < end;)
+        {
+            const int64_t b = first / g.channels;
+            const int64_t group = (first % g.channels) / channels_per_group;
+            const int64_t last = std::min(end, b * g.channels + (group + 1) * channels_per_group);
+            fn(b, group, first, last);
+            first = last;
+        }
+    });
+}
+
+template <typename scalar_t>
+void deformable_im2col_cpu(const scalar_t *data_im, const scalar_t *data_offset, const int batch_n,
+                           const Geometry &g, scalar_t *data_col)
+{
+    const int64_t length = g.volume_out();
+    const int64_t taps = g.taps();
+    for_each_channel_run(batch_n, g, [&](int64_t b, int64_t group, int64_t first, int64_t last) {
+        std::vector<int64_t> index(8 * length);
+        std::vector<scalar_t> weight(8 * length);
+        const scalar_t *offset = data_offset + (b * g.deformable_group + group) * 3 * taps * length;
+        for (int64_t tap = 0; tap < taps; ++tap)
+        {
+            sampling_table(offset, tap, g, index.data(), weight.data(), (scalar_t *)nullptr);
+            for (int64_t bc = first; bc < last; ++bc)
+            {
+                const scalar_t *im = data_im + bc * g.volume();
+                scalar_t *col = data_col + (((bc % g.channels) * taps + tap) * batch_n + b) * length;
+                for (int64_t p = 0; p < length; ++p)
+                {
+                    const int64_t *index_p = index.data() + 8 * p;
+                    const scalar_t *weight_p = weight.data() + 8 * p;
+                    scalar_t val = 0;
+                    for (int corner = 0; corner < 8; ++corner)
+                        val += weight_p[corner] * im[index_p[corner]];
+                    col[p] = val;
+                }
+            }
+        }
+    });
+}
+
+template <typename scalar_t>
+void deformable_col2im_cpu(const scalar_t *data_col, const scalar_t *data_offset, const int batch_n,
+                           const Geometry &g, scalar_t *grad_im)
+{
+    const int64_t length = g.volume_out();
+    const int64_t taps = g.taps();
+    for_each_channel_run(batch_n, g, [&](int64_t b, int64_t group, int64_t first, int64_t last) {
+        std::vector<int64_t> index(8 * length);
+        std::vector<scalar_t> weight(8 * length);
+        const scalar_t *offset = data_offset + (b * g.deformable_group + group) * 3 * taps * length;
+        for (int64_t tap = 0; tap < taps; ++tap)
+        {
+            sampling_table(offset, tap, g, index.data(), weight.data(), (scalar_t *)nullptr);
+            for (int64_t bc = first; bc < last; ++bc)
+            {
+                scalar_t *im = grad_im + bc * g.volume();
+                const scalar_t *col = data_col + (((bc % g.channels) * taps + tap) * batch_n + b) * length;
+                for (int64_t p = 0; p < length; ++p)
+                {
+                    const int64_t *index_p = index.data() + 8 * p;
+                    const scalar_t *weight_p = weight.data() + 8 * p;
+                    for (int corner = 0; corner < 8; ++corner)
+                        im[index_p[corner]] += weight_p[corner] * col[p];
+                }
+            }
+        }
+    });
+}
+
+template <typename scalar_t>
+void deformable_col2im_coord_cpu(const scalar_t *data_col, const scalar_t *data_im, const scalar_t *data_offset,
+                                 const int batch_n, const Geometry &g, scalar_t *grad_offset)
+{
+    const int64_t length = g.volume_out();
+    const int64_t taps = g.taps();
+    const int channels_per_group = g.channels_per_group();
+    // one task per batch element, deformable group and kernel tap, each writes the 3 offset channels of its tap
+    at::parallel_for(0, (int64_t)batch_n * g.deformable_group * taps, 1, [&](int64_t begin, int64_t end) {
+        std::vector<int64_t> index(8 * length);
+        std::vector<scalar_t> weight(8 * length);
+        std::vector<scalar_t> grad(24 * length);
+        std::vector<scalar_t> corner_sum(8 * length);
+        for (int64_t task = begin; task < end; ++task)
+        {
+            const int64_t b = task / (g.deformable_group * taps);
+            const int64_t group = (task / taps) % g.deformable_group;
+            const int64_t tap = task % taps;
+            const int64_t offset_start = (b * g.deformable_group + group) * 3 * taps * length;
+            sampling_table(data_offset + offset_start, tap, g, index.data(), weight.data(), grad.data());
+
+            // sum over the channels of the corner values times the gradient of the columns first, then one weighted
+            // sum of the 8 corners per axis
+            std::fill(corner_sum.begin(), corner_sum.end(), static_cast<scalar_t>(0));
+            for (int64_t c = group * channels_per_group; c < (group + 1) * channels_per_group; ++c)
+            {
+                const scalar_t *im = data_im + (b * g.channels + c) * g.volume();
+                const scalar_t *col = data_col + ((c * taps + tap) * batch_n + b) * length;
+                for (int64_t p = 0; p < length; ++p)
+                {
+                    const int64_t *index_p = index.data() + 8 * p;
+                    scalar_t *corner_sum_p = corner_sum.data() + 8 * p;
+                    for (int corner = 0; corner < 8; ++corner)
+                        corner_sum_p[corner] += im[index_p[corner]] * col[p];
+                }
+            }
+
+            scalar_t *grad_d = grad_offset + offset_start + 3 * tap * length;
+            scalar_t *grad_h = grad_d + length;
+            scalar_t *grad_w = grad_h + length;
+            for (int64_t p = 0; p < length; ++p)
+            {
+                const scalar_t *grad_p = grad.data() + 24 * p;
+                const scalar_t *corner_sum_p = corner_sum.data() + 8 * p;
+                scalar_t val_d = 0, val_h = 0, val_w = 0;
+                for (int corner = 0; corner < 8; ++corner)
+                {
+                    val_d += grad_p[corner] * corner_sum_p[corner];
+                    val_h += grad_p[8 + corner] * corner_sum_p[corner];
+                    val_w += grad_p[16 + corner] * corner_sum_p[corner];
+                }
+                grad_d[p] = val_d;
+                grad_h[p] = val_h;
+                grad_w[p] = val_w;
+            }
+        }
+    });
+}
+
+} // namespace
 
 at::Tensor
 deform_conv_cpu_forward(const at::Tensor &input,
@@ -25,7 +252,73 @@ deform_conv_cpu_forward(const at::Tensor &input,
                    const int deformable_group,
                    const int im2col_step)
 {
-    AT_ERROR("Not implement on cpu");
+    AT_ASSERTM(input.is_contiguous(), "input tensor has to be contiguous");
+    AT_ASSERTM(weight.is_contiguous(), "weight tensor has to be contiguous");
+
+    AT_ASSERTM(!input.is_cuda(), "input must be a CPU tensor");
+    AT_ASSERTM(!weight.is_cuda(), "weight must be a CPU tensor");
+    AT_ASSERTM(!bias.is_cuda(), "bias must be a CPU tensor");
+    AT_ASSERTM(!offset.is_cuda(), "offset must be a CPU tensor");
+
+    const int batch = input.size(0);
+    const int channels = input.size(1);
+    const int depth = input.size(2);
+    const int height = input.size(3);
+    const int width = input.size(4);
+
+    const int channels_out = weight.size(0);
+    const int channels_kernel = weight.size(1);
+    const int kernel_d_ = weight.size(2);
+    const int kernel_h_ = weight.size(3);
+    const int kernel_w_ = weight.size(4);
+
+    const int im2col_step_ = std::min(batch, im2col_step);
+
+    AT_ASSERTM(batch % im2col_step_ == 0, "batch(%d) must divide im2col_step(%d)", batch, im2col_step_);
+
+    AT_ASSERTM((channels % group == 0) && (channels_out % group == 0),
+        "channels(%d) and channels_out(%d) must divide group(%d)", channels, channels_out, group);
+
+    AT_ASSERTM(kernel_h_ == kernel_h && kernel_w_ == kernel_w && kernel_d_ == kernel_d,
+               "Input shape and kernel shape wont match: (%d x %d x %d vs %d x %d x %d).", kernel_d, kernel_h, kernel_w, kernel_d_, kernel_h_, kernel_w_);
+
+    AT_ASSERTM(channels == (channels_kernel * group),
+               "Input shape and kernel channels wont match: (%d vs %d).", channels, channels_kernel * group);
+
+    const int depth_out = (depth + 2 * pad_d - (dilation_d * (kernel_d - 1) + 1)) / stride_d + 1;
+    const int height_out = (height + 2 * pad_h - (dilation_h * (kernel_h - 1) + 1)) / stride_h + 1;
+    const int width_out = (width + 2 * pad_w - (dilation_w * (kernel_w - 1) + 1)) / stride_w + 1;
+
+    const Geometry geometry = {channels, depth, height, width, depth_out, height_out, width_out,
+                               kernel_d, kernel_h, kernel_w, pad_d, pad_h, pad_w, stride_d, stride_h, stride_w,
+                               dilation_d, dilation_h, dilation_w, deformable_group};
+    const int64_t length = geometry.volume_out();
+    const int64_t taps = geometry.taps();
+
+    auto offset_ = offset.contiguous();
+    auto output = at::empty({batch, channels_out, length}, input.options());
+
+    // one matrix product per group for all groups at once
+    auto weight_g = weight.view({group, channels_out / group, channels_kernel * taps});
+
+    const int batch_n = im2col_step_;
+    const int64_t per_input_size = (int64_t)channels * geometry.volume();
+    const int64_t per_offset_size = offset_.numel() / batch;
+    auto columns = at::empty({channels * taps, batch_n * length}, input.options());
+    for (int n = 0; n < batch / im2col_step_; ++n)
+    {
+        AT_DISPATCH_FLOATING_TYPES(input.scalar_type(), "deform_conv_forward_cpu", ([&] {
+            deformable_im2col_cpu(input.data_ptr<scalar_t>() + n * im2col_step_ * per_input_size,
+                                  offset_.data_ptr<scalar_t>() + n * im2col_step_ * per_offset_size,
+                                  batch_n, geometry, columns.data_ptr<scalar_t>());
+        }));
+
+        auto output_g = at::bmm(weight_g, columns.view({group, channels / group * taps, batch_n * length}));
+        output.narrow(0, n * batch_n, batch_n).copy_(output_g.view({channels_out, batch_n, length}).transpose(0, 1));
+    }
+    output.add_(bias.view({1, channels_out, 1}));
+
+    return output.view({batch, channels_out, depth_out, height_out, width_out});
 }
 
 std::vector<at::Tensor>
@@ -34,22 +327,122 @@ deform_conv_cpu_backward(const at::Tensor &input,
                     const at::Tensor &bias,
                     const at::Tensor &offset,
                     const at::Tensor &grad_output,
-                     const int kernel_d, 
-                     const int kernel_h, 
+                     const int kernel_d,
+                     const int kernel_h,
                      const int kernel_w,
-                     const int stride_d, 
-                     const int stride_h, 
+                     const int stride_d,
+                     const int stride_h,
                      const int stride_w,
                      const int pad_d,
-                     const int pad_h, 
+                     const int pad_h,
                      const int pad_w,
-                     const int dilation_d, 
-                     const int dilation_h, 
+                     const int dilation_d,
+                     const int dilation_h,
                      const int dilation_w,
                      const int group,
                      const int deformable_group,
                      const int im2col_step)
 {
-    AT_ERROR("Not implement on cpu");
-}
+    AT_ASSERTM(input.is_contiguous(), "input tensor has to be contiguous");
+    AT_ASSERTM(weight.is_contiguous(), "weight tensor has to be contiguous");
+
+    AT_ASSERTM(!input.is_cuda(), "input must be a CPU tensor");
+    AT_ASSERTM(!weight.is_cuda(), "weight must be a CPU tensor");
+    AT_ASSERTM(!bias.is_cuda(), "bias must be a CPU tensor");
+    AT_ASSERTM(!offset.is_cuda(), "offset must be a CPU tensor");
+
+    const int batch = input.size(0);
+    const int channels = input.size(1);
+    const int depth = input.size(2);
+    const int height = input.size(3);
+    const int width = input.size(4);
+
+    const int channels_out = weight.size(0);
+    const int channels_kernel = weight.size(1);
+    const int kernel_d_ = weight.size(2);
+    const int kernel_h_ = weight.size(3);
+    const int kernel_w_ = weight.size(4);
+
+    const int batch_ = grad_output.size(0);
+    const int channels_out_ = grad_output.size(1);
+    const int depth_out_ = grad_output.size(2);
+    const int height_out_ = grad_output.size(3);
+    const int width_out_ = grad_output.size(4);
+
+    const int im2col_step_ = std::min(im2col_step, batch);
+
+    AT_ASSERTM(batch % im2col_step_ == 0, "batch(%d) must divide im2col_step(%d)", batch, im2col_step_);
 
+    AT_ASSERTM((channels % group == 0) && (channels_out % group == 0),
+        "channels(%d) and channels_out(%d) must divide group(%d)", channels, channels_out, group);
+
+    AT_ASSERTM(kernel_h_ == kernel_h && kernel_w_ == kernel_w && kernel_d_ == kernel_d,
+               "Input shape and kernel shape wont match: (%d x %d x %d vs %d x %d x %d).", kernel_d, kernel_h, kernel_w, kernel_d_, kernel_h_, kernel_w_);
+
+    AT_ASSERTM(channels == (channels_kernel * group),
+               "Input shape and kernel channels wont match: (%d vs %d).", channels, channels_kernel * group);
+
+    const int depth_out = (depth + 2 * pad_d - (dilation_d * (kernel_d - 1) + 1)) / stride_d + 1;
+    const int height_out = (height + 2 * pad_h - (dilation_h * (kernel_h - 1) + 1)) / stride_h + 1;
+    const int width_out = (width + 2 * pad_w - (dilation_w * (kernel_w - 1) + 1)) / stride_w + 1;
+
+    AT_ASSERTM(batch == batch_,
+               "Input shape and grad_out batch wont match: (%d vs %d).", batch, batch_);
+
+    AT_ASSERTM(channels_out == channels_out_,
+               "Input shape and grad_out channels_out wont match: (%d vs %d).", channels_out, channels_out_);
+
+    AT_ASSERTM(height_out == height_out_ && width_out == width_out_ && depth_out == depth_out_,
+               "Input shape and grad_out shape wont match: (%d x %d x %d vs %d x %d x %d).", depth_out, depth_out_, height_out, height_out_, width_out, width_out_);
+
+    const Geometry geometry = {channels, depth, height, width, depth_out, height_out, width_out,
+                               kernel_d, kernel_h, kernel_w, pad_d, pad_h, pad_w, stride_d, stride_h, stride_w,
+                               dilation_d, dilation_h, dilation_w, deformable_group};
+    const int64_t length = geometry.volume_out();
+    const int64_t taps = geometry.taps();
+
+    auto offset_ = offset.contiguous();
+    auto grad_input = at::zeros_like(input);
+    auto grad_offset = at::empty_like(offset_);
+    auto grad_weight = at::zeros_like(weight);
+    auto grad_bias = grad_output.sum({0, 2, 3, 4});
+
+    auto weight_g = weight.view({group, channels_out / group, channels_kernel * taps});
+    auto grad_weight_g = grad_weight.view({group, channels_out / group, channels_kernel * taps});
+
+    const int batch_n = im2col_step_;
+    const int64_t per_input_size = (int64_t)channels * geometry.volume();
+    const int64_t per_offset_size = offset_.numel() / batch;
+    for (int n = 0; n < batch / im2col_step_; ++n)
+    {
+        // (group, channels_out / group, batch_n * od * oh * ow)
+        auto grad_output_g = grad_output.narrow(0, n * batch_n, batch_n).reshape({batch_n, channels_out, length})
+                                 .transpose(0, 1).contiguous().view({group, channels_out / group, batch_n * length});
+        // the gradient of the columns, (group, channels / group * taps, batch_n * od * oh * ow) is laid out like the columns
+        auto columns = at::bmm(weight_g.transpose(1, 2), grad_output_g);
+
+        AT_DISPATCH_FLOATING_TYPES(input.scalar_type(), "deform_conv_backward_cpu", ([&] {
+            deformable_col2im_coord_cpu(columns.data_ptr<scalar_t>(),
+                                        input.data_ptr<scalar_t>() + n * im2col_step_ * per_input_size,
+                                        offset_.data_ptr<scalar_t>() + n * im2col_step_ * per_offset_size,
+                                        batch_n, geometry,
+                                        grad_offset.data_ptr<scalar_t>() + n * im2col_step_ * per_offset_size);
+            // gradient w.r.t. input data
+            deformable_col2im_cpu(columns.data_ptr<scalar_t>(),
+                                  offset_.data_ptr<scalar_t>() + n * im2col_step_ * per_offset_size,
+                                  batch_n, geometry,
+                                  grad_input.data_ptr<scalar_t>() + n * im2col_step_ * per_input_size);
+
+            // gradient w.r.t. weight, dWeight should accumulate across the batch and group
+            deformable_im2col_cpu(input.data_ptr<scalar_t>() + n * im2col_step_ * per_input_size,
+                                  offset_.data_ptr<scalar_t>() + n * im2col_step_ * per_offset_size,
+                                  batch_n, geometry, columns.data_ptr<scalar_t>());
+        }));
+
+        grad_weight_g.baddbmm_(grad_output_g, columns.transpose(1, 2));
+    }
+
+    return {
+        grad_input, grad_offset, grad_weight, grad_bias
+    };
+}
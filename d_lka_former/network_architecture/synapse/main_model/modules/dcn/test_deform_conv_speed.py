@@ -9,6 +9,8 @@ import torch.optim
 
 from modules.deform_conv import DeformConv, _DeformConv, DeformConvPack
 from modules.deform_conv import DeformConv_d, _DeformConv, DeformConvPack_d
+from functions.deform_conv_func import DeformConvFunction, D3D
+from functions.deform_conv_torch import deform_conv3d
 
 
 class NormalConv(nn.Module):
@@ -220,7 +222,60 @@ def test_backward(n_times=1000):
     # print(f"{'Time torch conv 3d:':<30} {time_conv_3d:>6.2f} ms")
 
 
+def test_cpu_backends(n_times=10):
+    """
+    D3D on the CPU against the PyTorch fallback (deform_conv3d), the depthwise 5x5x5 deformable conv of deform_LKA and
+    a dense 3x3x3 one
+    """
+    print(f"CPU, {torch.get_num_threads()} threads")
+    for channels, size, kernel, groups in [
+        (32, 16, 5, 32),
+        (32, 32, 5, 32),
+        (32, 16, 3, 1),
+    ]:
+        input = torch.rand(1, channels, size, size, size, requires_grad=True)
+        weight = torch.randn(
+            channels, channels // groups, kernel, kernel, kernel, requires_grad=True
+        )
+        bias = torch.zeros(channels, requires_grad=True)
+        offset = (
+            torch.randn(1, 3 * kernel**3, size, size, size).mul_(0.5).requires_grad_()
+        )
+        args = ((1, 1, 1), (kernel // 2,) * 3, (1, 1, 1), groups, 1)
+        backends = [
+            (
+                "D3D",
+                lambda: DeformConvFunction.apply(
+                    input, offset, weight, bias, *args, 64
+                ),
+            ),
+            ("PyTorch", lambda: deform_conv3d(input, offset, weight, bias, *args)),
+        ]
+        for name, fn in backends:
+            times_forward, times_backward = [], []
+            for i in range(n_times + 1):
+                t0 = time.perf_counter()
+                out = fn()
+                t1 = time.perf_counter()
+                out.sum().backward()
+                t2 = time.perf_counter()
+                # the first run is the warm up
+                if i > 0:
+                    times_forward.append(t1 - t0)
+                    times_backward.append(t2 - t1)
+            print(
+                f"{channels} channels, {size}^3, kernel {kernel}, groups {groups}, {name:<8}"
+                f" forward {sum(times_forward) * 1000 / n_times:>8.1f} ms,"
+                f" backward {sum(times_backward) * 1000 / n_times:>8.1f} ms"
+            )
+
+
 if __name__ == "__main__":
+    if D3D is not None:
+        test_cpu_backends()
+    if not torch.cuda.is_available():
+        exit()
+
     in_channels = 512
     bs_list = [1, 1, 16, 16]
     groups_list = [1, in_channels, 1, in_channels]
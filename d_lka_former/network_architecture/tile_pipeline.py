@@ -0,0 +1,188 @@
+from collections import OrderedDict
+from queue import Queue
+from threading import Thread
+from time import time
+from typing import Callable, List
+
+import torch
+
+
+class TilePipeline(object):
+    STAGES = ("load", "upload", "forward", "download", "accumulate", "wait")
+
+    def __init__(self, predict: Callable, device, num_buffers: int = 2):
+        """
+        Runs batches of sliding window tiles through a network so that the host to device copy of the next batch, the
+        forward pass of the current batch, the device to host copy of the previous batch and the aggregation of the
+        batch before that all overlap.
+
+        On GPU, uploads and downloads go through page locked (pinned) buffers on their own CUDA streams, the forward
+        pass runs on the current stream. On CPU there is nothing to copy, but the aggregation still runs in a background
+        thread (numpy releases the GIL for large in place additions, so this overlaps with the forward pass as well).
+        This makes it possible to test the buffering and timing logic with a CPU stand-in for the network.
+
+        :param predict: takes a torch tensor (b, c, x, y, z) on device and returns the prediction as torch tensor on
+        device
+        :param device: 'cpu' or the index of a GPU, just like NeuralNetwork.get_device
+        :param num_buffers: number of batches that can be in flight at the same time. Each of them needs a pinned
+        input and output buffer
+        """
+        self.predict = predict
+        self.device = device
+        self.is_cuda = device != "cpu"
+        self.num_buffers = num_buffers
+        self.timings = OrderedDict((stage, 0.0) for stage in self.STAGES)
+        self.timings["total"] = 0.0
+        self.num_batches = 0
+
+        self._input_buffers = [None] * num_buffers
+        self._output_buffers = [None] * num_buffers
+        self._upload_done = [None] * num_buffers
+        self._cuda_events = []
+
+    def run(self, batches: List, load: Callable, accumulate: Callable):
+        """
+        :param batches: whatever describes a batch, for example a list of tiles. It is handed to load and accumulate
+        :param load: load(batch) -> np.ndarray (b, c, x, y, z), runs in the calling thread
+        :param accumulate: accumulate(batch, prediction) with prediction as np.ndarray (b, classes, x, y, z). Runs in a
+        background thread in the order of batches. prediction is only valid during the call, copy it if you need it
+        later
+        :return:
+        """
+        start = time()
+        if self.is_cuda:
+            upload_stream = torch.cuda.Stream(self.device)
+            download_stream = torch.cuda.Stream(self.device)
+            compute_stream = torch.cuda.current_stream(self.device)
+
+        # buffers that are not in use by the accumulation thread. The accumulation thread hands them back when it is
+        # done, so this also limits how far the forward passes can get ahead of the aggregation
+        free_buffers = Queue()
+        for i in range(self.num_buffers):
+            free_buffers.put(i)
+        pending = Queue()
+        errors = []
+
+        def accumulation_worker():
+            while True:
+                item = pending.get()
+                if item is None:
+                    break
+                batch, buffer_idx, prediction, download_done = item
+                if download_done is not None:
+                    download_done.synchronize()
+                if not errors:
+                    try:
+                        accumulate_start = time()
+                        accumulate(batch, prediction.numpy())
+                        self.timings["accumulate"] += time() - accumulate_start
+                    except Exception as e:
+                        errors.append(e)
+                free_buffers.put(buffer_idx)
+
+        worker = Thread(target=accumulation_worker, daemon=True)
+        worker.start()
+
+        try:
+            for batch in batches:
+                if errors:
+                    break
+                wait_start = time()
+                buffer_idx = free_buffers.get()
+                self.timings["wait"] += time() - wait_start
+
+                load_start = time()
+                data = torch.from_numpy(load(batch))
+                if self.is_cuda:
+                    input_buffer = self._get_buffer(
+                        self._input_buffers, buffer_idx, data
+                    )
+                    # the previous upload from this buffer must be finished before we overwrite it
+                    if self._upload_done[buffer_idx] is not None:
+                        self._upload_done[buffer_idx].synchronize()
+                    input_buffer.copy_(data)
+                self.timings["load"] += time() - load_start
+
+                if self.is_cuda:
+                    upload_start, upload_end = self._new_event_pair("upload")
+                    with torch.cuda.stream(upload_stream):
+                        upload_start.record()
+                        data = input_buffer.to(
+                            torch.device("cuda", self.device), non_blocking=True
+                        )
+                        upload_end.record()
+                    self._upload_done[buffer_idx] = upload_end
+                    compute_stream.wait_event(upload_end)
+                    # data was allocated on the upload stream but is used on the compute stream
+                    data.record_stream(compute_stream)
+
+                    forward_start, forward_end = self._new_event_pair("forward")
+                    forward_start.record()
+                    prediction = self.predict(data)
+                    forward_end.record()
+
+                    download_start, download_end = self._new_event_pair("download")
+                    output_buffer = self._get_buffer(
+                        self._output_buffers, buffer_idx, prediction
+                    )
+                    with torch.cuda.stream(download_stream):
+                        download_stream.wait_event(forward_end)
+                        download_start.record()
+                        output_buffer.copy_(prediction, non_blocking=True)
+                        download_end.record()
+                    prediction.record_stream(download_stream)
+                    pending.put((batch, buffer_idx, output_buffer, download_end))
+                else:
+                    forward_start = time()
+                    prediction = self.predict(data)
+                    self.timings["forward"] += time() - forward_start
+                    pending.put((batch, buffer_idx, prediction, None))
+                self.num_batches += 1
+        finally:
+            pending.put(None)
+            worker.join()
+
+        if errors:
+            raise errors[0]
+
+        if self.is_cuda:
+            torch.cuda.synchronize(self.device)
+            for stage, event_start, event_end in self._cuda_events:
+                self.timings[stage] += event_start.elapsed_time(event_end) / 1000
+            self._cuda_events = []
+        self.timings["total"] += time() - start
+
+    def _get_buffer(self, buffers, idx, like):
+        """
+        Pinned host buffer with the shape and dtype of like. Buffers are reused as long as they are large enough, a
+        smaller batch (the last one) gets a view of the first entries
+        """
+        buffer = buffers[idx]
+        if (
+            buffer is None
+            or buffer.dtype != like.dtype
+            or buffer.shape[1:] != like.shape[1:]
+            or buffer.shape[0] < like.shape[0]
+        ):
+            buffer = torch.empty(
+                like.shape, dtype=like.dtype, device="cpu", pin_memory=True
+            )
+            buffers[idx] = buffer
+        return buffer[: like.shape[0]]
+
+    def _new_event_pair(self, stage):
+        events = (
+            torch.cuda.Event(enable_timing=True),
+            torch.cuda.Event(enable_timing=True),
+        )
+        self._cuda_events.append((stage,) + events)
+        return events
+
+    def print_timings(self):
+        """
+        On GPU, upload, forward and download are measured on their streams, so they add up to more than the total
+        if (and only if) they overlap. wait is the time the main thread was blocked by the aggregation
+        """
+        print("tile pipeline: %d batches" % self.num_batches)
+        for stage, t in self.timings.items():
+            print("%-12s %8.3f s" % (stage, t))
@@ -14,13 +14,21 @@
 
 
 import ast
-from copy import deepcopy
+from collections import OrderedDict
+from copy import copy, deepcopy
 from multiprocessing.pool import Pool
 
 import numpy as np
 from d_lka_former.configuration import default_num_threads
-from d_lka_former.evaluation.evaluator import aggregate_scores
+from d_lka_former.evaluation.evaluator import (
+    Evaluator,
+    aggregate_scores,
+    run_evaluation,
+    summarize_scores,
+)
+from d_lka_former.evaluation.metrics import ConfusionMatrix, dice, label_bounding_boxes
 from scipy.ndimage import label
+from skimage.measure import label as skimage_label
 import SimpleITK as sitk
 from d_lka_former.utilities.sitk_stuff import copy_geometry
 from batchgenerators.utilities.file_and_folder_operations import *
@@ -49,6 +57,71 @@ def load_remove_save(
     return largest_removed, kept_size
 
 
+def _region_box(boxes, region):
+    region_boxes = [boxes[cl] for cl in region if cl in boxes]
+    if len(region_boxes) == 0:
+        return None
+    return tuple(
+        slice(
+            min([b[d].start for b in region_boxes]),
+            max([b[d].stop for b in region_boxes]),
+        )
+        for d in range(len(region_boxes[0]))
+    )
+
+
+def connected_components(image: np.ndarray, c, boxes: dict = None):
+    """
+    labels the connected components of class c (or of the joint region c if c is a tuple of classes) within the
+    bounding box of c, so the cost depends on the size of the class and not on the size of the image
+    :param image:
+    :param c: int or tuple of int
+    :param boxes: label_bounding_boxes(image), so that it only needs to be computed once for all classes. Boxes of an
+    image from which objects were removed since are still valid. None: label the whole image
+    :return: bounding box (tuple of slices, None if c is not in image), labeled map of the bounding box (0 is
+    background) and the number of voxels of each component (index 0 is the background)
+    """
+    region = c if isinstance(c, (list, tuple)) else (c,)
+    if boxes is None:
+        box = tuple(slice(0, s) for s in image.shape)
+    else:
+        box = _region_box(boxes, region)
+        if box is None:
+            return None, None, np.zeros(1, dtype=np.int64)
+    crop = image[box]
+    mask = crop == region[0] if len(region) == 1 else np.isin(crop, region)
+    lmap, num_objects = label(mask)
+    if num_objects == 0:
+        return None, None, np.zeros(1, dtype=np.int64)
+    return box, lmap, np.bincount(lmap.ravel(), minlength=num_objects + 1)
+
+
+def class_connected_components(image: np.ndarray, boxes: dict):
+    """
+    labels the connected components of all classes in one pass instead of one pass per class: voxels are only
+    connected to neighbors of the same class (same neighborhood as scipy.ndimage.label)
+    :param image: non-negative integer segmentation
+    :param boxes: label_bounding_boxes(image)
+    :return: bounding box of all classes (None if there are none), labeled map of the bounding box (0 is background),
+    the number of voxels and the class of each component
+    """
+    box = _region_box(boxes, list(boxes.keys()))
+    if box is None:
+        return None, None, np.zeros(1, dtype=np.int64), np.zeros(1, dtype=image.dtype)
+    crop = image[box]
+    lmap, num_objects = skimage_label(
+        crop, background=0, connectivity=1, return_num=True
+    )
+    component_class = np.zeros(num_objects + 1, dtype=image.dtype)
+    component_class[lmap.ravel()] = crop.ravel()
+    return (
+        box,
+        lmap,
+        np.bincount(lmap.ravel(), minlength=num_objects + 1),
+        component_class,
+    )
+
+
 def remove_all_but_the_largest_connected_component(
     image: np.ndarray,
     for_which_classes: list,
@@ -56,8 +129,11 @@ def remove_all_but_the_largest_connected_component(
     minimum_valid_object_size: dict = None,
 ):
     """
-    removes all but the largest connected component, individually for each class
-    :param image:
+    removes all but the largest connected component, individually for each class. The components are labeled once
+    per joint region and once for all individual classes (see class_connected_components), their sizes are counted
+    in a single bincount and all removed components are set to 0 with one lookup table, so the cost no longer grows
+    with the number of components
+    :param image: modified in place
     :param for_which_classes: can be None. Should be list of int. Can also be something like [(1, 2), 2, 4].
     Here (1, 2) will be treated as a joint region, not individual classes (example LiTS here we can use (1, 2)
     to use all foreground classes together)
@@ -72,49 +148,269 @@ def remove_all_but_the_largest_connected_component(
     assert 0 not in for_which_classes, "cannot remove background"
     largest_removed = {}
     kept_size = {}
+    # all boxes in one pass, removing objects does not invalidate them
+    boxes = label_bounding_boxes(image)
+    # removing the components of one class does not change the components of the other classes, so consecutive
+    # individual classes share one labeling and their removed components are only set to 0 when a joint region comes
+    # next (or at the end)
+    class_components = None
     for c in for_which_classes:
         if isinstance(c, (list, tuple)):
             c = tuple(c)  # otherwise it cant be used as key in the dict
-            mask = np.zeros_like(image, dtype=bool)
-            for cl in c:
-                mask[image == cl] = True
+        joint = isinstance(c, tuple) or boxes is None
+        if joint:
+            if class_components is not None:
+                image[class_components[0]][removed[class_components[1]]] = 0
+                class_components = None
+            box, lmap, object_sizes = connected_components(image, c, boxes)
+            objects = np.arange(1, len(object_sizes))
+            removed = np.zeros(len(object_sizes), dtype=bool)
         else:
-            mask = image == c
-        # get labelmap and number of objects
-        lmap, num_objects = label(mask.astype(int))
-
-        # collect object sizes
-        object_sizes = {}
-        for object_id in range(1, num_objects + 1):
-            object_sizes[object_id] = (lmap == object_id).sum() * volume_per_voxel
+            if class_components is None:
+                class_components = class_connected_components(image, boxes)
+                removed = np.zeros(len(class_components[2]), dtype=bool)
+            box, lmap, object_sizes, component_class = class_components
+            objects = np.flatnonzero((component_class == c) & ~removed)
 
         largest_removed[c] = None
         kept_size[c] = None
 
-        if num_objects > 0:
-            # we always keep the largest object. We could also consider removing the largest object if it is smaller
-            # than minimum_valid_object_size in the future but we don't do that now.
-            maximum_size = max(object_sizes.values())
-            kept_size[c] = maximum_size
-
-            for object_id in range(1, num_objects + 1):
-                # we only remove objects that are not the largest
-                if object_sizes[object_id] != maximum_size:
-                    # we only remove objects that are smaller than minimum_valid_object_size
-                    remove = True
-                    if minimum_valid_object_size is not None:
-                        remove = object_sizes[object_id] < minimum_valid_object_size[c]
-                    if remove:
-                        image[(lmap == object_id) & mask] = 0
-                        if largest_removed[c] is None:
-                            largest_removed[c] = object_sizes[object_id]
-                        else:
-                            largest_removed[c] = max(
-                                largest_removed[c], object_sizes[object_id]
-                            )
+        if len(objects) > 0:
+            sizes = object_sizes[objects] * volume_per_voxel
+            kept_size[c] = sizes.max()
+            remove = _objects_to_remove(sizes, minimum_valid_object_size, c)
+            if np.any(remove):
+                largest_removed[c] = sizes[remove].max()
+                removed[objects[remove]] = True
+                if joint:
+                    image[box][removed[lmap]] = 0
+    if class_components is not None and np.any(removed):
+        image[class_components[0]][removed[class_components[1]]] = 0
     return image, largest_removed, kept_size
 
 
+def _objects_to_remove(object_sizes, minimum_valid_object_size, c):
+    # we always keep the largest object. We could also consider removing the largest object if it is smaller
+    # than minimum_valid_object_size in the future but we don't do that now.
+    remove = object_sizes != object_sizes.max()
+    if minimum_valid_object_size is not None and np.any(remove):
+        # we only remove objects that are smaller than minimum_valid_object_size
+        remove &= object_sizes < minimum_valid_object_size[c]
+    return remove
+
+
+class ConnectedComponentStatistics(object):
+    def __init__(self, prediction, reference, classes, volume_per_voxel):
+        """
+        Summarizes a predicted segmentation by its connected components, of all classes as one region and of each
+        class separately: their sizes and how many of their voxels agree with the reference. That is all it takes to
+        get the Dice scores after remove_all_but_the_largest_connected_component, so determine_postprocessing can try
+        its variants on these small tables instead of writing, reading and evaluating niftis
+
+        :param prediction: non-negative integer segmentation
+        :param reference: integer segmentation, same shape
+        :param classes: the foreground classes (the joint region is tuple(classes))
+        :param volume_per_voxel:
+        """
+        self.classes = [int(c) for c in classes]
+        self.volume_per_voxel = volume_per_voxel
+        self.num_voxels = prediction.size
+        self.num_labels = (
+            int(max(max(self.classes), prediction.max(), reference.max())) + 1
+        )
+        self.reference_counts = np.bincount(
+            reference.ravel(), minlength=self.num_labels
+        )
+
+        boxes = label_bounding_boxes(prediction)
+        fg_box, fg_lmap, self.fg_sizes = connected_components(
+            prediction, tuple(self.classes), boxes
+        )
+        # voxels (and true positives) of each class in each component of the joint region
+        self.fg_counts = np.zeros((len(self.fg_sizes), self.num_labels), dtype=np.int64)
+        self.fg_tp = np.zeros_like(self.fg_counts)
+        if fg_box is not None:
+            crop = prediction[fg_box]
+            index = (fg_lmap.astype(np.int64) * self.num_labels + crop)[fg_lmap > 0]
+            correct = (crop == reference[fg_box])[fg_lmap > 0]
+            self.fg_counts += np.bincount(index, minlength=self.fg_counts.size).reshape(
+                self.fg_counts.shape
+            )
+            self.fg_tp += np.bincount(
+                index[correct], minlength=self.fg_counts.size
+            ).reshape(self.fg_counts.shape)
+        self.fg_kept = np.ones(len(self.fg_sizes), dtype=bool)
+
+        # the components of the individual classes, their true positives and the component of the joint region they
+        # lie in (0 for classes that are not in classes)
+        (
+            box,
+            lmap,
+            self.component_sizes,
+            self.component_class,
+        ) = class_connected_components(prediction, boxes)
+        self.component_tp = np.zeros_like(self.component_sizes)
+        self.component_parent = np.zeros_like(self.component_sizes)
+        if box is not None:
+            self.component_tp = np.bincount(
+                lmap[prediction[box] == reference[box]],
+                minlength=len(self.component_sizes),
+            )
+            if fg_box is not None:
+                lmap = lmap[
+                    tuple(
+                        slice(f.start - b.start, f.stop - b.start)
+                        for b, f in zip(box, fg_box)
+                    )
+                ]
+                self.component_parent[lmap[fg_lmap > 0]] = fg_lmap[fg_lmap > 0]
+        self.component_kept = np.ones(len(self.component_sizes), dtype=bool)
+
+    def copy(self):
+        """
+        the tables are shared, only which components are kept is copied
+        """
+        other = copy(self)
+        other.fg_kept = self.fg_kept.copy()
+        other.component_kept = self.component_kept.copy()
+        return other
+
+    def remove_all_but_the_largest_connected_component(
+        self, for_which_classes, minimum_valid_object_size=None
+    ):
+        """
+        same as remove_all_but_the_largest_connected_component, but on the tables. for_which_classes may contain the
+        joint region of all classes (before any individual class) and individual classes
+        :return: largest_removed, kept_size
+        """
+        largest_removed = {}
+        kept_size = {}
+        for c in for_which_classes:
+            if isinstance(c, (list, tuple)):
+                c = tuple(c)
+                assert sorted(c) == sorted(
+                    self.classes
+                ), "only the joint region of all classes is supported"
+                assert np.all(self.component_kept), (
+                    "removing components of individual classes can split the components of the joint region, "
+                    "process the joint region first"
+                )
+                object_sizes, kept = self.fg_sizes, self.fg_kept
+                objects = np.flatnonzero(kept[1:]) + 1
+            else:
+                c = int(c)
+                object_sizes, kept = self.component_sizes, self.component_kept
+                # components of the joint region that were removed took their components of c with them
+                objects = np.flatnonzero(
+                    (self.component_class == c)
+                    & kept
+                    & self.fg_kept[self.component_parent]
+                )
+
+            largest_removed[c] = None
+            kept_size[c] = None
+
+            if len(objects) > 0:
+                sizes = object_sizes[objects] * self.volume_per_voxel
+                kept_size[c] = sizes.max()
+                remove = _objects_to_remove(sizes, minimum_valid_object_size, c)
+                if np.any(remove):
+                    largest_removed[c] = sizes[remove].max()
+                    kept[objects[remove]] = False
+        return largest_removed, kept_size
+
+    def dice(self):
+        """
+        :return: dict str(class) -> Dice, like Evaluator.evaluate with metrics=["Dice"]
+        """
+        fg_kept = self.fg_kept.copy()
+        fg_kept[0] = False
+        removed = ~self.component_kept & fg_kept[self.component_parent]
+        test_counts = self.fg_counts[fg_kept].sum(0) - np.bincount(
+            self.component_class[removed],
+            self.component_sizes[removed],
+            minlength=self.num_labels,
+        ).astype(np.int64)
+        tp = self.fg_tp[fg_kept].sum(0) - np.bincount(
+            self.component_class[removed],
+            self.component_tp[removed],
+            minlength=self.num_labels,
+        ).astype(np.int64)
+        result = OrderedDict()
+        for c in self.classes:
+            fp = test_counts[c] - tp[c]
+            fn = self.reference_counts[c] - tp[c]
+            confusion_matrix = ConfusionMatrix()
+            confusion_matrix.set_counts(
+                tp[c], fp, self.num_voxels - tp[c] - fp - fn, fn
+            )
+            result[str(c)] = dice(confusion_matrix=confusion_matrix)
+        return result
+
+
+def load_connected_component_statistics(
+    predicted_segmentation, gt_segmentation, classes
+):
+    img_in = sitk.ReadImage(predicted_segmentation)
+    volume_per_voxel = float(np.prod(img_in.GetSpacing(), dtype=np.float64))
+    return ConnectedComponentStatistics(
+        sitk.GetArrayFromImage(img_in),
+        sitk.GetArrayFromImage(sitk.ReadImage(gt_segmentation)),
+        classes,
+        volume_per_voxel,
+    )
+
+
+def aggregate_dice(statistics):
+    """
+    :param statistics: list of ConnectedComponentStatistics, one per case
+    :return: {str(class): {"Dice": mean over the cases}} like the "mean" entry of a summary.json (aggregate_scores)
+    """
+    per_case = [s.dice() for s in statistics]
+    return OrderedDict(
+        (c, OrderedDict(Dice=float(np.nanmean([d[c] for d in per_case]))))
+        for c in per_case[0].keys()
+    )
+
+
+def load_remove_save_evaluate(
+    input_file: str,
+    output_file: str,
+    gt_file: str,
+    for_which_classes: list,
+    minimum_valid_object_size: dict,
+    classes: list,
+):
+    """
+    load_remove_save followed by the evaluation (like aggregate_scores) of the result, without reading it again
+    :return: the scores of this case, see run_evaluation
+    """
+    img_in = sitk.ReadImage(input_file)
+    volume_per_voxel = float(np.prod(img_in.GetSpacing(), dtype=np.float64))
+    image, _, _ = remove_all_but_the_largest_connected_component(
+        sitk.GetArrayFromImage(img_in),
+        for_which_classes,
+        volume_per_voxel,
+        minimum_valid_object_size,
+    )
+    img_out_itk = sitk.GetImageFromArray(image)
+    img_out_itk = copy_geometry(img_out_itk, img_in)
+    sitk.WriteImage(img_out_itk, output_file)
+
+    evaluator = Evaluator(labels=classes)
+    scores = run_evaluation(
+        (
+            image,
+            sitk.GetArrayFromImage(sitk.ReadImage(gt_file)),
+            evaluator,
+            {"voxel_spacing": np.array(img_in.GetSpacing())[::-1]},
+        )
+    )
+    scores["test"] = output_file
+    scores["reference"] = gt_file
+    return scores
+
+
 def load_postprocessing(json_file):
     """
     loads the relevant part of the pkl file that is needed for applying postprocessing
@@ -140,6 +436,7 @@ def determine_postprocessing(
     debug=False,
     advanced_postprocessing=False,
     pp_filename="postprocessing.json",
+    in_memory=False,
 ):
     """
     :param base:
@@ -150,6 +447,9 @@ def determine_postprocessing(
     :param processes:
     :param dice_threshold: only apply postprocessing if results is better than old_result+dice_threshold (can be used as eps)
     :param debug: if True then the temporary files will not be deleted
+    :param in_memory: if True, every case is read and labeled only once and the postprocessing variants are evaluated
+    on ConnectedComponentStatistics in memory. No temporary files are written, only the final predictions (same
+    results as the default)
     :return:
     """
     # lets see what classes are in the dataset
@@ -164,9 +464,9 @@ def determine_postprocessing(
     folder_all_classes_as_fg = join(base, temp_folder + "_allClasses")
     folder_per_class = join(base, temp_folder + "_perClass")
 
-    if isdir(folder_all_classes_as_fg):
+    if isdir(folder_all_classes_as_fg) and not in_memory:
         shutil.rmtree(folder_all_classes_as_fg)
-    if isdir(folder_per_class):
+    if isdir(folder_per_class) and not in_memory:
         shutil.rmtree(folder_per_class)
 
     # multiprocessing rules
@@ -180,8 +480,9 @@ def determine_postprocessing(
     fnames = subfiles(join(base, raw_subfolder_name), suffix=".nii.gz", join=False)
 
     # make output and temp dir
-    maybe_mkdir_p(folder_all_classes_as_fg)
-    maybe_mkdir_p(folder_per_class)
+    if not in_memory:
+        maybe_mkdir_p(folder_all_classes_as_fg)
+        maybe_mkdir_p(folder_per_class)
     maybe_mkdir_p(join(base, final_subf_name))
 
     pp_results = {}
@@ -202,27 +503,43 @@ def determine_postprocessing(
     pp_results["num_samples"] = len(validation_result_raw["all"])
     validation_result_raw = validation_result_raw["mean"]
 
+    if in_memory:
+        # the connected components of each case, all variants below are evaluated on them
+        statistics = p.starmap(
+            load_connected_component_statistics,
+            [
+                (join(base, raw_subfolder_name, f), join(gt_labels_folder, f), classes)
+                for f in fnames
+            ],
+        )
+
     if advanced_postprocessing:
         # first treat all foreground classes as one and remove all but the largest foreground connected component
-        results = []
-        for f in fnames:
-            predicted_segmentation = join(base, raw_subfolder_name, f)
-            # now remove all but the largest connected component for each class
-            output_file = join(folder_all_classes_as_fg, f)
-            results.append(
-                p.starmap_async(
-                    load_remove_save,
-                    ((predicted_segmentation, output_file, (classes,)),),
+        if in_memory:
+            results = [
+                s.copy().remove_all_but_the_largest_connected_component((classes,))
+                for s in statistics
+            ]
+        else:
+            results = []
+            for f in fnames:
+                predicted_segmentation = join(base, raw_subfolder_name, f)
+                # now remove all but the largest connected component for each class
+                output_file = join(folder_all_classes_as_fg, f)
+                results.append(
+                    p.starmap_async(
+                        load_remove_save,
+                        ((predicted_segmentation, output_file, (classes,)),),
+                    )
                 )
-            )
 
-        results = [i.get() for i in results]
+            results = [i.get()[0] for i in results]
 
         # aggregate max_size_removed and min_size_kept
         max_size_removed = {}
         min_size_kept = {}
         for tmp in results:
-            mx_rem, min_kept = tmp[0]
+            mx_rem, min_kept = tmp
             for k in mx_rem:
                 if mx_rem[k] is not None:
                     if max_size_removed.get(k) is None:
@@ -246,38 +563,45 @@ def determine_postprocessing(
         min_size_kept = None
 
     # we need to rerun the step from above, now with the size constraint
-    pred_gt_tuples = []
-    results = []
-    # first treat all foreground classes as one and remove all but the largest foreground connected component
-    for f in fnames:
-        predicted_segmentation = join(base, raw_subfolder_name, f)
-        # now remove all but the largest connected component for each class
-        output_file = join(folder_all_classes_as_fg, f)
-        results.append(
-            p.starmap_async(
-                load_remove_save,
-                ((predicted_segmentation, output_file, (classes,), min_size_kept),),
+    if in_memory:
+        statistics_all_classes_as_fg = [s.copy() for s in statistics]
+        for s in statistics_all_classes_as_fg:
+            s.remove_all_but_the_largest_connected_component((classes,), min_size_kept)
+        validation_result_PP_test = aggregate_dice(statistics_all_classes_as_fg)
+    else:
+        pred_gt_tuples = []
+        results = []
+        # first treat all foreground classes as one and remove all but the largest foreground connected component
+        for f in fnames:
+            predicted_segmentation = join(base, raw_subfolder_name, f)
+            # now remove all but the largest connected component for each class
+            output_file = join(folder_all_classes_as_fg, f)
+            results.append(
+                p.starmap_async(
+                    load_remove_save,
+                    ((predicted_segmentation, output_file, (classes,), min_size_kept),),
+                )
             )
-        )
-        pred_gt_tuples.append([output_file, join(gt_labels_folder, f)])
+            pred_gt_tuples.append([output_file, join(gt_labels_folder, f)])
 
-    _ = [i.get() for i in results]
+        _ = [i.get() for i in results]
 
-    # evaluate postprocessed predictions
-    _ = aggregate_scores(
-        pred_gt_tuples,
-        labels=classes,
-        json_output_file=join(folder_all_classes_as_fg, "summary.json"),
-        json_author="Fabian",
-        num_threads=processes,
-    )
+        # evaluate postprocessed predictions
+        _ = aggregate_scores(
+            pred_gt_tuples,
+            labels=classes,
+            json_output_file=join(folder_all_classes_as_fg, "summary.json"),
+            json_author="Fabian",
+            num_threads=processes,
+        )
+
+        validation_result_PP_test = load_json(
+            join(folder_all_classes_as_fg, "summary.json")
+        )["results"]["mean"]
 
     # now we need to figure out if doing this improved the dice scores. We will implement that defensively in so far
     # that if a single class got worse as a result we won't do this. We can change this in the future but right now I
     # prefer to do it this way
-    validation_result_PP_test = load_json(
-        join(folder_all_classes_as_fg, "summary.json")
-    )["results"]["mean"]
 
     for c in classes:
         dc_raw = validation_result_raw[str(c)]["Dice"]
@@ -327,27 +651,35 @@ def determine_postprocessing(
             source = folder_all_classes_as_fg
         else:
             source = join(base, raw_subfolder_name)
+        if in_memory:
+            source_statistics = statistics_all_classes_as_fg if do_fg_cc else statistics
 
         if advanced_postprocessing:
             # now run this for each class separately
-            results = []
-            for f in fnames:
-                predicted_segmentation = join(source, f)
-                output_file = join(folder_per_class, f)
-                results.append(
-                    p.starmap_async(
-                        load_remove_save,
-                        ((predicted_segmentation, output_file, classes),),
+            if in_memory:
+                results = [
+                    s.copy().remove_all_but_the_largest_connected_component(classes)
+                    for s in source_statistics
+                ]
+            else:
+                results = []
+                for f in fnames:
+                    predicted_segmentation = join(source, f)
+                    output_file = join(folder_per_class, f)
+                    results.append(
+                        p.starmap_async(
+                            load_remove_save,
+                            ((predicted_segmentation, output_file, classes),),
+                        )
                     )
-                )
 
-            results = [i.get() for i in results]
+                results = [i.get()[0] for i in results]
 
             # aggregate max_size_removed and min_size_kept
             max_size_removed = {}
             min_size_kept = {}
             for tmp in results:
-                mx_rem, min_kept = tmp[0]
+                mx_rem, min_kept = tmp
                 for k in mx_rem:
                     if mx_rem[k] is not None:
                         if max_size_removed.get(k) is None:
@@ -368,29 +700,41 @@ def determine_postprocessing(
             min_size_kept = None
 
         # rerun with the size thresholds from above
-        pred_gt_tuples = []
-        results = []
-        for f in fnames:
-            predicted_segmentation = join(source, f)
-            output_file = join(folder_per_class, f)
-            results.append(
-                p.starmap_async(
-                    load_remove_save,
-                    ((predicted_segmentation, output_file, classes, min_size_kept),),
+        if in_memory:
+            statistics_per_class = [s.copy() for s in source_statistics]
+            for s in statistics_per_class:
+                s.remove_all_but_the_largest_connected_component(classes, min_size_kept)
+        else:
+            pred_gt_tuples = []
+            results = []
+            for f in fnames:
+                predicted_segmentation = join(source, f)
+                output_file = join(folder_per_class, f)
+                results.append(
+                    p.starmap_async(
+                        load_remove_save,
+                        (
+                            (
+                                predicted_segmentation,
+                                output_file,
+                                classes,
+                                min_size_kept,
+                            ),
+                        ),
+                    )
                 )
-            )
-            pred_gt_tuples.append([output_file, join(gt_labels_folder, f)])
+                pred_gt_tuples.append([output_file, join(gt_labels_folder, f)])
 
-        _ = [i.get() for i in results]
+            _ = [i.get() for i in results]
 
-        # evaluate postprocessed predictions
-        _ = aggregate_scores(
-            pred_gt_tuples,
-            labels=classes,
-            json_output_file=join(folder_per_class, "summary.json"),
-            json_author="Fabian",
-            num_threads=processes,
-        )
+            # evaluate postprocessed predictions
+            _ = aggregate_scores(
+                pred_gt_tuples,
+                labels=classes,
+                json_output_file=join(folder_per_class, "summary.json"),
+                json_author="Fabian",
+                num_threads=processes,
+            )
 
         if do_fg_cc:
             old_res = deepcopy(validation_result_PP_test)
@@ -398,9 +742,12 @@ def determine_postprocessing(
             old_res = validation_result_raw
 
         # these are the new dice scores
-        validation_result_PP_test = load_json(join(folder_per_class, "summary.json"))[
-            "results"
-        ]["mean"]
+        if in_memory:
+            validation_result_PP_test = aggregate_dice(statistics_per_class)
+        else:
+            validation_result_PP_test = load_json(
+                join(folder_per_class, "summary.json")
+            )["results"]["mean"]
         
         class_check=[1,11,2,3,4,6,7,8]
         classes_dice=[]
@@ -450,38 +797,63 @@ def determine_postprocessing(
 
         # now remove all but the largest connected component for each class
         output_file = join(base, final_subf_name, f)
-        results.append(
-            p.starmap_async(
-                load_remove_save,
-                (
+        if in_memory:
+            # evaluated right away instead of reading the result again
+            results.append(
+                p.starmap_async(
+                    load_remove_save_evaluate,
                     (
-                        predicted_segmentation,
-                        output_file,
-                        pp_results["for_which_classes"],
-                        pp_results["min_valid_object_sizes"],
+                        (
+                            predicted_segmentation,
+                            output_file,
+                            join(gt_labels_folder, f),
+                            pp_results["for_which_classes"],
+                            pp_results["min_valid_object_sizes"],
+                            classes,
+                        ),
                     ),
-                ),
+                )
+            )
+        else:
+            results.append(
+                p.starmap_async(
+                    load_remove_save,
+                    (
+                        (
+                            predicted_segmentation,
+                            output_file,
+                            pp_results["for_which_classes"],
+                            pp_results["min_valid_object_sizes"],
+                        ),
+                    ),
+                )
             )
-        )
 
         pred_gt_tuples.append([output_file, join(gt_labels_folder, f)])
 
-    _ = [i.get() for i in results]
+    results = [i.get()[0] for i in results]
     # evaluate postprocessed predictions
-    _ = aggregate_scores(
-        pred_gt_tuples,
-        labels=classes,
-        json_output_file=join(base, final_subf_name, "summary.json"),
-        json_author="Fabian",
-        num_threads=processes,
-    )
+    if in_memory:
+        _ = summarize_scores(
+            results,
+            json_output_file=join(base, final_subf_name, "summary.json"),
+            json_author="Fabian",
+        )
+    else:
+        _ = aggregate_scores(
+            pred_gt_tuples,
+            labels=classes,
+            json_output_file=join(base, final_subf_name, "summary.json"),
+            json_author="Fabian",
+            num_threads=processes,
+        )
 
     pp_results["min_valid_object_sizes"] = str(pp_results["min_valid_object_sizes"])
 
     save_json(pp_results, join(base, pp_filename))
 
     # delete temp
-    if not debug:
+    if not debug and not in_memory:
         shutil.rmtree(folder_per_class)
         shutil.rmtree(folder_all_classes_as_fg)
 
@@ -13,18 +13,26 @@
 #    limitations under the License.
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 from batchgenerators.augmentations.utils import resize_segmentation
 from d_lka_former.configuration import (
     default_num_threads,
     RESAMPLING_SEPARATE_Z_ANISO_THRESHOLD,
+    default_storage_format,
 )
 from d_lka_former.preprocessing.cropping import (
     get_case_identifier_from_npz,
     ImageCropper,
 )
+from d_lka_former.utilities.chunked_volume import save_chunked
+from d_lka_former.utilities.class_locations import (
+    compute_class_locations,
+    save_class_locations,
+)
 from skimage.transform import resize
+from scipy.ndimage import find_objects
 from scipy.ndimage.interpolation import map_coordinates
 import numpy as np
 from batchgenerators.utilities.file_and_folder_operations import *
@@ -58,6 +66,7 @@ def resample_patient(
     order_z_data=0,
     order_z_seg=0,
     separate_z_anisotropy_threshold=RESAMPLING_SEPARATE_Z_ANISO_THRESHOLD,
+    num_threads=1,
 ):
     """
     :param cval_seg:
@@ -74,6 +83,7 @@ def resample_patient(
     :param order_z_data: only applies if do_separate_z is True
     :param separate_z_anisotropy_threshold: if max_spacing > separate_z_anisotropy_threshold * min_spacing (per axis)
     then resample along lowres axis with order_z_data/order_z_seg instead of order_data/order_seg
+    :param num_threads: see resample_data_or_seg
 
     :return:
     """
@@ -129,6 +139,7 @@ def resample_patient(
             do_separate_z,
             cval=cval_data,
             order_z=order_z_data,
+            num_threads=num_threads,
         )
     else:
         data_reshaped = None
@@ -142,16 +153,272 @@ def resample_patient(
             do_separate_z,
             cval=cval_seg,
             order_z=order_z_seg,
+            num_threads=num_threads,
         )
     else:
         seg_reshaped = None
     return data_reshaped, seg_reshaped
 
 
+# cache for _axis_operator, the same shapes come up for every channel and often for every case
+_axis_operators = {}
+
+
+def _axis_operator(old_size, new_size, order, along_z=False):
+    """
+    Resampling along one axis is linear, so it can be written as a (new_size, old_size) matrix. We get that matrix by
+    resampling the identity with exactly the function resample_data_or_seg_slicewise uses: skimage's resize (mode
+    edge, no anti aliasing, no clipping) in plane and map_coordinates (mode nearest) along z. Resampling a volume along
+    several axes is the same as applying the matrices of the axes one after the other because the splines of
+    skimage/scipy are separable.
+
+    For order 0 every row has a single 1, so we return the column of the 1 instead (use it with np.take)
+    """
+    key = (int(old_size), int(new_size), int(order), along_z)
+    if key not in _axis_operators.keys():
+        identity = np.eye(old_size)
+        if along_z:
+            scale = float(old_size) / new_size
+            coords = np.array(
+                np.meshgrid(
+                    scale * (np.arange(new_size) + 0.5) - 0.5,
+                    np.arange(old_size),
+                    indexing="ij",
+                )
+            )
+            operator = map_coordinates(identity, coords, order=order, mode="nearest")
+        else:
+            operator = resize(
+                identity,
+                (new_size, old_size),
+                order,
+                mode="edge",
+                anti_aliasing=False,
+                clip=False,
+            )
+        if order == 0:
+            operator = np.argmax(operator, 1)
+        _axis_operators[key] = operator
+    return _axis_operators[key]
+
+
+def _operator_taps(operator, max_taps=4):
+    """
+    Linear (and nearest) interpolation only has a few nonzero entries per row, it is much faster to apply these as a
+    few weighted np.take than as a matrix product. Returns the columns and weights of the nonzero band of each row or
+    None if the band is wider than max_taps (cubic splines have a dense operator because of the prefilter)
+    """
+    nonzero = operator != 0
+    has_nonzero = np.any(nonzero, 1)
+    first = np.where(has_nonzero, np.argmax(nonzero, 1), 0)
+    last = np.where(
+        has_nonzero, operator.shape[1] - 1 - np.argmax(nonzero[:, ::-1], 1), 0
+    )
+    num_taps = int(np.max(last - first)) + 1
+    if num_taps > max_taps:
+        return None
+    columns = first[:, None] + np.arange(num_taps)
+    weights = np.take_along_axis(
+        operator, np.minimum(columns, operator.shape[1] - 1), 1
+    )
+    weights[columns >= operator.shape[1]] = 0
+    return np.minimum(columns, operator.shape[1] - 1), weights
+
+
+def _apply_axis_operator(x, operator, axis, executor=None):
+    """
+    Resamples x along axis with an operator from _axis_operator. With an executor, x is split along its largest other
+    axis and the parts are done in parallel (matrix products and np.take release the GIL)
+    """
+    out_shape = list(x.shape)
+    out_shape[axis] = len(operator)
+    out = np.empty(out_shape, dtype=x.dtype)
+    taps = _operator_taps(operator) if operator.ndim == 2 else None
+    weight_shape = [1] * x.ndim
+    weight_shape[axis] = -1
+
+    def apply(slicer):
+        part = x[slicer]
+        if operator.ndim == 1:
+            out[slicer] = np.take(part, operator, axis=axis)
+        elif taps is not None:
+            columns, weights = taps
+            result = np.take(part, columns[:, 0], axis=axis)
+            result *= weights[:, 0].reshape(weight_shape)
+            for j in range(1, columns.shape[1]):
+                result += np.take(part, columns[:, j], axis=axis) * weights[
+                    :, j
+                ].reshape(weight_shape)
+            out[slicer] = result
+        else:
+            out[slicer] = np.moveaxis(
+                np.tensordot(operator, part, axes=(1, axis)), 0, axis
+            )
+
+    if executor is None:
+        apply((slice(None),) * x.ndim)
+        return out
+    split_axis = max([i for i in range(x.ndim) if i != axis], key=lambda i: x.shape[i])
+    # many small parts keep all threads busy even if some parts are slower
+    num_parts = min(x.shape[split_axis], 32)
+    bounds = np.linspace(0, x.shape[split_axis], num_parts + 1).astype(int)
+    slicers = []
+    for lb, ub in zip(bounds[:-1], bounds[1:]):
+        slicer = [slice(None)] * x.ndim
+        slicer[split_axis] = slice(lb, ub)
+        slicers.append(tuple(slicer))
+    list(executor.map(apply, slicers))
+    return out
+
+
+def _resample_labels(seg, operators, threshold, executor=None):
+    """
+    Label aware resampling like resize_segmentation: every label is resampled as a binary mask and voxels where the mask
+    passes threshold get that label (later labels win). Each mask is only resampled within the bounding box of its
+    label: the columns of the operators outside of it would multiply zeros, so they are dropped, and so are the rows
+    (output voxels) that would only get zeros. The bounding boxes of all labels are found in one pass
+
+    :param operators: list of (axis, operator) for the spatial axes of seg (x, y, z), operator must be a matrix
+    :param threshold: function of the resampled masks that returns where the label is set
+    """
+    labels = np.unique(seg)
+    out_shape = list(seg.shape)
+    for axis, operator in operators:
+        out_shape[axis] = len(operator)
+    out = np.zeros(out_shape, dtype=seg.dtype)
+    if np.all(labels == np.round(labels)):
+        # find_objects wants labels 1, 2, ...
+        boxes = find_objects((seg - labels[0] + 1).astype(np.int32))
+        boxes = [boxes[int(l - labels[0])] for l in labels]
+    else:
+        boxes = [(slice(None),) * seg.ndim] * len(labels)
+    if labels[0] == 0:
+        # out is 0 already and nothing was set before the first label
+        labels, boxes = labels[1:], boxes[1:]
+
+    def resample(label, box):
+        mask = (seg[box] == label).astype(float)
+        out_box = list(box)
+        for axis, operator in operators:
+            operator = operator[:, box[axis]]
+            rows = np.flatnonzero(np.any(operator != 0, 1))
+            if len(rows) == 0:
+                return None, None
+            out_box[axis] = slice(rows[0], rows[-1] + 1)
+            mask = _apply_axis_operator(mask, operator[out_box[axis]], axis)
+        return tuple(out_box), threshold(mask)
+
+    if executor is None:
+        results = map(resample, labels, boxes)
+    else:
+        results = executor.map(resample, labels, boxes)
+    for label, (out_box, mask) in zip(labels, results):
+        if out_box is not None:
+            out[out_box][mask] = label
+    return out
+
+
 def resample_data_or_seg(
+    data,
+    new_shape,
+    is_seg,
+    axis=None,
+    order=3,
+    do_separate_z=False,
+    cval=0,
+    order_z=0,
+    num_threads=1,
+):
+    """
+    separate_z=True will resample with order 0 along z
+
+    Gives the same result as resample_data_or_seg_slicewise (up to floating point rounding), but instead of calling
+    skimage's resize for every channel and slice, the whole volume is resampled one axis at a time with precomputed
+    1D operators (see _axis_operator). Segmentations with order > 0 resample the masks of several labels at once.
+    :param data:
+    :param new_shape:
+    :param is_seg:
+    :param axis:
+    :param order:
+    :param do_separate_z:
+    :param cval: not used, all our resampling extends the border (mode edge/nearest)
+    :param order_z: only applies if do_separate_z is True
+    :param num_threads: number of threads each resampling step is split into
+    :return:
+    """
+    assert len(data.shape) == 4, "data must be (c, x, y, z)"
+    dtype_data = data.dtype
+    data = data.astype(float)
+    shape = np.array(data[0].shape)
+    new_shape = np.array(new_shape)
+    if not np.any(shape != new_shape):
+        print("no resampling necessary")
+        return data
+
+    if do_separate_z:
+        print("separate z, order in z is", order_z, "order inplane is", order)
+        assert len(axis) == 1, "only one anisotropic axis supported"
+        axis = axis[0]
+        inplane_axes = tuple(i for i in range(3) if i != axis)
+    else:
+        print("no separate z, order", order)
+        inplane_axes = (0, 1, 2)
+    # the axes that shrink the most go first, that leaves less work for the others
+    inplane_operators = [
+        (a, _axis_operator(shape[a], new_shape[a], order))
+        for a in sorted(inplane_axes, key=lambda a: new_shape[a] / shape[a])
+        if shape[a] != new_shape[a]
+    ]
+    if do_separate_z and shape[axis] != new_shape[axis]:
+        z_operator = _axis_operator(shape[axis], new_shape[axis], order_z, True)
+    else:
+        z_operator = None
+
+    executor = ThreadPoolExecutor(num_threads) if num_threads > 1 else None
+    try:
+        reshaped_final_data = []
+        for c in range(data.shape[0]):
+            reshaped = data[c]
+            if is_seg and order > 0:
+                reshaped = _resample_labels(
+                    reshaped, inplane_operators, lambda m: m >= 0.5, executor
+                )
+            else:
+                for a, operator in inplane_operators:
+                    reshaped = _apply_axis_operator(reshaped, operator, a, executor)
+                if not is_seg:
+                    # skimage's resize clips to the value range of its input, which is a slice if do_separate_z
+                    reshaped = np.clip(
+                        reshaped,
+                        data[c].min(axis=inplane_axes, keepdims=True),
+                        data[c].max(axis=inplane_axes, keepdims=True),
+                    )
+            if z_operator is not None:
+                if not is_seg or order_z == 0:
+                    reshaped = _apply_axis_operator(
+                        reshaped, z_operator, axis, executor
+                    )
+                else:
+                    reshaped = _resample_labels(
+                        reshaped,
+                        [(axis, z_operator)],
+                        lambda m: np.round(m) > 0.5,
+                        executor,
+                    )
+            reshaped_final_data.append(reshaped[None])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return np.vstack(reshaped_final_data).astype(dtype_data)
+
+
+def resample_data_or_seg_slicewise(
     data, new_shape, is_seg, axis=None, order=3, do_separate_z=False, cval=0, order_z=0
 ):
     """
+    The original implementation of resample_data_or_seg, one skimage resize per channel and slice. It is kept as the
+    reference that resample_data_or_seg is checked against (see benchmarking/resampling.py)
+
     separate_z=True will resample with order 0 along z
     :param data:
     :param new_shape:
@@ -301,6 +568,8 @@ class GenericPreprocessor(object):
         self.resample_separate_z_anisotropy_threshold = (
             RESAMPLING_SEPARATE_Z_ANISO_THRESHOLD
         )
+        # "npz", "chunked" or "both", see configuration.py
+        self.storage_format = default_storage_format
 
     @staticmethod
     def load_cropped(cropped_output_dir, case_identifier):
@@ -455,32 +724,34 @@ class GenericPreprocessor(object):
         # we need to find out where the classes are and sample some random locations
         # let's do 10.000 samples per class
         # seed this for reproducibility!
-        num_samples = 10000
-        min_percent_coverage = 0.01  # at least 1% of the class voxels need to be selected, otherwise it may be too sparse
-        rndst = np.random.RandomState(1234)
-        class_locs = {}
-        for c in all_classes:
-            all_locs = np.argwhere(all_data[-1] == c)
-            if len(all_locs) == 0:
-                class_locs[c] = []
-                continue
-            target_num_samples = min(num_samples, len(all_locs))
-            target_num_samples = max(
-                target_num_samples, int(np.ceil(len(all_locs) * min_percent_coverage))
-            )
-
-            selected = all_locs[
-                rndst.choice(len(all_locs), target_num_samples, replace=False)
-            ]
-            class_locs[c] = selected
-            print(c, target_num_samples)
-        properties["class_locations"] = class_locs
-
-        print("saving: ", os.path.join(output_folder_stage, "%s.npz" % case_identifier))
-        np.savez_compressed(
-            os.path.join(output_folder_stage, "%s.npz" % case_identifier),
-            data=all_data.astype(np.float32),
+        # they are stored next to the data (and not in the properties) so that the data loaders don't have to unpickle
+        # them for every sample
+        class_locs = compute_class_locations(
+            all_data[-1], all_classes, num_samples=10000, min_percent_coverage=0.01
         )
+        save_class_locations(
+            os.path.join(output_folder_stage, "%s.classlocs" % case_identifier),
+            class_locs,
+        )
+
+        if self.storage_format in ("npz", "both"):
+            print(
+                "saving: ",
+                os.path.join(output_folder_stage, "%s.npz" % case_identifier),
+            )
+            np.savez_compressed(
+                os.path.join(output_folder_stage, "%s.npz" % case_identifier),
+                data=all_data.astype(np.float32),
+            )
+        if self.storage_format in ("chunked", "both"):
+            print(
+                "saving: ",
+                os.path.join(output_folder_stage, "%s.chunks" % case_identifier),
+            )
+            save_chunked(
+                os.path.join(output_folder_stage, "%s.chunks" % case_identifier),
+                all_data.astype(np.float32),
+            )
         with open(
             os.path.join(output_folder_stage, "%s.pkl" % case_identifier), "wb"
         ) as f:
@@ -0,0 +1,593 @@
+from time import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from batchgenerators.dataloading import MultiThreadedAugmenter
+from batchgenerators.transforms import Compose
+from batchgenerators.transforms.utility_transforms import NumpyToTensor
+from d_lka_former.training.data_augmentation.default_data_augmentation import (
+    default_3D_augmentation_params,
+)
+
+
+def _uniform(value_range):
+    if value_range[0] == value_range[1]:
+        return value_range[0]
+    return np.random.uniform(value_range[0], value_range[1])
+
+
+def _sample_factor(value_range):
+    """
+    Same as batchgenerators: with probability 0.5 the factor is < 1 (if the range allows that), otherwise >= 1
+    """
+    if np.random.random() < 0.5 and value_range[0] < 1:
+        return np.random.uniform(value_range[0], 1)
+    return np.random.uniform(max(value_range[0], 1), value_range[1])
+
+
+def _rotation_matrix_3d(angle_x, angle_y, angle_z):
+    """
+    The rotation of batchgenerators' rotate_coords_3d (which multiplies the coordinates from the right, so this is the
+    transpose of what it builds)
+    """
+    cx, sx = np.cos(angle_x), np.sin(angle_x)
+    cy, sy = np.cos(angle_y), np.sin(angle_y)
+    cz, sz = np.cos(angle_z), np.sin(angle_z)
+    rot_x = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    rot_y = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rot_z = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    return (rot_x @ rot_y @ rot_z).T
+
+
+def gaussian_smooth(x, sigma, padding_mode="constant"):
+    """
+    Separable gaussian filter over the spatial axes of x (b, c, x, y, z), truncated at 4 sigma like
+    scipy.ndimage.gaussian_filter. Every channel is filtered on its own
+
+    :param sigma: one value for all axes
+    :param padding_mode: 'constant' (zeros) or 'reflect'
+    """
+    radius = int(4 * sigma + 0.5)
+    if radius == 0:
+        return x
+    kernel = torch.arange(-radius, radius + 1, device=x.device, dtype=x.dtype)
+    kernel = torch.exp(-0.5 * (kernel / sigma) ** 2)
+    kernel = kernel / kernel.sum()
+    num_channels = x.shape[1]
+    for axis in range(3):
+        shape = [1, 1, 1]
+        shape[axis] = -1
+        weight = kernel.view([1, 1] + shape).repeat(num_channels, 1, 1, 1, 1)
+        pad = [0] * 6
+        # F.pad lists the last axis first
+        pad[(2 - axis) * 2] = pad[(2 - axis) * 2 + 1] = radius
+        x = F.pad(x, pad, mode=padding_mode)
+        x = F.conv3d(x, weight, groups=num_channels)
+    return x
+
+
+class TorchAugmentation(object):
+    def __init__(
+        self,
+        patch_size,
+        params=default_3D_augmentation_params,
+        border_val_seg=-1,
+        order_seg=1,
+        order_data=3,
+        deep_supervision_scales=None,
+        training=True,
+    ):
+        """
+        The transforms of get_moreDA_augmentation, done on whole batches of torch tensors so that they can run on the
+        GPU we train on. params has the same meaning as for get_moreDA_augmentation. What differs:
+
+        - the spatial transform samples the data with grid_sample, which only knows nearest and (tri)linear
+          interpolation. order_data 0 is nearest, everything else linear (batchgenerators uses cubic by default)
+        - with order_seg 1, the segmentation is interpolated linearly per label (like batchgenerators). Voxels that
+          fall outside of the input get border_val_seg
+        - elastic deformation fields are smoothed on a coarser grid and upsampled, which is a lot cheaper for the
+          large sigmas we use and looks the same
+        - SimulateLowResolution upsamples linearly instead of cubic
+        - cascade augmentations, regions, soft deep supervision and dummy 2D are not supported
+
+        Scalar parameters (which transform is applied, angles, factors) are drawn with np.random, just like in the
+        batchgenerators transforms. Noise fields are drawn with torch.
+
+        :param patch_size: size of the patches after the spatial transform. Ignored if training is False
+        :param training: False gives the validation transforms (no augmentation, just channel selection, removing
+        label -1 and deep supervision downsampling)
+        """
+        assert (
+            params.get("mirror") is None
+        ), "old version of params, use new keyword do_mirror"
+        assert not params.get(
+            "dummy_2D"
+        ), "dummy 2D is not supported, use batchgenerators"
+        assert not params.get(
+            "move_last_seg_chanel_to_data"
+        ), "the cascade is not supported, use batchgenerators"
+        self.patch_size = tuple(int(i) for i in patch_size)
+        self.params = params
+        self.border_val_seg = border_val_seg
+        self.order_seg = order_seg
+        self.order_data = order_data
+        self.deep_supervision_scales = deep_supervision_scales
+        self.training = training
+        if params.get("border_mode_data") in ("constant", None):
+            self.padding_mode_data = "zeros"
+        elif params.get("border_mode_data") == "nearest":
+            self.padding_mode_data = "border"
+        else:
+            self.padding_mode_data = "reflection"
+
+    def __call__(self, data, seg):
+        """
+        :param data: (b, c, x, y, z) float tensor
+        :param seg: (b, c, x, y, z) tensor, same device as data
+        :return: data, target (a list of tensors if deep_supervision_scales is given)
+        """
+        params = self.params
+        if params.get("selected_data_channels") is not None:
+            data = data[:, params.get("selected_data_channels")]
+        if params.get("selected_seg_channels") is not None:
+            seg = seg[:, params.get("selected_seg_channels")]
+        data = data.float()
+        seg = seg.float()
+
+        if self.training:
+            data, seg = self.spatial_transform(data, seg)
+            data = self.gaussian_noise(data, p_per_sample=0.1)
+            data = self.gaussian_blur(
+                data, (0.5, 1.0), p_per_sample=0.2, p_per_channel=0.5
+            )
+            data = self.brightness_multiplicative(data, (0.75, 1.25), p_per_sample=0.15)
+            if params.get("do_additive_brightness"):
+                data = self.brightness_additive(
+                    data,
+                    params.get("additive_brightness_mu"),
+                    params.get("additive_brightness_sigma"),
+                    params.get("additive_brightness_p_per_sample"),
+                    params.get("additive_brightness_p_per_channel"),
+                )
+            data = self.contrast(data, (0.75, 1.25), p_per_sample=0.15)
+            data = self.simulate_low_resolution(
+                data, (0.5, 1), p_per_sample=0.25, p_per_channel=0.5
+            )
+            # inverted gamma
+            data = self.gamma(
+                data,
+                params.get("gamma_range"),
+                invert_image=True,
+                retain_stats=params.get("gamma_retain_stats"),
+                p_per_sample=0.1,
+            )
+            if params.get("do_gamma"):
+                data = self.gamma(
+                    data,
+                    params.get("gamma_range"),
+                    invert_image=False,
+                    retain_stats=params.get("gamma_retain_stats"),
+                    p_per_sample=params["p_gamma"],
+                )
+            if params.get("do_mirror"):
+                data, seg = self.mirror(data, seg, params.get("mirror_axes"))
+            if params.get("mask_was_used_for_normalization") is not None:
+                data = self.mask(
+                    data, seg, params.get("mask_was_used_for_normalization")
+                )
+
+        seg[seg == -1] = 0
+
+        if self.deep_supervision_scales is not None:
+            return data, self.downsample_seg_for_ds(seg, self.deep_supervision_scales)
+        return data, seg
+
+    def spatial_transform(self, data, seg):
+        """
+        Elastic deformation, rotation and scaling (in this order, like SpatialTransform) followed by a center crop to
+        patch_size. Samples that draw none of them are just cropped
+        """
+        params = self.params
+        b = data.shape[0]
+        device = data.device
+        matrices = []
+        displacements = []
+        transformed = []
+        for i in range(b):
+            modified = False
+            displacement = None
+            if params.get("do_elastic") and np.random.uniform() < params.get("p_eldef"):
+                displacement = self.elastic_displacement(
+                    _uniform(params.get("elastic_deform_alpha")),
+                    _uniform(params.get("elastic_deform_sigma")),
+                    device,
+                )
+                modified = True
+
+            matrix = np.eye(3)
+            if params.get("do_rotation") and np.random.uniform() < params.get("p_rot"):
+                angles = []
+                for key in ("rotation_x", "rotation_y", "rotation_z"):
+                    if np.random.uniform() <= params.get("rotation_p_per_axis"):
+                        angles.append(_uniform(params.get(key)))
+                    else:
+                        angles.append(0)
+                matrix = _rotation_matrix_3d(*angles) @ matrix
+                modified = True
+
+            if params.get("do_scaling") and np.random.uniform() < params.get("p_scale"):
+                scale_range = params.get("scale_range")
+                if params.get("independent_scale_factor_for_each_axis"):
+                    scale = [_sample_factor(scale_range) for _ in range(3)]
+                else:
+                    scale = [_sample_factor(scale_range)] * 3
+                matrix = np.diag(scale) @ matrix
+                modified = True
+
+            if modified:
+                transformed.append(i)
+                matrices.append(matrix)
+                displacements.append(displacement)
+
+        data_out = self._center_crop(data)
+        seg_out = self._center_crop(seg)
+        if len(transformed) > 0:
+            grid = self._sampling_grid(matrices, displacements, data.shape[2:], device)
+            data_out[transformed] = F.grid_sample(
+                data[transformed],
+                grid,
+                mode="nearest" if self.order_data == 0 else "bilinear",
+                padding_mode=self.padding_mode_data,
+                align_corners=True,
+            )
+            seg_out[transformed] = self._sample_seg(seg[transformed], grid)
+        return data_out, seg_out
+
+    def _center_crop(self, x):
+        slicer = [slice(None), slice(None)]
+        for s, p in zip(x.shape[2:], self.patch_size):
+            assert s >= p, "the data loader must return patches of at least patch_size"
+            lb = (s - p) // 2
+            slicer.append(slice(lb, lb + p))
+        return x[tuple(slicer)].clone()
+
+    def _sampling_grid(self, matrices, displacements, input_shape, device):
+        """
+        grid for grid_sample (align_corners=True). Coordinates are in voxels relative to the center of the output
+        patch, transformed, and then placed at the center of the input
+        """
+        coords = torch.stack(
+            torch.meshgrid(
+                *[
+                    torch.arange(p, device=device, dtype=torch.float32) - (p - 1) / 2
+                    for p in self.patch_size
+                ],
+                indexing="ij"
+            )
+        )
+        coords = coords[None].repeat(len(matrices), 1, 1, 1, 1)
+        for i, displacement in enumerate(displacements):
+            if displacement is not None:
+                coords[i] += displacement
+        matrices = torch.as_tensor(
+            np.stack(matrices), dtype=torch.float32, device=device
+        )
+        coords = torch.einsum("bij,bjxyz->bixyz", matrices, coords)
+        half_extent = torch.tensor(
+            [(s - 1) / 2 for s in input_shape], dtype=torch.float32, device=device
+        ).view(1, 3, 1, 1, 1)
+        coords = coords / half_extent
+        # grid_sample wants (b, x, y, z, 3) with the last axis of the input first
+        return coords.flip(1).permute(0, 2, 3, 4, 1).contiguous()
+
+    def _sample_seg(self, seg, grid):
+        if self.order_seg == 0:
+            # shifting makes voxels outside of the input (zero padding) come out as border_val_seg
+            shifted = seg - self.border_val_seg
+            return (
+                F.grid_sample(shifted, grid, mode="nearest", align_corners=True)
+                + self.border_val_seg
+            )
+        out = torch.full(
+            (seg.shape[0], seg.shape[1]) + self.patch_size,
+            self.border_val_seg,
+            dtype=seg.dtype,
+            device=seg.device,
+        )
+        for c in range(seg.shape[1]):
+            labels = torch.unique(seg[:, c])
+            best = torch.zeros_like(out[:, c])
+            for label in labels:
+                if label == self.border_val_seg:
+                    continue
+                interpolated = F.grid_sample(
+                    (seg[:, c : c + 1] == label).float(),
+                    grid,
+                    mode="bilinear",
+                    align_corners=True,
+                )[:, 0]
+                take = (interpolated >= 0.5) & (interpolated > best)
+                out[:, c][take] = label
+                best = torch.maximum(best, interpolated)
+        return out
+
+    def elastic_displacement(self, alpha, sigma, device):
+        """
+        Like batchgenerators' elastic_deform_coordinates: uniform noise in [-1, 1], smoothed with a gaussian of sigma
+        voxels, times alpha. The smoothing is done on a grid that is coarser by a factor of about sigma / 3. The noise
+        there is scaled down so that its smoothed version has the same magnitude as on the full grid
+        """
+        factor = max(1, int(sigma // 3))
+        coarse_shape = [int(np.ceil(p / factor)) + 1 for p in self.patch_size]
+        noise = torch.rand([1, 3] + coarse_shape, device=device) * 2 - 1
+        noise = noise / factor**1.5
+        noise = gaussian_smooth(noise, sigma / factor) * alpha
+        noise = F.interpolate(
+            noise,
+            size=[c * factor for c in coarse_shape],
+            mode="trilinear",
+            align_corners=False,
+        )
+        return noise[
+            0, :, : self.patch_size[0], : self.patch_size[1], : self.patch_size[2]
+        ]
+
+    @staticmethod
+    def _select(num, p):
+        return [i for i in range(num) if np.random.uniform() < p]
+
+    def gaussian_noise(self, data, noise_variance=(0, 0.1), p_per_sample=1):
+        for i in self._select(data.shape[0], p_per_sample):
+            # batchgenerators uses the drawn 'variance' as standard deviation
+            std = _uniform(noise_variance)
+            data[i] += torch.randn_like(data[i]) * std
+        return data
+
+    def gaussian_blur(self, data, sigma_range, p_per_sample=1, p_per_channel=1):
+        for i in self._select(data.shape[0], p_per_sample):
+            for c in self._select(data.shape[1], p_per_channel):
+                data[i, c] = gaussian_smooth(
+                    data[i : i + 1, c : c + 1], _uniform(sigma_range), "reflect"
+                )[0, 0]
+        return data
+
+    def brightness_multiplicative(self, data, multiplier_range, p_per_sample=1):
+        factors = np.ones(data.shape[:2])
+        for i in self._select(data.shape[0], p_per_sample):
+            factors[i] = np.random.uniform(
+                multiplier_range[0], multiplier_range[1], size=data.shape[1]
+            )
+        return data * torch.as_tensor(
+            factors, dtype=data.dtype, device=data.device
+        ).view(data.shape[:2] + (1, 1, 1))
+
+    def brightness_additive(self, data, mu, sigma, p_per_sample=1, p_per_channel=1):
+        offsets = np.zeros(data.shape[:2])
+        for i in self._select(data.shape[0], p_per_sample):
+            for c in range(data.shape[1]):
+                if np.random.uniform() < p_per_channel:
+                    offsets[i, c] = np.random.normal(mu, sigma)
+        return data + torch.as_tensor(
+            offsets, dtype=data.dtype, device=data.device
+        ).view(data.shape[:2] + (1, 1, 1))
+
+    def contrast(self, data, contrast_range, p_per_sample=1):
+        """
+        per channel, preserving the value range (like ContrastAugmentationTransform with its defaults)
+        """
+        factors = np.ones(data.shape[:2])
+        for i in self._select(data.shape[0], p_per_sample):
+            for c in range(data.shape[1]):
+                factors[i, c] = _sample_factor(contrast_range)
+        factors = torch.as_tensor(factors, dtype=data.dtype, device=data.device).view(
+            data.shape[:2] + (1, 1, 1)
+        )
+        mean = data.mean(dim=(2, 3, 4), keepdim=True)
+        minimum = data.amin(dim=(2, 3, 4), keepdim=True)
+        maximum = data.amax(dim=(2, 3, 4), keepdim=True)
+        data = (data - mean) * factors + mean
+        return torch.maximum(torch.minimum(data, maximum), minimum)
+
+    def simulate_low_resolution(
+        self, data, zoom_range, p_per_sample=1, p_per_channel=1
+    ):
+        shape = data.shape[2:]
+        for i in self._select(data.shape[0], p_per_sample):
+            for c in self._select(data.shape[1], p_per_channel):
+                zoom = _uniform(zoom_range)
+                target_shape = [int(np.round(s * zoom)) for s in shape]
+                downsampled = F.interpolate(
+                    data[i : i + 1, c : c + 1], size=target_shape, mode="nearest-exact"
+                )
+                data[i, c] = F.interpolate(
+                    downsampled, size=shape, mode="trilinear", align_corners=False
+                )[0, 0]
+        return data
+
+    def gamma(
+        self, data, gamma_range, invert_image=False, retain_stats=False, p_per_sample=1
+    ):
+        """
+        per channel, like GammaTransform(gamma_range, invert_image, per_channel=True, retain_stats)
+        """
+        selected = self._select(data.shape[0], p_per_sample)
+        if len(selected) == 0:
+            return data
+        gammas = [
+            [_sample_factor(gamma_range) for _ in range(data.shape[1])]
+            for _ in selected
+        ]
+        x = data[selected]
+        if invert_image:
+            x = -x
+        if retain_stats:
+            mean = x.mean(dim=(2, 3, 4), keepdim=True)
+            std = x.std(dim=(2, 3, 4), keepdim=True)
+        minimum = x.amin(dim=(2, 3, 4), keepdim=True)
+        value_range = x.amax(dim=(2, 3, 4), keepdim=True) - minimum
+        gammas = torch.as_tensor(gammas, dtype=x.dtype, device=x.device).view(
+            x.shape[:2] + (1, 1, 1)
+        )
+        x = (
+            torch.pow((x - minimum) / (value_range + 1e-7), gammas) * value_range
+            + minimum
+        )
+        if retain_stats:
+            x = x - x.mean(dim=(2, 3, 4), keepdim=True)
+            x = x / (x.std(dim=(2, 3, 4), keepdim=True) + 1e-8) * std + mean
+        if invert_image:
+            x = -x
+        data[selected] = x
+        return data
+
+    def mirror(self, data, seg, axes):
+        for i in range(data.shape[0]):
+            flip_dims = [a + 1 for a in axes if np.random.uniform() < 0.5]
+            if len(flip_dims) > 0:
+                data[i] = torch.flip(data[i], flip_dims)
+                seg[i] = torch.flip(seg[i], flip_dims)
+        return data, seg
+
+    def mask(self, data, seg, dct_for_where_it_was_used, mask_idx_in_seg=0):
+        outside = seg[:, mask_idx_in_seg] < 0
+        for c in range(data.shape[1]):
+            if dct_for_where_it_was_used[c]:
+                data[:, c][outside] = 0
+        return data
+
+    @staticmethod
+    def downsample_seg_for_ds(seg, ds_scales):
+        """
+        like DownsampleSegForDSTransform2 with order 0
+        """
+        output = []
+        for s in ds_scales:
+            if all([i == 1 for i in s]):
+                output.append(seg)
+            else:
+                new_shape = [int(np.round(i * j)) for i, j in zip(seg.shape[2:], s)]
+                output.append(F.interpolate(seg, size=new_shape, mode="nearest-exact"))
+        return output
+
+
+class TorchAugmenter(object):
+    def __init__(self, generator, augmentation, device):
+        """
+        Takes the (un-augmented) batches of generator, moves them to device and augments them there. Can be used like
+        a MultiThreadedAugmenter. Anything we don't implement is looked up in generator
+
+        :param generator: must return dicts with 'data' and 'seg' as torch tensors (pinned, ideally)
+        :param augmentation: a TorchAugmentation
+        :param device: torch device or anything torch.device understands
+        """
+        self.generator = generator
+        self.augmentation = augmentation
+        self.device = torch.device(device)
+        # seconds spent waiting for batches and augmenting them
+        self.timings = {"load": 0.0, "augment": 0.0}
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time()
+        batch = next(self.generator)
+        self.timings["load"] += time() - start
+
+        start = time()
+        data = batch["data"].to(self.device, non_blocking=True)
+        seg = batch["seg"].to(self.device, non_blocking=True)
+        with torch.no_grad():
+            data, target = self.augmentation(data, seg)
+        if self.device.type == "cuda":
+            # without this, the time the GPU needs would be counted for the forward pass
+            torch.cuda.synchronize(self.device)
+        self.timings["augment"] += time() - start
+
+        out = {k: v for k, v in batch.items() if k not in ("data", "seg")}
+        out["data"] = data
+        out["target"] = target
+        return out
+
+    def next(self):
+        return self.__next__()
+
+    def __getattr__(self, item):
+        if item == "generator":
+            raise AttributeError(item)
+        return getattr(self.generator, item)
+
+
+def get_torch_augmentation(
+    dataloader_train,
+    dataloader_val,
+    patch_size,
+    params=default_3D_augmentation_params,
+    border_val_seg=-1,
+    seeds_train=None,
+    seeds_val=None,
+    order_seg=1,
+    order_data=3,
+    deep_supervision_scales=None,
+    pin_memory=True,
+    device=None,
+):
+    """
+    Drop in replacement for get_moreDA_augmentation. The MultiThreadedAugmenter workers only load and crop patches,
+    the augmentation runs batched on device (see TorchAugmentation for the differences to batchgenerators).
+
+    :param device: where to augment. None means the current GPU if there is one, else the CPU
+    """
+    if device is None:
+        device = (
+            torch.device("cuda", torch.cuda.current_device())
+            if torch.cuda.is_available()
+            else torch.device("cpu")
+        )
+    to_tensor = Compose([NumpyToTensor(["data", "seg"], "float")])
+
+    print(
+        "Using MultiThreadedAugmenter with {} threads for loading, augmenting on {}.".format(
+            params.get("num_threads"), device
+        )
+    )
+    batchgenerator_train = MultiThreadedAugmenter(
+        dataloader_train,
+        to_tensor,
+        params.get("num_threads"),
+        params.get("num_cached_per_thread"),
+        seeds=seeds_train,
+        pin_memory=pin_memory,
+    )
+    batchgenerator_val = MultiThreadedAugmenter(
+        dataloader_val,
+        to_tensor,
+        max(params.get("num_threads") // 2, 1),
+        params.get("num_cached_per_thread"),
+        seeds=seeds_val,
+        pin_memory=pin_memory,
+    )
+
+    augmentation_train = TorchAugmentation(
+        patch_size,
+        params,
+        border_val_seg,
+        order_seg,
+        order_data,
+        deep_supervision_scales,
+        training=True,
+    )
+    augmentation_val = TorchAugmentation(
+        patch_size,
+        params,
+        border_val_seg,
+        order_seg,
+        order_data,
+        deep_supervision_scales,
+        training=False,
+    )
+    return (
+        TorchAugmenter(batchgenerator_train, augmentation_train, device),
+        TorchAugmenter(batchgenerator_val, augmentation_val, device),
+    )
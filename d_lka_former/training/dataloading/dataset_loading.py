@@ -12,7 +12,8 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from batchgenerators.augmentations.utils import (
     random_crop_2D_image_batched,
     pad_nd_image,
@@ -23,6 +24,12 @@ from multiprocessing import Pool
 
 from d_lka_former.configuration import default_num_threads
 from d_lka_former.paths import preprocessing_output_dir
+from d_lka_former.utilities.chunked_volume import (
+    ChunkedVolume,
+    default_chunk_shape,
+    save_chunked,
+)
+from d_lka_former.utilities.class_locations import ClassLocations
 from batchgenerators.utilities.file_and_folder_operations import *
 
 
@@ -32,6 +39,14 @@ def get_case_identifiers(folder):
         for i in os.listdir(folder)
         if i.endswith("npz") and (i.find("segFromPrevStage") == -1)
     ]
+    # datasets that were preprocessed with storage_format="chunked" may not have npz files at all
+    case_identifiers += [
+        i[:-7]
+        for i in os.listdir(folder)
+        if i.endswith(".chunks")
+        and (i.find("segFromPrevStage") == -1)
+        and i[:-7] not in case_identifiers
+    ]
     return case_identifiers
 
 
@@ -67,6 +82,37 @@ def save_as_npz(args):
     np.savez_compressed(npy_file[:-3] + "npz", **{key: d})
 
 
+def convert_to_chunked(args):
+    npz_file, key, chunk_shape = args
+    if not isfile(npz_file[:-3] + "chunks"):
+        a = np.load(npz_file)[key]
+        save_chunked(npz_file[:-3] + "chunks", a, chunk_shape)
+
+
+def chunk_dataset(
+    folder, threads=default_num_threads, key="data", chunk_shape=default_chunk_shape
+):
+    """
+    Converts all npz files in a folder to the chunked format (see utilities/chunked_volume.py). The data loaders then
+    read only the chunks a patch touches instead of decompressing the whole case, at about the size of the npz. Use
+    this instead of unpack_dataset if there is not enough disk space for the npy files. The npz files are kept
+    :param folder:
+    :param threads:
+    :param key:
+    :param chunk_shape: spatial shape of the chunks
+    :return:
+    """
+    p = Pool(threads)
+    npz_files = subfiles(folder, True, None, ".npz", True)
+    npz_files = [i for i in npz_files if i.find("segFromPrevStage") == -1]
+    p.map(
+        convert_to_chunked,
+        zip(npz_files, [key] * len(npz_files), [chunk_shape] * len(npz_files)),
+    )
+    p.close()
+    p.join()
+
+
 def unpack_dataset(folder, threads=default_num_threads, key="data"):
     """
     unpacks all npz files in a folder to npy (whatever you want to have unpacked must be saved unter key)
@@ -122,6 +168,65 @@ def load_dataset(folder, num_cases_properties_loading_threshold=1000):
     return dataset
 
 
+def open_case(dataset, key, memmap_mode="r", key_in_file="data"):
+    """
+    Returns the preprocessed data of case key without reading more than necessary: the memmapped .npy if the dataset
+    was unpacked (see unpack_dataset), else a ChunkedVolume if there is a .chunks file (see chunk_dataset), else the
+    decompressed .npz. All of them can be sliced like a numpy array (c, x, y, z)
+    """
+    npy_file = dataset[key]["data_file"][:-4] + ".npy"
+    if isfile(npy_file):
+        return np.load(npy_file, memmap_mode)
+    chunks_file = dataset[key]["data_file"][:-4] + ".chunks"
+    if isfile(chunks_file):
+        return ChunkedVolume(chunks_file)
+    return np.load(dataset[key]["data_file"])[key_in_file]
+
+
+def load_case(dataset, key, key_in_file="data", num_threads=4):
+    """
+    Loads the preprocessed data of case key into memory. If the dataset was unpacked (see unpack_dataset), the .npy is
+    used instead of decompressing the .npz. Chunked cases are decompressed by num_threads threads
+    """
+    data = open_case(dataset, key, None, key_in_file)
+    if isinstance(data, ChunkedVolume):
+        return data.read(num_threads=num_threads)
+    return data
+
+
+def load_class_locations(dataset, key, properties):
+    """
+    The sampled foreground voxels of case key as ClassLocations. They are stored next to the data (.classlocs) by the
+    preprocessing. Data that was preprocessed before that has them in properties["class_locations"]
+    """
+    locations_file = dataset[key]["data_file"][:-4] + ".classlocs"
+    if isfile(locations_file):
+        return ClassLocations.load(locations_file)
+    if "class_locations" not in properties.keys():
+        raise RuntimeError(
+            "Please rerun the preprocessing with the newest version of nnU-Net!"
+        )
+    return ClassLocations.from_dict(properties["class_locations"])
+
+
+def load_cases_in_background(dataset, keys, num_cases_ahead=1):
+    """
+    Yields (key, data) for all keys in order. While the caller works on one case, the next num_cases_ahead cases are
+    already loaded (and decompressed) in a background thread. zlib and file IO release the GIL, so this really runs in
+    parallel
+    """
+    with ThreadPoolExecutor(1) as executor:
+        pending = deque()
+        for k in keys:
+            pending.append((k, executor.submit(load_case, dataset, k)))
+            if len(pending) > num_cases_ahead:
+                k_done, future = pending.popleft()
+                yield k_done, future.result()
+        while len(pending) > 0:
+            k_done, future = pending.popleft()
+            yield k_done, future.result()
+
+
 def crop_2D_image_force_fg(img, crop_size, valid_voxels):
     """
     img must be [c, x, y]
@@ -187,6 +292,8 @@ class DataLoader3D(SlimDataLoaderBase):
         pad_mode="edge",
         pad_kwargs_data=None,
         pad_sides=None,
+        store=None,
+        stratify_foreground_regions=False,
     ):
         """
         This is the basic data loader for 3D networks. It uses preprocessed data as produced by my (Fabian) preprocessing.
@@ -210,6 +317,9 @@ class DataLoader3D(SlimDataLoaderBase):
         :param stage: ignore this (Fabian only)
         :param random: Sample keys randomly; CAREFUL! non-random sampling requires batch_size=1, otherwise you will iterate batch_size times over the dataset
         :param oversample_foreground: half the batch will be forced to contain at least some foreground (equal prob for each of the foreground classes)
+        :param store: optional SharedMemoryDatasetStore the cases are read from instead of the npy/npz files
+        :param stratify_foreground_regions: when forcing foreground, first draw a class, then a connected component of
+        it and then a voxel in there (instead of any voxel of the class). Needs data preprocessed with .classlocs files
         """
         super(DataLoader3D, self).__init__(data, batch_size, None)
         if pad_kwargs_data is None:
@@ -233,8 +343,21 @@ class DataLoader3D(SlimDataLoaderBase):
         self.memmap_mode = memmap_mode
         self.num_channels = None
         self.pad_sides = pad_sides
+        self.store = store
+        self.stratify_foreground_regions = stratify_foreground_regions
+        self._class_locations = OrderedDict()
         self.data_shape, self.seg_shape = self.determine_shapes()
 
+    def get_class_locations(self, key, properties):
+        """
+        ClassLocations of case key, cached because the same cases come up again and again
+        """
+        if key not in self._class_locations.keys():
+            self._class_locations[key] = load_class_locations(
+                self._data, key, properties
+            )
+        return self._class_locations[key]
+
     def get_do_oversample(self, batch_idx):
         return not batch_idx < round(
             self.batch_size * (1 - self.oversample_foreground_percent)
@@ -247,12 +370,10 @@ class DataLoader3D(SlimDataLoaderBase):
             num_seg = 1
 
         k = list(self._data.keys())[0]
-        if isfile(self._data[k]["data_file"][:-4] + ".npy"):
-            case_all_data = np.load(
-                self._data[k]["data_file"][:-4] + ".npy", self.memmap_mode
-            )
+        if self.store is not None:
+            case_all_data = self.store.get(k)
         else:
-            case_all_data = np.load(self._data[k]["data_file"])["data"]
+            case_all_data = open_case(self._data, k, self.memmap_mode)
         num_color_channels = case_all_data.shape[0] - 1
         data_shape = (self.batch_size, num_color_channels, *self.patch_size)
         seg_shape = (self.batch_size, num_seg, *self.patch_size)
@@ -277,14 +398,13 @@ class DataLoader3D(SlimDataLoaderBase):
                 properties = load_pickle(self._data[i]["properties_file"])
             case_properties.append(properties)
 
-            # cases are stored as npz, but we require unpack_dataset to be run. This will decompress them into npy
-            # which is much faster to access
-            if isfile(self._data[i]["data_file"][:-4] + ".npy"):
-                case_all_data = np.load(
-                    self._data[i]["data_file"][:-4] + ".npy", self.memmap_mode
-                )
+            # cases are stored as npz, but we require unpack_dataset (or chunk_dataset) to be run. This will
+            # decompress them into npy (or chunks) which is much faster to access. Chunked cases are not read here,
+            # only the chunks of the patch are read when we crop below
+            if self.store is not None:
+                case_all_data = self.store.get(i)
             else:
-                case_all_data = np.load(self._data[i]["data_file"])["data"]
+                case_all_data = open_case(self._data, i, self.memmap_mode)
 
             # If we are doing the cascade then we will also need to load the segmentation of the previous stage and
             # concatenate it. Here it will be concatenates to the segmentation because the augmentations need to be
@@ -360,35 +480,22 @@ class DataLoader3D(SlimDataLoaderBase):
                 bbox_z_lb = np.random.randint(lb_z, ub_z + 1)
             else:
                 # these values should have been precomputed
-                if "class_locations" not in properties.keys():
-                    raise RuntimeError(
-                        "Please rerun the preprocessing with the newest version of nnU-Net!"
-                    )
+                class_locations = self.get_class_locations(i, properties)
 
                 # this saves us a np.unique. Preprocessing already did that for all cases. Neat.
-                foreground_classes = np.array(
-                    [
-                        i
-                        for i in properties["class_locations"].keys()
-                        if len(properties["class_locations"][i]) != 0
-                    ]
-                )
-                foreground_classes = foreground_classes[foreground_classes > 0]
+                foreground_classes = class_locations.foreground_classes()
 
                 if len(foreground_classes) == 0:
                     # this only happens if some image does not contain foreground voxels at all
                     selected_class = None
-                    voxels_of_that_class = None
                     print("case does not contain any foreground classes", i)
                 else:
                     selected_class = np.random.choice(foreground_classes)
 
-                    voxels_of_that_class = properties["class_locations"][selected_class]
-
-                if voxels_of_that_class is not None:
-                    selected_voxel = voxels_of_that_class[
-                        np.random.choice(len(voxels_of_that_class))
-                    ]
+                if selected_class is not None:
+                    selected_voxel = class_locations.sample_voxel(
+                        selected_class, self.stratify_foreground_regions
+                    )
                     # selected voxel is center voxel. Subtract half the patch size to get lower bbox voxel.
                     # Make sure it is within the bounds of lb and ub
                     bbox_x_lb = max(lb_x, selected_voxel[0] - self.patch_size[0] // 2)
@@ -595,19 +702,9 @@ class DataLoader2D(SlimDataLoaderBase):
                 selected_class = None
             else:
                 # these values should have been precomputed
-                if "class_locations" not in properties.keys():
-                    raise RuntimeError(
-                        "Please rerun the preprocessing with the newest version of nnU-Net!"
-                    )
+                class_locations = load_class_locations(self._data, i, properties)
 
-                foreground_classes = np.array(
-                    [
-                        i
-                        for i in properties["class_locations"].keys()
-                        if len(properties["class_locations"][i]) != 0
-                    ]
-                )
-                foreground_classes = foreground_classes[foreground_classes > 0]
+                foreground_classes = class_locations.foreground_classes()
                 if len(foreground_classes) == 0:
                     selected_class = None
                     random_slice = np.random.choice(case_all_data.shape[1])
@@ -615,7 +712,7 @@ class DataLoader2D(SlimDataLoaderBase):
                 else:
                     selected_class = np.random.choice(foreground_classes)
 
-                    voxels_of_that_class = properties["class_locations"][selected_class]
+                    voxels_of_that_class = class_locations.voxels(selected_class)
                     valid_slices = np.unique(voxels_of_that_class[:, 0])
                     random_slice = np.random.choice(valid_slices)
                     voxels_of_that_class = voxels_of_that_class[
@@ -0,0 +1,209 @@
+import atexit
+import multiprocessing
+import os
+import uuid
+from multiprocessing import shared_memory
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import load_pickle
+from d_lka_former.training.dataloading.dataset_loading import open_case
+from d_lka_former.utilities.chunked_volume import ChunkedVolume
+
+# states of a case in the store
+NOT_RESIDENT = 0
+LOADING = 1
+RESIDENT = 2
+
+
+class SharedMemoryDatasetStore(object):
+    def __init__(self, dataset, budget_bytes, memmap_mode="r"):
+        """
+        Keeps preprocessed cases in POSIX shared memory so that all data loader processes (the workers of
+        MultiThreadedAugmenter are forked from the process that creates the store) read them as numpy views without
+        going through the page cache or decompressing npz files. At most budget_bytes are held in shared memory. If a
+        case does not fit, the least recently used cases are evicted. Cases that are not in shared memory are read as
+        before (see open_case) and admitted to the store.
+
+        The bookkeeping (state, generation and last access per case, bytes in use) lives in shared arrays that are
+        protected by one lock, so all processes agree on what is in the store. A shared memory block is named after its
+        case and generation. Processes close their mapping of a block once they notice that its generation has changed.
+
+        The properties of all cases are loaded here as well so that the data loaders do not have to unpickle them.
+
+        :param dataset: what load_dataset returns. Only cases in here can be stored
+        :param budget_bytes: maximum number of bytes in shared memory
+        :param memmap_mode: how .npy files are opened for cases that are not in the store
+        """
+        self.dataset = dataset
+        self.budget_bytes = int(budget_bytes)
+        self.memmap_mode = memmap_mode
+        self.keys = list(dataset.keys())
+        self._index = {k: i for i, k in enumerate(self.keys)}
+        self._prefix = "dlka_%s" % uuid.uuid4().hex[:12]
+        self._owner_pid = os.getpid()
+
+        num_cases = len(self.keys)
+        self._lock = multiprocessing.Lock()
+        self._state = multiprocessing.RawArray("b", num_cases)
+        self._generation = multiprocessing.RawArray("q", num_cases)
+        self._last_access = multiprocessing.RawArray("q", num_cases)
+        self._nbytes = multiprocessing.RawArray("q", num_cases)
+        self._shape = multiprocessing.RawArray("q", num_cases * 4)
+        self._bytes_in_use = multiprocessing.RawValue("q", 0)
+        self._clock = multiprocessing.RawValue("q", 0)
+
+        # (generation, SharedMemory) per case for the blocks this process has mapped. Not shared between processes
+        self._mapped = {}
+
+        for k in self.keys:
+            if "properties" not in dataset[k].keys():
+                dataset[k]["properties"] = load_pickle(dataset[k]["properties_file"])
+
+        atexit.register(self.close)
+
+    def _block_name(self, idx, generation):
+        return "%s_%d_%d" % (self._prefix, idx, generation)
+
+    def _load_from_disk(self, key):
+        data = open_case(self.dataset, key, self.memmap_mode)
+        if isinstance(data, ChunkedVolume):
+            return data.read()
+        return data
+
+    def _release_stale_mappings(self):
+        for idx in list(self._mapped.keys()):
+            generation, shm = self._mapped[idx]
+            if self._state[idx] != RESIDENT or self._generation[idx] != generation:
+                del self._mapped[idx]
+                try:
+                    shm.close()
+                except BufferError:
+                    # somebody still holds a view. The mapping goes away together with the last view
+                    pass
+
+    def _view(self, idx, generation):
+        if idx not in self._mapped or self._mapped[idx][0] != generation:
+            shm = shared_memory.SharedMemory(name=self._block_name(idx, generation))
+            self._mapped[idx] = (generation, shm)
+        shape = tuple(self._shape[idx * 4 : idx * 4 + 4])
+        view = np.ndarray(shape, dtype=np.float32, buffer=self._mapped[idx][1].buf)
+        view.flags.writeable = False
+        return view
+
+    def _evict(self, idx):
+        """
+        must be called with the lock held
+        """
+        try:
+            shm = shared_memory.SharedMemory(
+                name=self._block_name(idx, self._generation[idx])
+            )
+            shm.unlink()
+            shm.close()
+        except FileNotFoundError:
+            pass
+        self._state[idx] = NOT_RESIDENT
+        self._generation[idx] += 1
+        self._bytes_in_use.value -= self._nbytes[idx]
+
+    def _admit(self, idx, data):
+        """
+        Copies data into shared memory, evicting least recently used cases if necessary
+        """
+        nbytes = data.size * 4
+        if (
+            nbytes > self.budget_bytes
+            or len(data.shape) != 4
+            or data.dtype != np.float32
+        ):
+            return
+        with self._lock:
+            if self._state[idx] != NOT_RESIDENT:
+                return
+            while self._bytes_in_use.value + nbytes > self.budget_bytes:
+                resident = [
+                    i for i in range(len(self.keys)) if self._state[i] == RESIDENT
+                ]
+                if len(resident) == 0:
+                    # everything else is still being loaded by other processes
+                    return
+                self._evict(min(resident, key=lambda i: self._last_access[i]))
+            self._state[idx] = LOADING
+            self._bytes_in_use.value += nbytes
+            self._nbytes[idx] = nbytes
+            self._shape[idx * 4 : idx * 4 + 4] = list(data.shape)
+            generation = self._generation[idx]
+
+        # the copy is done without holding the lock, the other processes read from disk in the meantime
+        shm = shared_memory.SharedMemory(
+            name=self._block_name(idx, generation), create=True, size=max(nbytes, 1)
+        )
+        np.ndarray(data.shape, dtype=np.float32, buffer=shm.buf)[:] = data
+        shm.close()
+        with self._lock:
+            self._state[idx] = RESIDENT
+
+    def get(self, key):
+        """
+        Returns the data of case key (c, x, y, z), read only
+        """
+        idx = self._index[key]
+        with self._lock:
+            self._clock.value += 1
+            self._last_access[idx] = self._clock.value
+            state = self._state[idx]
+            generation = self._generation[idx]
+            # mapping the block while holding the lock makes sure it cannot be evicted in the meantime
+            if state == RESIDENT:
+                view = self._view(idx, generation)
+        self._release_stale_mappings()
+        if state == RESIDENT:
+            return view
+
+        data = self._load_from_disk(key)
+        if state == NOT_RESIDENT:
+            self._admit(idx, data)
+        return data
+
+    def preload(self, keys=None):
+        """
+        Loads cases into shared memory until the budget is used up. Call this before the data loader processes are
+        started so that they find everything in the store right away
+        """
+        if keys is None:
+            keys = self.keys
+        for k in keys:
+            idx = self._index[k]
+            if self._state[idx] != NOT_RESIDENT:
+                continue
+            data = self._load_from_disk(k)
+            if self._bytes_in_use.value + data.size * 4 > self.budget_bytes:
+                break
+            self._admit(idx, data)
+        print(
+            "shared memory dataset store: %d of %d cases, %.1f of %.1f GB"
+            % (
+                sum([i == RESIDENT for i in self._state]),
+                len(self.keys),
+                self._bytes_in_use.value / 1024**3,
+                self.budget_bytes / 1024**3,
+            )
+        )
+
+    def close(self):
+        """
+        Releases all shared memory. Only the process that created the store does this, data loader processes that
+        exit just drop their mappings
+        """
+        for generation, shm in self._mapped.values():
+            try:
+                shm.close()
+            except BufferError:
+                pass
+        self._mapped = {}
+        if os.getpid() != self._owner_pid:
+            return
+        with self._lock:
+            for idx in range(len(self.keys)):
+                if self._state[idx] == RESIDENT:
+                    self._evict(idx)
@@ -29,6 +29,7 @@ from d_lka_former.configuration import default_num_threads
 from d_lka_former.evaluation.evaluator import aggregate_scores
 from d_lka_former.inference.segmentation_export import (
     save_segmentation_nifti_from_softmax,
+    save_segmentation_nifti_from_shared_softmax,
 )
 from d_lka_former.network_architecture.generic_UNet import Generic_UNet
 from d_lka_former.network_architecture.initialization import InitWeights_He
@@ -45,13 +46,20 @@ from d_lka_former.training.dataloading.dataset_loading import (
     DataLoader3D,
     DataLoader2D,
     unpack_dataset,
+    load_cases_in_background,
+)
+from d_lka_former.training.dataloading.shared_memory_store import (
+    SharedMemoryDatasetStore,
 )
 from d_lka_former.training.loss_functions.dice_loss import DC_and_CE_loss
 from d_lka_former.training.network_training.network_trainer_synapse import (
     NetworkTrainer_synapse,
 )
 from d_lka_former.utilities.nd_softmax import softmax_helper
-from d_lka_former.utilities.tensor_utilities import sum_tensor
+from d_lka_former.utilities.shared_memory import (
+    array_to_shared_memory,
+    shared_memory_available,
+)
 from torch import nn
 from torch.optim import lr_scheduler
 
@@ -162,10 +170,12 @@ class Trainer_synapse(NetworkTrainer_synapse):
             weight_ce=1, weight_dice=1
         )
 
-        self.online_eval_foreground_dc = []
-        self.online_eval_tp = []
-        self.online_eval_fp = []
-        self.online_eval_fn = []
+        # confusion matrix (reference x prediction) of the validation batches of the current epoch. Stays on the GPU
+        # until finish_online_evaluation
+        self.online_eval_confusion = None
+        # classes whose Dice is reported (and averaged) during training. These are the 8 organs of the Synapse
+        # benchmark. None uses all foreground classes
+        self.online_eval_classes = (1, 2, 3, 4, 6, 7, 8, 11)
 
         self.classes = (
             self.do_dummy_2D_aug
@@ -177,6 +187,48 @@ class Trainer_synapse(NetworkTrainer_synapse):
 
         self.inference_pad_border_mode = "constant"
         self.inference_pad_kwargs = {"constant_values": 0}
+        # sliding window tile size. None means self.patch_size, larger tiles need fewer forward passes and waste less
+        # on overlap but only work with networks that accept them (LHUNet: see d_lka_former_trainer_synapse)
+        self.inference_patch_size = None
+        # number of sliding window tiles that are predicted in one forward pass. 'auto' picks it based on free memory
+        self.inference_tiles_per_batch = 1
+        # only relevant when the network lives on the CPU (no GPU available). None keeps the torch default
+        self.inference_num_threads = None
+        self.inference_channels_last = False
+        # mirroring test time augmentation: which mirror combinations to use (None = all of them, see
+        # SegmentationNetwork.predict_3D) and in how many forward passes they are evaluated
+        self.inference_mirror_combinations = None
+        self.inference_mirror_chunks = 1
+        # sliding window tiles that only cover air/padding are skipped if this is not None, see
+        # SegmentationNetwork.predict_3D
+        self.inference_sparse_tile_threshold = None
+        self.inference_sparse_tile_min_foreground = 0.0
+        # two pass inference: a downsampled pass finds the foreground, the full resolution sliding window only runs
+        # there. See SegmentationNetwork.predict_3D_coarse_to_fine
+        self.inference_coarse_to_fine = False
+        self.inference_coarse_scale = 0.5
+        self.inference_roi_margin = (8, 16, 16)
+        # np.float16 halves the host memory of the sliding window aggregation (the softmax is float16 then as well)
+        self.inference_accumulation_dtype = np.float32
+        # if False, predict_preprocessed_data_return_seg_and_softmax returns None instead of the softmax and the sliding
+        # window only keeps the slab it is currently working on in memory. validate always requests the softmax
+        self.inference_return_probabilities = True
+        # overlap tile uploads, forward passes, downloads and aggregation. See TilePipeline
+        self.inference_pipelined = False
+        # how validate brings the softmax back to the original spacing: softmax, channelwise (same result, a fraction
+        # of the memory) or argmax (fastest, not identical). See save_segmentation_nifti_from_softmax
+        self.export_mode = "softmax"
+        # determine_postprocessing evaluates its variants in memory instead of writing and evaluating temporary niftis
+        # (same result). validate(debug=True) always uses the temporary niftis, so they can be inspected
+        self.postprocessing_in_memory = True
+
+        # if not None, the preprocessed cases are kept in shared memory (at most this many bytes) and the 3D data
+        # loaders read them from there. See SharedMemoryDatasetStore
+        self.dataset_store_budget = None
+        self.dataset_store = None
+        # when forcing foreground into a patch, draw a connected component of the selected class first (so small
+        # separate structures get as many patches as large ones). See ClassLocations.sample_voxel
+        self.stratify_foreground_regions = False
 
         self.update_fold(fold)
         self.pad_all_sides = None
@@ -534,6 +586,15 @@ class Trainer_synapse(NetworkTrainer_synapse):
         self.load_dataset()
         self.do_split()
 
+        if self.threeD and self.dataset_store_budget is not None:
+            self.dataset_store = SharedMemoryDatasetStore(
+                self.dataset, self.dataset_store_budget
+            )
+            # training cases first, they are the ones that are read all the time
+            self.dataset_store.preload(
+                list(self.dataset_tr.keys()) + list(self.dataset_val.keys())
+            )
+
         if self.threeD:
             dl_tr = DataLoader3D(
                 self.dataset_tr,
@@ -545,6 +606,8 @@ class Trainer_synapse(NetworkTrainer_synapse):
                 pad_mode="constant",
                 pad_sides=self.pad_all_sides,
                 memmap_mode="r",
+                store=self.dataset_store,
+                stratify_foreground_regions=self.stratify_foreground_regions,
             )
             dl_val = DataLoader3D(
                 self.dataset_val,
@@ -556,6 +619,8 @@ class Trainer_synapse(NetworkTrainer_synapse):
                 pad_mode="constant",
                 pad_sides=self.pad_all_sides,
                 memmap_mode="r",
+                store=self.dataset_store,
+                stratify_foreground_regions=self.stratify_foreground_regions,
             )
         else:
             dl_tr = DataLoader2D(
@@ -725,21 +790,44 @@ class Trainer_synapse(NetworkTrainer_synapse):
 
         current_mode = self.network.training
         self.network.eval()
-        ret = self.network.predict_3D(
-            data,
-            do_mirroring=do_mirroring,
-            mirror_axes=mirror_axes,
-            use_sliding_window=use_sliding_window,
-            step_size=step_size,
-            patch_size=self.patch_size,
-            regions_class_order=self.regions_class_order,
-            use_gaussian=use_gaussian,
-            pad_border_mode=pad_border_mode,
-            pad_kwargs=pad_kwargs,
-            all_in_gpu=all_in_gpu,
-            verbose=verbose,
-            mixed_precision=mixed_precision,
-        )
+        predict_kwargs = {
+            "do_mirroring": do_mirroring,
+            "mirror_axes": mirror_axes,
+            "step_size": step_size,
+            "patch_size": (
+                self.patch_size
+                if self.inference_patch_size is None
+                else self.inference_patch_size
+            ),
+            "regions_class_order": self.regions_class_order,
+            "use_gaussian": use_gaussian,
+            "pad_border_mode": pad_border_mode,
+            "pad_kwargs": pad_kwargs,
+            "all_in_gpu": all_in_gpu,
+            "verbose": verbose,
+            "mixed_precision": mixed_precision,
+            "tiles_per_batch": self.inference_tiles_per_batch,
+            "num_threads": self.inference_num_threads,
+            "channels_last": self.inference_channels_last,
+            "mirror_combinations": self.inference_mirror_combinations,
+            "mirror_chunks": self.inference_mirror_chunks,
+            "sparse_tile_threshold": self.inference_sparse_tile_threshold,
+            "sparse_tile_min_foreground": self.inference_sparse_tile_min_foreground,
+            "accumulation_dtype": self.inference_accumulation_dtype,
+            "return_probabilities": self.inference_return_probabilities,
+            "pipelined": self.inference_pipelined,
+        }
+        if self.inference_coarse_to_fine and use_sliding_window:
+            ret = self.network.predict_3D_coarse_to_fine(
+                data,
+                coarse_scale=self.inference_coarse_scale,
+                roi_margin=self.inference_roi_margin,
+                **predict_kwargs
+            )
+        else:
+            ret = self.network.predict_3D(
+                data, use_sliding_window=use_sliding_window, **predict_kwargs
+            )
         self.network.train(current_mode)
         return ret
 
@@ -760,6 +848,7 @@ class Trainer_synapse(NetworkTrainer_synapse):
         """
         if debug=True then the temporary files generated for postprocessing determination will be kept
         """
+        validation_start = time.time()
 
         current_mode = self.network.training
         self.network.eval()
@@ -823,7 +912,9 @@ class Trainer_synapse(NetworkTrainer_synapse):
         export_pool = Pool(default_num_threads)
         results = []
 
-        inference_times = []
+        # figure out which cases need to be predicted first, so that we can load them in the background while the
+        # previous one is predicted
+        cases_to_predict = OrderedDict()
         for k in self.dataset_val.keys():
             properties = load_pickle(self.dataset[k]["properties_file"])
             fname = properties["list_of_data_files"][0].split("/")[-1][:-12]
@@ -832,11 +923,26 @@ class Trainer_synapse(NetworkTrainer_synapse):
                 or (not isfile(join(output_folder, fname + ".nii.gz")))
                 or (save_softmax and not isfile(join(output_folder, fname + ".npz")))
             ):
-                start = time.time()
-                data = np.load(self.dataset[k]["data_file"])["data"]
-                print(k, data.shape)
-                data[-1][data[-1] == -1] = 0
+                cases_to_predict[k] = (fname, properties)
 
+            pred_gt_tuples.append(
+                [
+                    join(output_folder, fname + ".nii.gz"),
+                    join(self.gt_niftis_folder, fname + ".nii.gz"),
+                ]
+            )
+
+        inference_times = []
+        for k, data in load_cases_in_background(self.dataset, cases_to_predict.keys()):
+            fname, properties = cases_to_predict[k]
+            start = time.time()
+            print(k, data.shape)
+            data[-1][data[-1] == -1] = 0
+
+            # validate needs the softmax, whatever inference_return_probabilities says
+            return_probabilities = self.inference_return_probabilities
+            self.inference_return_probabilities = True
+            try:
                 softmax_pred = self.predict_preprocessed_data_return_seg_and_softmax(
                     data[:-1],
                     do_mirroring=do_mirroring,
@@ -847,18 +953,43 @@ class Trainer_synapse(NetworkTrainer_synapse):
                     all_in_gpu=all_in_gpu,
                     mixed_precision=self.fp16,
                 )[1]
+            finally:
+                self.inference_return_probabilities = return_probabilities
 
-                softmax_pred = softmax_pred.transpose(
-                    [0] + [i + 1 for i in self.transpose_backward]
+            softmax_pred = softmax_pred.transpose(
+                [0] + [i + 1 for i in self.transpose_backward]
+            )
+            end = time.time()
+            print(f"Inference Time (k={k}): {end - start} sec.")
+            inference_times.append(end - start)
+            if save_softmax:
+                softmax_fname = join(output_folder, fname + ".npz")
+            else:
+                softmax_fname = None
+
+            export_args = (
+                join(output_folder, fname + ".nii.gz"),
+                properties,
+                interpolation_order,
+                self.regions_class_order,
+                None,
+                None,
+                softmax_fname,
+                None,
+                force_separate_z,
+                interpolation_order_z,
+                True,
+                self.export_mode,
+            )
+            if shared_memory_available(softmax_pred.nbytes):
+                # the export processes read the softmax straight from shared memory. No pickling, no 2 GB limit
+                results.append(
+                    export_pool.starmap_async(
+                        save_segmentation_nifti_from_shared_softmax,
+                        ((array_to_shared_memory(softmax_pred),) + export_args,),
+                    )
                 )
-                end = time.time()
-                print(f"Inference Time (k={k}): {end - start} sec.")
-                inference_times.append(end - start)
-                if save_softmax:
-                    softmax_fname = join(output_folder, fname + ".npz")
-                else:
-                    softmax_fname = None
-
+            else:
                 """There is a problem with python process communication that prevents us from communicating obejcts
                 larger than 2 GB between processes (basically when the length of the pickle string that will be sent is
                 communicated by the multiprocessing.Pipe object then the placeholder (\%i I think) does not allow for long
@@ -875,37 +1006,30 @@ class Trainer_synapse(NetworkTrainer_synapse):
                 results.append(
                     export_pool.starmap_async(
                         save_segmentation_nifti_from_softmax,
-                        (
-                            (
-                                softmax_pred,
-                                join(output_folder, fname + ".nii.gz"),
-                                properties,
-                                interpolation_order,
-                                self.regions_class_order,
-                                None,
-                                None,
-                                softmax_fname,
-                                None,
-                                force_separate_z,
-                                interpolation_order_z,
-                            ),
-                        ),
+                        ((softmax_pred,) + export_args,),
                     )
                 )
 
-            pred_gt_tuples.append(
-                [
-                    join(output_folder, fname + ".nii.gz"),
-                    join(self.gt_niftis_folder, fname + ".nii.gz"),
-                ]
-            )
-
         # Print inference times
         print(f"Total Images: {len(inference_times)}")
         print(f"Total Time: {sum(inference_times)} sec.")
-        print(f"Time per Image: {sum(inference_times) / len(inference_times)} sec.")
+        if len(inference_times) > 0:
+            print(f"Time per Image: {sum(inference_times) / len(inference_times)} sec.")
         _ = [i.get() for i in results]
         self.print_to_log_file("finished prediction")
+        validation_time = time.time() - validation_start
+        self.print_to_log_file(
+            "validation of %d cases (prediction and export) took %.1f s"
+            % (len(inference_times), validation_time)
+        )
+        save_json(
+            {
+                "inference_times": dict(zip(cases_to_predict.keys(), inference_times)),
+                "total_inference_time": sum(inference_times),
+                "prediction_and_export_time": validation_time,
+            },
+            join(output_folder, "validation_times.json"),
+        )
 
         # evaluate raw predictions
         self.print_to_log_file("evaluation of raw predictions")
@@ -933,6 +1057,7 @@ class Trainer_synapse(NetworkTrainer_synapse):
                 validation_folder_name,
                 final_subf_name=validation_folder_name + "_postprocessed",
                 debug=debug,
+                in_memory=self.postprocessing_in_memory and not debug,
             )
             # after this the final predictions for the vlaidation set can be found in validation_folder_name_base + "_postprocessed"
             # They are always in that folder, even if no postprocessing as applied!
@@ -968,57 +1093,39 @@ class Trainer_synapse(NetworkTrainer_synapse):
     def run_online_evaluation(self, output, target):
         with torch.no_grad():
             num_classes = output.shape[1]
-            output_softmax = softmax_helper(output)
-            output_seg = output_softmax.argmax(1)
-            target = target[:, 0]
-            axes = tuple(range(1, len(target.shape)))
-            # tp_hard = torch.zeros((target.shape[0], num_classes - 1)).to(output_seg.device.index)
-            # fp_hard = torch.zeros((target.shape[0], num_classes - 1)).to(output_seg.device.index)
-            # fn_hard = torch.zeros((target.shape[0], num_classes - 1)).to(output_seg.device.index)
-            tp_hard = torch.zeros((target.shape[0], 8)).to(output_seg.device.index)
-            fp_hard = torch.zeros((target.shape[0], 8)).to(output_seg.device.index)
-            fn_hard = torch.zeros((target.shape[0], 8)).to(output_seg.device.index)
-            i = 0
-            for c in range(1, num_classes):
-                if c in [10, 12, 13, 5, 9]:
-                    continue
-                tp_hard[:, i] = sum_tensor(
-                    (output_seg == c).float() * (target == c).float(), axes=axes
-                )
-                fp_hard[:, i] = sum_tensor(
-                    (output_seg == c).float() * (target != c).float(), axes=axes
-                )
-                fn_hard[:, i] = sum_tensor(
-                    (output_seg != c).float() * (target == c).float(), axes=axes
-                )
-                i += 1
-
-            tp_hard = tp_hard.sum(0, keepdim=False).detach().cpu().numpy()
-            fp_hard = fp_hard.sum(0, keepdim=False).detach().cpu().numpy()
-            fn_hard = fn_hard.sum(0, keepdim=False).detach().cpu().numpy()
-
-            self.online_eval_foreground_dc.append(
-                list((2 * tp_hard) / (2 * tp_hard + fp_hard + fn_hard + 1e-8))
-            )
-            self.online_eval_tp.append(list(tp_hard))
-            self.online_eval_fp.append(list(fp_hard))
-            self.online_eval_fn.append(list(fn_hard))
+            # the softmax does not change the argmax
+            output_seg = output.argmax(1)
+            # voxels outside of the nonzero mask (-1) are background as far as the metrics are concerned
+            target = target[:, 0].long().clamp_min(0)
+            # one bincount gives the whole confusion matrix, rows are the reference, columns the prediction
+            confusion = torch.bincount(
+                (target * num_classes + output_seg).view(-1),
+                minlength=num_classes**2,
+            ).view(num_classes, num_classes)
+            if self.online_eval_confusion is None:
+                self.online_eval_confusion = confusion
+            else:
+                self.online_eval_confusion += confusion
 
     def finish_online_evaluation(self):
-        self.online_eval_tp = np.sum(self.online_eval_tp, 0)
-        self.online_eval_fp = np.sum(self.online_eval_fp, 0)
-        self.online_eval_fn = np.sum(self.online_eval_fn, 0)
-
-        global_dc_per_class = [
-            i
-            for i in [
-                2 * i / (2 * i + j + k)
-                for i, j, k in zip(
-                    self.online_eval_tp, self.online_eval_fp, self.online_eval_fn
-                )
-            ]
-            if not np.isnan(i)
-        ]
+        if self.online_eval_confusion is None:
+            self.all_val_eval_metrics.append(np.nan)
+            return
+        confusion = self.online_eval_confusion.cpu().numpy().astype(np.float64)
+        self.online_eval_confusion = None
+
+        classes = self.online_eval_classes
+        if classes is None:
+            classes = range(1, confusion.shape[0])
+        classes = list(classes)
+        tp = np.diag(confusion)[classes]
+        fp = confusion.sum(0)[classes] - tp
+        fn = confusion.sum(1)[classes] - tp
+
+        # classes that are neither in the reference nor in the prediction have no Dice, skip them
+        with np.errstate(invalid="ignore", divide="ignore"):
+            dc_per_class = 2 * tp / (2 * tp + fp + fn)
+        global_dc_per_class = [i for i in dc_per_class if not np.isnan(i)]
         avg_dc_per_class = np.mean(global_dc_per_class)
         self.all_val_eval_metrics.append(avg_dc_per_class)
 
@@ -1031,11 +1138,6 @@ class Trainer_synapse(NetworkTrainer_synapse):
             "exact.)"
         )
 
-        self.online_eval_foreground_dc = []
-        self.online_eval_tp = []
-        self.online_eval_fp = []
-        self.online_eval_fn = []
-
     def save_checkpoint(self, fname, save_optimizer=True):
         super(Trainer_synapse, self).save_checkpoint(fname, save_optimizer)
         info = OrderedDict()
@@ -13,7 +13,10 @@
 #    limitations under the License.
 
 
+import multiprocessing
+import traceback
 from collections import OrderedDict
+from itertools import chain
 from typing import Tuple
 
 import numpy as np
@@ -21,6 +24,9 @@ import torch
 from d_lka_former.training.data_augmentation.data_augmentation_moreDA import (
     get_moreDA_augmentation,
 )
+from d_lka_former.training.data_augmentation.torch_augmentation import (
+    get_torch_augmentation,
+)
 from d_lka_former.training.loss_functions.deep_supervision import MultipleOutputLoss2
 from d_lka_former.utilities.to_torch import maybe_to_torch, to_cuda
 from d_lka_former.network_architecture.synapse.d_lka_former_synapse import D_LKA_Former
@@ -53,8 +59,50 @@ from d_lka_former.network_architecture.synapse.lhunet.models.v8 import (
 from d_lka_former.network_architecture.synapse.lhunet.models.v7 import (
     LHUNet as LHUNet_v7,
 )
+from d_lka_former.network_architecture.synapse.lhunet.fusion import fuse_for_inference
+from d_lka_former.network_architecture.synapse.lhunet.checkpointing import (
+    plan_checkpointing,
+    set_checkpointing,
+)
+from d_lka_former.network_architecture.synapse.lhunet.modules.vit.token_grid import (
+    enable_any_patch_size,
+)
 
 
+def run_test_in_background(
+    trainer_class,
+    init_args,
+    attributes,
+    checkpoint,
+    device,
+    memory_fraction,
+    validate_kwargs,
+    result_queue,
+):
+    """
+    Entry point of the test evaluation process, see d_lka_former_trainer_synapse.start_background_test. Puts
+    (True, test dice) or (False, traceback) into result_queue
+
+    :param attributes: set on the trainer before it is initialized, see get_test_attributes
+    :param device: GPU index or 'cpu'. memory_fraction only applies to GPUs
+    """
+    try:
+        if device != "cpu":
+            torch.cuda.set_device(device)
+            if memory_fraction is not None:
+                torch.cuda.set_per_process_memory_fraction(memory_fraction, device)
+        trainer = trainer_class(*init_args)
+        for name, value in attributes.items():
+            setattr(trainer, name, value)
+        trainer.initialize(False)
+        trainer.load_checkpoint(checkpoint, train=False)
+        if device == "cpu":
+            # initialize_network moves the network to the GPU whenever there is one
+            trainer.network.cpu()
+        result_queue.put((True, trainer.validate(**validate_kwargs)))
+    except Exception:
+        result_queue.put((False, traceback.format_exc()))
+
 
 class d_lka_former_trainer_synapse(Trainer_synapse):
     """
@@ -113,6 +161,40 @@ class d_lka_former_trainer_synapse(Trainer_synapse):
         self.trans_block = trans_block
         self.skip_connections = skip_connections
 
+        # the test evaluation in maybe_test takes several minutes. If test_in_background is True it runs in a separate
+        # process on a snapshot of the weights and training continues in the meantime. Off by default: the test
+        # predicts with all_in_gpu, so on the training GPU it needs a test_memory_fraction that leaves room for training
+        self.test_in_background = False
+        # GPU of the test process. None means the GPU we train on
+        self.test_device = None
+        # fraction of the memory of test_device the test process may use. None means no limit
+        self.test_memory_fraction = None
+        self._pending_test = None  # (epoch, snapshot file, process, result queue)
+
+        # 'batchgenerators' augments in the worker processes of MultiThreadedAugmenter. 'torch' only loads patches
+        # there and augments whole batches on augmentation_device (see torch_augmentation.py)
+        self.augmentation_backend = "batchgenerators"
+        # None means the GPU we train on (or the CPU if there is none)
+        self.augmentation_device = None
+
+        # if True, validate and predict_preprocessed_data_return_seg_and_softmax predict with an eval only copy of the
+        # network in which batch norms and 1x1 convolutions are folded into the convolutions before them (see
+        # lhunet/fusion.py). The copy is checked against the network on a random patch when it is made
+        self.fuse_network_for_inference = False
+        # (state of self.network it was made from, fused copy), see get_fused_network
+        self._fused_network = None
+        # LHUNet is trained on self.crop_size, its spatial attentions (key/value projections and position embeddings)
+        # are adapted to other sizes if self.inference_patch_size is set: 'pool' pools the keys and values to the
+        # training token grid, 'interpolate' resizes the projection weights instead (see token_grid.project_tokens)
+        self.inference_token_projection = "pool"
+
+        # activation checkpointing of the hybrid encoder/decoder stages (see lhunet/checkpointing.py): None is off, a
+        # list of stage names (e.g. ["hyb_encoder.0", "hyb_decoder.2"]) checkpoints those, 'auto' picks them with
+        # plan_checkpointing from a dry run of one batch so that training fits into checkpoint_memory_budget
+        self.checkpoint_stages = None
+        # GB. None means what is free on the GPU when the network is initialized
+        self.checkpoint_memory_budget = None
+
     def initialize(self, training=True, force_load_plans=False):
         """
         - replaced get_default_augmentation with get_moreDA_augmentation
@@ -194,19 +276,34 @@ class d_lka_former_trainer_synapse(Trainer_synapse):
                         "will wait all winter for your model to finish!"
                     )
 
-                self.tr_gen, self.val_gen = get_moreDA_augmentation(
-                    self.dl_tr,
-                    self.dl_val,
-                    self.data_aug_params["patch_size_for_spatialtransform"],
-                    self.data_aug_params,
-                    deep_supervision_scales=self.deep_supervision_scales
-                    if self.deep_supervision
-                    else None,
-                    pin_memory=self.pin_memory,
-                    use_nondetMultiThreadedAugmenter=False,
-                    seeds_train=seeds_train,
-                    seeds_val=seeds_val,
-                )
+                if self.augmentation_backend == "torch":
+                    self.tr_gen, self.val_gen = get_torch_augmentation(
+                        self.dl_tr,
+                        self.dl_val,
+                        self.data_aug_params["patch_size_for_spatialtransform"],
+                        self.data_aug_params,
+                        deep_supervision_scales=self.deep_supervision_scales
+                        if self.deep_supervision
+                        else None,
+                        pin_memory=self.pin_memory,
+                        seeds_train=seeds_train,
+                        seeds_val=seeds_val,
+                        device=self.augmentation_device,
+                    )
+                else:
+                    self.tr_gen, self.val_gen = get_moreDA_augmentation(
+                        self.dl_tr,
+                        self.dl_val,
+                        self.data_aug_params["patch_size_for_spatialtransform"],
+                        self.data_aug_params,
+                        deep_supervision_scales=self.deep_supervision_scales
+                        if self.deep_supervision
+                        else None,
+                        pin_memory=self.pin_memory,
+                        use_nondetMultiThreadedAugmenter=False,
+                        seeds_train=seeds_train,
+                        seeds_val=seeds_val,
+                    )
                 self.print_to_log_file(
                     "TRAINING KEYS:\n %s" % (str(self.dataset_tr.keys())),
                     also_print_to_console=False,
@@ -389,6 +486,56 @@ class d_lka_former_trainer_synapse(Trainer_synapse):
         self.print_to_log_file(f"MAdds: {round(model_flops * 1e-9, 4)} G")
         self.best_test_dice = 0
 
+        if self.checkpoint_stages is not None:
+            self.setup_checkpointing()
+
+    def setup_checkpointing(self):
+        """
+        applies self.checkpoint_stages to self.network, 'auto' is resolved here
+        """
+        stages = self.checkpoint_stages
+        if stages == "auto":
+            device = next(self.network.parameters()).device
+            if self.checkpoint_memory_budget is not None:
+                budget = self.checkpoint_memory_budget * 1024**3
+            elif device.type == "cuda":
+                free = torch.cuda.mem_get_info(device)[0]
+                budget = free + torch.cuda.memory_reserved(device)
+            else:
+                raise RuntimeError(
+                    "checkpoint_stages='auto' needs a checkpoint_memory_budget on the CPU"
+                )
+            example_input = torch.rand(
+                self.batch_size,
+                self.num_input_channels,
+                *self.patch_size,
+                device=device,
+            )
+            with autocast(enabled=self.fp16 and device.type == "cuda"):
+                stages, configurations = plan_checkpointing(
+                    self.network,
+                    example_input,
+                    budget,
+                    # SGD momentum
+                    extra_memory=sum(
+                        p.numel() * p.element_size() for p in self.network.parameters()
+                    ),
+                )
+            self.print_to_log_file(
+                "activation checkpointing for a budget of %.2f GB:" % (budget / 1024**3)
+            )
+            for config, memory, seconds in configurations:
+                self.print_to_log_file(
+                    "  %s: ~%.2f GB, +%.0f ms per iteration"
+                    % (
+                        config if len(config) > 0 else "none",
+                        memory / 1024**3,
+                        seconds * 1000,
+                    )
+                )
+        set_checkpointing(self.network, stages)
+        self.print_to_log_file("checkpointed stages: %s" % str(stages))
+
     def initialize_optimizer_and_scheduler(self):
         assert self.network is not None, "self.initialize_network must be called first"
         self.optimizer = torch.optim.SGD(
@@ -435,21 +582,26 @@ class d_lka_former_trainer_synapse(Trainer_synapse):
         """
         ds = self.network.do_ds
         self.network.do_ds = False
-        ret = super().validate(
-            do_mirroring=do_mirroring,
-            use_sliding_window=use_sliding_window,
-            step_size=step_size,
-            save_softmax=save_softmax,
-            use_gaussian=use_gaussian,
-            overwrite=overwrite,
-            validation_folder_name=validation_folder_name,
-            debug=debug,
-            all_in_gpu=all_in_gpu,
-            segmentation_export_kwargs=segmentation_export_kwargs,
-            run_postprocessing_on_folds=run_postprocessing_on_folds,
-        )
-
-        self.network.do_ds = ds
+        network = self.network
+        try:
+            if self.fuse_network_for_inference:
+                self.network = self.get_fused_network()
+            ret = super().validate(
+                do_mirroring=do_mirroring,
+                use_sliding_window=use_sliding_window,
+                step_size=step_size,
+                save_softmax=save_softmax,
+                use_gaussian=use_gaussian,
+                overwrite=overwrite,
+                validation_folder_name=validation_folder_name,
+                debug=debug,
+                all_in_gpu=all_in_gpu,
+                segmentation_export_kwargs=segmentation_export_kwargs,
+                run_postprocessing_on_folds=run_postprocessing_on_folds,
+            )
+        finally:
+            self.network = network
+            self.network.do_ds = ds
         return ret
 
     def predict_preprocessed_data_return_seg_and_softmax(
@@ -471,22 +623,64 @@ class d_lka_former_trainer_synapse(Trainer_synapse):
         """
         ds = self.network.do_ds
         self.network.do_ds = False
-        ret = super().predict_preprocessed_data_return_seg_and_softmax(
-            data,
-            do_mirroring=do_mirroring,
-            mirror_axes=mirror_axes,
-            use_sliding_window=use_sliding_window,
-            step_size=step_size,
-            use_gaussian=use_gaussian,
-            pad_border_mode=pad_border_mode,
-            pad_kwargs=pad_kwargs,
-            all_in_gpu=all_in_gpu,
-            verbose=verbose,
-            mixed_precision=mixed_precision,
-        )
-        self.network.do_ds = ds
+        if self.inference_patch_size is not None:
+            enable_any_patch_size(
+                self.network,
+                self.patch_size,
+                self.num_input_channels,
+                self.inference_token_projection,
+            )
+        network = self.network
+        try:
+            if self.fuse_network_for_inference and not getattr(
+                network, "is_fused", False
+            ):
+                self.network = self.get_fused_network()
+            ret = super().predict_preprocessed_data_return_seg_and_softmax(
+                data,
+                do_mirroring=do_mirroring,
+                mirror_axes=mirror_axes,
+                use_sliding_window=use_sliding_window,
+                step_size=step_size,
+                use_gaussian=use_gaussian,
+                pad_border_mode=pad_border_mode,
+                pad_kwargs=pad_kwargs,
+                all_in_gpu=all_in_gpu,
+                verbose=verbose,
+                mixed_precision=mixed_precision,
+            )
+        finally:
+            self.network = network
+            self.network.do_ds = ds
         return ret
 
+    def get_fused_network(self):
+        """
+        eval only copy of self.network for prediction, see fuse_for_inference. The copy is kept and only made again
+        once the weights or running statistics of self.network have changed (training steps, load_checkpoint, ...)
+        """
+        # every in-place change of a tensor (optimizer steps, load_state_dict, batch norm updates) bumps its version
+        key = (
+            id(self.network),
+            getattr(self.network, "any_patch_size", None),
+            tuple(
+                t._version
+                for t in chain(self.network.parameters(), self.network.buffers())
+            ),
+        )
+        if self._fused_network is None or self._fused_network[0] != key:
+            example_input = torch.rand(
+                1,
+                self.num_input_channels,
+                *self.patch_size,
+                device=next(self.network.parameters()).device,
+            )
+            self._fused_network = (
+                key,
+                fuse_for_inference(self.network, example_input),
+            )
+        return self._fused_network[1]
+
     def run_iteration(
         self, data_generator, do_backprop=True, run_online_evaluation=False
     ):
@@ -782,33 +976,135 @@ class d_lka_former_trainer_synapse(Trainer_synapse):
         return continue_training
     
     
+    def get_test_validate_kwargs(self):
+        return {
+            "do_mirroring": True,
+            "use_sliding_window": True,
+            "step_size": 1,  ####################################### YOUSEF HERE
+            "save_softmax": False,
+            "use_gaussian": True,
+            "overwrite": True,
+            "validation_folder_name": "test_raw",
+            "debug": False,
+            "all_in_gpu": True,
+            "segmentation_export_kwargs": None,
+            "run_postprocessing_on_folds": True,
+        }
+
     def maybe_test(self):
-        if self.epoch>750 and self.all_val_eval_metrics[-1]>0.86:
-            self.network.eval()
-            results=self.validate(
-                    do_mirroring = True,
-                    use_sliding_window = True,
-                    step_size = 1, ####################################### YOUSEF HERE
-                    save_softmax = False,
-                    use_gaussian = True,
-                    overwrite = True,
-                    validation_folder_name= "test_raw",
-                    debug = False,
-                    all_in_gpu = True,
-                    segmentation_export_kwargs = None,
-                    run_postprocessing_on_folds = True)
-            if results>self.best_test_dice:
-                self.save_checkpoint(
-                join(
-                    self.output_folder,
-                    f"model_ep_{(self.epoch+1):03d}_best_test_dice_{results:.5f}.model",
-                ))
-                self.best_test_dice=results
-            
+        self.maybe_collect_test_results()
+        if self.epoch > 750 and self.all_val_eval_metrics[-1] > 0.86:
+            if not self.test_in_background:
+                self.network.eval()
+                results = self.validate(**self.get_test_validate_kwargs())
+                self.network.train()
+                self.on_test_results(results, self.epoch)
+            elif self._pending_test is not None:
+                self.print_to_log_file(
+                    "test evaluation of epoch %d is still running, not testing epoch %d"
+                    % (self._pending_test[0], self.epoch)
+                )
+            else:
+                self.start_background_test()
+
+    def get_test_attributes(self):
+        """
+        the options set after construction that change how the network predicts. The trainer of the background test is
+        made from self.init_args only and gets these before it is initialized. The checkpoint_* options are left out:
+        checkpointing does nothing without gradients, and 'auto' would run training dry runs in the test process
+        """
+        return {
+            name: value
+            for name, value in vars(self).items()
+            if name.startswith("inference_")
+            or name
+            in ("export_mode", "fuse_network_for_inference", "postprocessing_in_memory")
+        }
+
+    def start_background_test(self):
+        """
+        Saves a snapshot of the current weights and evaluates it in a separate process (spawned, so that it can have
+        its own CUDA context). The results are picked up in maybe_collect_test_results
+        """
+        snapshot = join(
+            self.output_folder, "test_snapshot_ep_%03d.model" % (self.epoch + 1)
+        )
+        self.save_checkpoint(snapshot)
+        device = (
+            self.test_device
+            if self.test_device is not None
+            else self.network.get_device()
+        )
+        ctx = multiprocessing.get_context("spawn")
+        result_queue = ctx.Queue()
+        # not a Pool: pool workers are daemonic and validate needs to start its own export processes
+        process = ctx.Process(
+            target=run_test_in_background,
+            args=(
+                self.__class__,
+                self.init_args,
+                self.get_test_attributes(),
+                snapshot,
+                device,
+                self.test_memory_fraction,
+                self.get_test_validate_kwargs(),
+                result_queue,
+            ),
+        )
+        process.start()
+        self._pending_test = (self.epoch, snapshot, process, result_queue)
+        self.print_to_log_file(
+            "started test evaluation of epoch %d in the background" % self.epoch
+        )
+
+    def maybe_collect_test_results(self, wait=False):
+        """
+        Handles the results of the background test evaluation if it has finished. If wait is True we wait for it
+        """
+        if self._pending_test is None:
+            return
+        epoch, snapshot, process, result_queue = self._pending_test
+        if wait:
+            process.join()
+        elif process.is_alive():
+            return
+        if result_queue.empty():
+            # the process died without reporting back (killed, out of memory, ...)
+            success, results = False, "exit code %s" % str(process.exitcode)
+        else:
+            success, results = result_queue.get()
+        process.join()
+        self._pending_test = None
+
+        if success:
+            self.on_test_results(results, epoch, snapshot)
+        else:
             self.print_to_log_file(
-                f"Test Dice: {results:.5f}, Best Test Dice: {self.best_test_dice:.5f}"
-            )                
-            self.network.train()
+                "test evaluation of epoch %d failed:\n%s" % (epoch, results)
+            )
+        for f in (snapshot, snapshot + ".pkl"):
+            if isfile(f):
+                os.remove(f)
+
+    def on_test_results(self, results, epoch, snapshot=None):
+        """
+        :param snapshot: checkpoint the results were computed with. If None, the current weights are saved instead
+        """
+        if results > self.best_test_dice:
+            fname = join(
+                self.output_folder,
+                f"model_ep_{(epoch+1):03d}_best_test_dice_{results:.5f}.model",
+            )
+            if snapshot is None:
+                self.save_checkpoint(fname)
+            else:
+                os.replace(snapshot, fname)
+                os.replace(snapshot + ".pkl", fname + ".pkl")
+            self.best_test_dice = results
+
+        self.print_to_log_file(
+            f"Test Dice (epoch {epoch}): {results:.5f}, Best Test Dice: {self.best_test_dice:.5f}"
+        )
 
     def run_training(self):
         """
@@ -829,4 +1125,6 @@ class d_lka_former_trainer_synapse(Trainer_synapse):
             self.network.do_ds = False
         ret = super().run_training()
         self.network.do_ds = ds
+        # validate writes to the same output folder (postprocessing.json), so the test evaluation must be done first
+        self.maybe_collect_test_results(wait=True)
         return ret
@@ -0,0 +1,237 @@
+import json
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+
+import numpy as np
+
+MAGIC = b"DLKACHK1"
+# header offset, header length, magic
+FOOTER = struct.Struct("<QQ8s")
+default_chunk_shape = (32, 64, 64)
+
+
+def save_chunked(
+    filename, array, chunk_shape=default_chunk_shape, level=1, shuffle=True
+):
+    """
+    Stores array (c, x, y, z) as a grid of independently zlib compressed chunks so that patches can be read without
+    decompressing the whole volume. Each chunk holds all channels of a block of chunk_shape voxels (edge chunks are
+    smaller). With shuffle, the bytes of the values are grouped by significance before compressing (like the shuffle
+    filter of blosc), which compresses float data much better.
+
+    Layout: magic, compressed chunks in C order, chunk index (offset and length of each chunk, uint64), json header,
+    footer (offset and length of the header, magic). The file is written to a temporary name and renamed at the end,
+    so readers never see half written files
+
+    :param chunk_shape: spatial shape of the chunks. Chunks of about the size of a training patch (or a fraction of
+    it) keep the overhead of reading a patch low
+    :param level: zlib compression level. 1 is much faster than the default of np.savez_compressed and only slightly
+    larger
+    """
+    array = np.ascontiguousarray(array)
+    assert len(array.shape) == 4, "expected (c, x, y, z), got shape %s" % str(
+        array.shape
+    )
+    chunk_shape = tuple(int(i) for i in chunk_shape)
+    grid = [int(np.ceil(s / c)) for s, c in zip(array.shape[1:], chunk_shape)]
+    num_chunks = int(np.prod(grid))
+    offsets = np.zeros(num_chunks, dtype=np.uint64)
+    lengths = np.zeros(num_chunks, dtype=np.uint64)
+
+    tmp_file = filename + ".tmp%d" % os.getpid()
+    with open(tmp_file, "wb") as f:
+        f.write(MAGIC)
+        for i, idx in enumerate(product(*[range(g) for g in grid])):
+            slicer = (slice(None),) + tuple(
+                slice(j * c, (j + 1) * c) for j, c in zip(idx, chunk_shape)
+            )
+            chunk = np.ascontiguousarray(array[slicer])
+            if shuffle and chunk.dtype.itemsize > 1:
+                raw = chunk.view(np.uint8).reshape(-1, chunk.dtype.itemsize).T.tobytes()
+            else:
+                raw = chunk.tobytes()
+            compressed = zlib.compress(raw, level)
+            offsets[i] = f.tell()
+            lengths[i] = len(compressed)
+            f.write(compressed)
+
+        index_offset = f.tell()
+        f.write(offsets.tobytes())
+        f.write(lengths.tobytes())
+        header = json.dumps(
+            {
+                "shape": list(array.shape),
+                "dtype": array.dtype.str,
+                "chunk_shape": list(chunk_shape),
+                "shuffle": bool(shuffle),
+                "index_offset": index_offset,
+                "num_chunks": num_chunks,
+            }
+        ).encode()
+        header_offset = f.tell()
+        f.write(header)
+        f.write(FOOTER.pack(header_offset, len(header), MAGIC))
+    os.replace(tmp_file, filename)
+
+
+class ChunkedVolume(object):
+    def __init__(self, filename):
+        """
+        Read access to a file written by save_chunked. Indexing with slices (step 1) only reads and decompresses the
+        chunks the slices touch and returns a new numpy array, so this can be used in place of a memmapped npy in the
+        data loaders:
+
+            patch = ChunkedVolume(f)[:, 10:90, 20:180, 20:180]
+
+        Reads use os.pread on a file descriptor that is reopened after a fork, so one object can be shared by threads
+        and by (forked) data loader processes
+        """
+        self.filename = filename
+        self._fd = None
+        self._pid = None
+        fd = self._get_fd()
+        file_size = os.fstat(fd).st_size
+        header_offset, header_length, magic = FOOTER.unpack(
+            os.pread(fd, FOOTER.size, file_size - FOOTER.size)
+        )
+        if magic != MAGIC:
+            raise RuntimeError("%s is not a chunked volume" % filename)
+        header = json.loads(os.pread(fd, header_length, header_offset))
+        self.shape = tuple(header["shape"])
+        self.dtype = np.dtype(header["dtype"])
+        self.chunk_shape = tuple(header["chunk_shape"])
+        self.shuffle = header["shuffle"]
+        self.grid = tuple(
+            int(np.ceil(s / c)) for s, c in zip(self.shape[1:], self.chunk_shape)
+        )
+        num_chunks = header["num_chunks"]
+        index = np.frombuffer(
+            os.pread(fd, num_chunks * 16, header["index_offset"]), dtype=np.uint64
+        )
+        self._offsets = index[:num_chunks]
+        self._lengths = index[num_chunks:]
+
+    def _get_fd(self):
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(self.filename, os.O_RDONLY)
+            self._pid = os.getpid()
+        return self._fd
+
+    def close(self):
+        if self._fd is not None and self._pid == os.getpid():
+            os.close(self._fd)
+        self._fd = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except (OSError, AttributeError):
+            pass
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def chunk_bounds(self, idx):
+        return tuple(
+            (i * c, min((i + 1) * c, s))
+            for i, c, s in zip(idx, self.chunk_shape, self.shape[1:])
+        )
+
+    def read_chunk(self, idx):
+        """
+        decompressed chunk idx (index in the chunk grid) as (c, x, y, z) array
+        """
+        flat = int(np.ravel_multi_index(idx, self.grid))
+        raw = zlib.decompress(
+            os.pread(self._get_fd(), int(self._lengths[flat]), int(self._offsets[flat]))
+        )
+        shape = (self.shape[0],) + tuple(ub - lb for lb, ub in self.chunk_bounds(idx))
+        if self.shuffle and self.dtype.itemsize > 1:
+            chunk = np.frombuffer(raw, dtype=np.uint8).reshape(self.dtype.itemsize, -1)
+            return chunk.T.copy().view(self.dtype).reshape(shape)
+        return np.frombuffer(raw, dtype=self.dtype).reshape(shape)
+
+    def read(self, bbox=None, num_threads=1):
+        """
+        :param bbox: [[lb, ub], [lb, ub], [lb, ub]] of the spatial axes (ub exclusive). None reads everything
+        :param num_threads: chunks are decompressed by this many threads (zlib releases the GIL)
+        :return: (c, x, y, z) array
+        """
+        if bbox is None:
+            bbox = [[0, s] for s in self.shape[1:]]
+        out = np.empty(
+            (self.shape[0],) + tuple(max(ub - lb, 0) for lb, ub in bbox),
+            dtype=self.dtype,
+        )
+        if out.size == 0:
+            return out
+        chunk_ranges = [
+            range(lb // c, (ub - 1) // c + 1)
+            for (lb, ub), c in zip(bbox, self.chunk_shape)
+        ]
+
+        def copy_chunk(idx):
+            chunk = self.read_chunk(idx)
+            src = [slice(None)]
+            dst = [slice(None)]
+            for (lb, ub), (c_lb, c_ub) in zip(bbox, self.chunk_bounds(idx)):
+                start, stop = max(lb, c_lb), min(ub, c_ub)
+                src.append(slice(start - c_lb, stop - c_lb))
+                dst.append(slice(start - lb, stop - lb))
+            out[tuple(dst)] = chunk[tuple(src)]
+
+        chunks = list(product(*chunk_ranges))
+        if num_threads > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(num_threads) as executor:
+                list(executor.map(copy_chunk, chunks))
+        else:
+            for idx in chunks:
+                copy_chunk(idx)
+        return out
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        if any(i is Ellipsis for i in item):
+            raise IndexError("ChunkedVolume does not support ...")
+        item = item + (slice(None),) * (len(self.shape) - len(item))
+        bbox = []
+        squeeze = []
+        for axis, (s, size) in enumerate(zip(item[1:], self.shape[1:])):
+            if isinstance(s, (int, np.integer)):
+                s = int(s) + size if s < 0 else int(s)
+                if not 0 <= s < size:
+                    raise IndexError(
+                        "index %d is out of bounds for axis %d with size %d"
+                        % (s, axis + 1, size)
+                    )
+                bbox.append([s, s + 1])
+                squeeze.append(axis + 1)
+            elif isinstance(s, slice):
+                start, stop, step = s.indices(size)
+                if step != 1:
+                    raise IndexError("ChunkedVolume only supports slices with step 1")
+                bbox.append([start, max(start, stop)])
+            else:
+                raise IndexError(
+                    "ChunkedVolume only supports ints and slices for the spatial axes"
+                )
+        out = self.read(bbox)
+        if len(squeeze) > 0:
+            out = out.squeeze(tuple(squeeze))
+        return out[item[0]]
+
+    def __array__(self, dtype=None):
+        out = self.read()
+        return out if dtype is None else out.astype(dtype)
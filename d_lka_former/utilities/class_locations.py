@@ -0,0 +1,165 @@
+import numpy as np
+from scipy.ndimage import label as connected_components
+
+
+def compute_class_locations(
+    seg, all_classes, num_samples=10000, min_percent_coverage=0.01, seed=1234
+):
+    """
+    Samples up to num_samples voxel coordinates per class (but at least min_percent_coverage of the voxels of the
+    class) so that the data loaders can force foreground into patches. Gives the same samples as calling
+    np.argwhere(seg == c) for every class, but only goes over the volume once: the voxels of all classes are found with
+    a lookup table and grouped by class with one stable sort. Each sampled voxel also gets the id of the connected
+    component of its class (6-connectivity, labeled within the bounding box of the class) it belongs to, see
+    ClassLocations.sample_voxel
+
+    :param seg: (x, y, z) segmentation, -1 (outside of the nonzero mask) is allowed
+    :param all_classes: the labels to look for
+    :return: dict of arrays, see ClassLocations
+    """
+    all_classes = np.array(all_classes, dtype=np.int64)
+    seg = np.asarray(seg)
+    seg_int = np.round(seg).astype(np.int32).ravel()
+    max_label = max(int(all_classes.max()) if len(all_classes) > 0 else 0, 0)
+    np.clip(seg_int, -1, max_label + 1, out=seg_int)
+    lookup = np.zeros(max_label + 3, dtype=bool)
+    lookup[all_classes[all_classes >= 0]] = True
+    # -1 indexes the last entry, which is False
+    mask = lookup[seg_int]
+    voxels = np.flatnonzero(mask)
+    voxel_labels = seg_int[voxels]
+    counts = np.bincount(voxel_labels, minlength=max_label + 1)
+    label_starts = np.concatenate(([0], np.cumsum(counts)))
+    # stable, so the voxels of each class stay in C order like np.argwhere returns them
+    voxels = voxels[np.argsort(voxel_labels, kind="stable")]
+
+    rndst = np.random.RandomState(seed)
+    selected = []
+    offsets = [0]
+    class_counts = []
+    regions = []
+    # same order as all_classes, otherwise rndst would give different samples than before
+    for c in all_classes:
+        num_voxels = int(counts[c]) if c >= 0 else 0
+        class_counts.append(num_voxels)
+        voxels_of_class = voxels[
+            label_starts[max(c, 0)] : label_starts[max(c, 0)] + num_voxels
+        ]
+        regions_of_class = np.zeros(0, dtype=np.int32)
+        if num_voxels > 0:
+            coordinates = np.unravel_index(voxels_of_class, seg.shape)
+            box = tuple(slice(int(i.min()), int(i.max()) + 1) for i in coordinates)
+            components = connected_components(
+                seg_int.reshape(seg.shape)[box] == c
+            )[0]
+
+            target_num_samples = min(num_samples, num_voxels)
+            target_num_samples = max(
+                target_num_samples, int(np.ceil(num_voxels * min_percent_coverage))
+            )
+            voxels_of_class = voxels_of_class[
+                rndst.choice(num_voxels, target_num_samples, replace=False)
+            ]
+            regions_of_class = components[
+                tuple(
+                    i - b.start
+                    for i, b in zip(np.unravel_index(voxels_of_class, seg.shape), box)
+                )
+            ].astype(np.int32)
+        selected.append(voxels_of_class)
+        regions.append(regions_of_class)
+        offsets.append(offsets[-1] + len(voxels_of_class))
+    selected = np.concatenate(selected)
+
+    coordinate_dtype = np.int16 if max(seg.shape) < np.iinfo(np.int16).max else np.int32
+    return {
+        "classes": all_classes,
+        "class_counts": np.array(class_counts, dtype=np.int64),
+        "offsets": np.array(offsets, dtype=np.int64),
+        "coordinates": np.stack(np.unravel_index(selected, seg.shape), 1).astype(
+            coordinate_dtype
+        ),
+        "regions": np.concatenate(regions),
+    }
+
+
+def save_class_locations(filename, locations):
+    """
+    locations is what compute_class_locations returns. This is a npz, but we don't want it to end in .npz because
+    every npz in the preprocessed data folder is considered a case
+    """
+    with open(filename, "wb") as f:
+        np.savez(f, **locations)
+
+
+class ClassLocations(object):
+    def __init__(self, classes, offsets, coordinates, regions=None, class_counts=None):
+        """
+        Sampled voxel coordinates per class. The coordinates of classes[i] are coordinates[offsets[i]:offsets[i + 1]],
+        regions holds the connected component (of their class) of each of them
+        """
+        self.classes = classes
+        self.offsets = offsets
+        self.coordinates = coordinates
+        self.regions = regions
+        self.class_counts = class_counts
+        self._index = {int(c): i for i, c in enumerate(classes)}
+        self._regions_of_class = {}
+
+    @staticmethod
+    def load(filename):
+        with np.load(filename) as f:
+            return ClassLocations(
+                f["classes"],
+                f["offsets"],
+                f["coordinates"],
+                f["regions"],
+                f["class_counts"],
+            )
+
+    @staticmethod
+    def from_dict(class_locations):
+        """
+        properties["class_locations"] of data that was preprocessed before the locations were stored in their own
+        file. There are no regions in there
+        """
+        classes = sorted(class_locations.keys())
+        coordinates = [np.array(class_locations[c]).reshape(-1, 3) for c in classes]
+        offsets = np.cumsum([0] + [len(i) for i in coordinates])
+        return ClassLocations(
+            np.array(classes), offsets, np.concatenate(coordinates).astype(np.int64)
+        )
+
+    def voxels(self, c):
+        i = self._index[int(c)]
+        return self.coordinates[self.offsets[i] : self.offsets[i + 1]]
+
+    def foreground_classes(self):
+        """
+        classes > 0 with at least one sampled voxel
+        """
+        num_samples = np.diff(self.offsets)
+        return self.classes[(self.classes > 0) & (num_samples > 0)]
+
+    def sample_voxel(self, selected_class, stratify_regions=False):
+        """
+        A random voxel of selected_class. With stratify_regions, a connected component is drawn first (with equal
+        probability) and then a voxel in it, so small structures that are separate from the large ones of the same
+        class are sampled as often as those
+        """
+        voxels = self.voxels(selected_class).astype(np.int64)
+        if not stratify_regions or self.regions is None:
+            return voxels[np.random.choice(len(voxels))]
+        i = self._index[int(selected_class)]
+        if i not in self._regions_of_class:
+            regions = self.regions[self.offsets[i] : self.offsets[i + 1]]
+            # voxel indices grouped by region
+            order = np.argsort(regions, kind="stable")
+            region_starts = np.flatnonzero(np.diff(regions[order], prepend=-1))
+            self._regions_of_class[i] = (
+                order,
+                np.append(region_starts, len(regions)),
+            )
+        order, bounds = self._regions_of_class[i]
+        r = np.random.choice(len(bounds) - 1)
+        return voxels[order[np.random.randint(bounds[r], bounds[r + 1])]]
@@ -0,0 +1,44 @@
+import os
+from multiprocessing import shared_memory
+from typing import Tuple
+
+import numpy as np
+
+
+def shared_memory_available(nbytes: int, margin: float = 1.2) -> bool:
+    """
+    Shared memory lives in /dev/shm, which is small in some setups (docker defaults to 64 MB). Writing beyond its size
+    does not raise an error, it kills the process with SIGBUS. So check first whether the array fits
+    """
+    try:
+        stat = os.statvfs("/dev/shm")
+    except OSError:
+        return False
+    return stat.f_bavail * stat.f_frsize > nbytes * margin
+
+
+def array_to_shared_memory(array: np.ndarray) -> Tuple[str, tuple, str]:
+    """
+    Copies array into a new shared memory block and returns a handle (name, shape, dtype) that can be sent to other
+    processes instead of the array itself. Whoever is the last to use the block must unlink it, see
+    array_from_shared_memory
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[:] = array
+    del shared
+    handle = (shm.name, array.shape, array.dtype.str)
+    shm.close()
+    return handle
+
+
+def array_from_shared_memory(
+    handle: Tuple[str, tuple, str],
+) -> Tuple[np.ndarray, shared_memory.SharedMemory]:
+    """
+    Returns the array behind handle (no copy) together with the shared memory block. The array is only valid until the
+    block is closed. When you are done: delete all references to the array, then call shm.close() and shm.unlink()
+    """
+    name, shape, dtype = handle
+    shm = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf), shm
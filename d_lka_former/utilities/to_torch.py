@@ -29,3 +29,14 @@ def to_cuda(data, non_blocking=True, gpu_id=0):
     else:
         data = data.cuda(gpu_id, non_blocking=non_blocking)
     return data
+
+
+def to_device(data, device, non_blocking=True):
+    """
+    device is what NeuralNetwork.get_device returns, so either 'cpu' or the index of a GPU
+    """
+    if device == "cpu":
+        if isinstance(data, list):
+            return [i.cpu() for i in data]
+        return data.cpu()
+    return to_cuda(data, non_blocking=non_blocking, gpu_id=device)
@@ -445,7 +445,7 @@ void deformable_col2im_cuda(cudaStream_t stream,
       <<<GET_BLOCKS(num_kernels), CUDA_NUM_THREADS,
           0, stream>>>(
         num_kernels, data_col, data_offset, channels, depth_im, height_im, width_im,
-        kernel_d, kernel_h, kernel_w, pad_d, pad_h, pad_h, stride_d, stride_h, stride_w,
+        kernel_d, kernel_h, kernel_w, pad_d, pad_h, pad_w, stride_d, stride_h, stride_w,
         dilation_d, dilation_h, dilation_w, channel_per_deformable_group,
         batch_size, deformable_group, depth_col, height_col, width_col, grad_im);
   cudaError_t err = cudaGetLastError();